@@ -26,6 +26,10 @@ def create_app(config_class=Config):
 
     # Initialize extensions
     db.init_app(app)
+
+    from app.metrics import init_query_counting
+    init_query_counting(app)
+
     CORS(app, resources={r"/*": {"origins": "*"}},
          supports_credentials=True,
          allow_headers=["Content-Type", "Authorization"])
@@ -34,6 +38,19 @@ def create_app(config_class=Config):
     from app.api.routes import api_bp
     app.register_blueprint(api_bp)
 
+    from app.services.invalidation import init_invalidation_bus
+    init_invalidation_bus(app)
+
+    from app.services.presence_store import init_presence_store
+    init_presence_store(app)
+
+    from app.services.user_service import init_user_lookups
+    init_user_lookups(app)
+
+    # Register CLI commands
+    from app.commands import register_commands
+    register_commands(app)
+
     # Initialize WebSocket handlers
     # with app.app_context():
     #     from app.websocket import socket_handlers
@@ -49,18 +66,24 @@ def init_database(app):
         db.drop_all()
         db.create_all()
 
+        from app.migrations import stamp_head
+        stamp_head()
+
         # Insert example data
         from app.services.dummy_data import insert_example_data
         insert_example_data()
 
+        from app.services.conversation_service import ConversationService
+        ConversationService().rebuild()
+
         from app.services.item_service import ItemService
         item_service = ItemService()
         item_service.reset_items()
         print("Database initialized with example data.")
 
 def create_tables(app):
-    """Create database tables if they do not exist"""
+    """Create missing database tables and apply pending schema migrations"""
     with app.app_context():
-        from app.models import db
-        db.create_all()
+        from app.migrations import upgrade
+        upgrade()
         print("Database tables created successfully.")
\ No newline at end of file
@@ -1,5 +1,6 @@
+import hmac
 import re
-from flask import Blueprint, current_app, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
@@ -10,6 +11,9 @@ from app.services.message_service import MessageService
 from app.services.contact_service import ContactService
 from app.services.group_service import GroupService
 from app.services.item_service import ItemService
+from app.services.chat_list_service import ChatListService
+from app.services.send_service import SendService
+from app.metrics import metrics
 from app import db
 
 from app.websocket import websockets
@@ -20,29 +24,8 @@ message_service = MessageService()
 contact_service = ContactService()
 group_service = GroupService()
 items_service = ItemService()
-
-
-#############################
-## HELPER FUNCTION
-#############################
-
-def add_last_message_to_chats(user_id, chats: list) -> list:
-    """
-    Adds the last message timestamp to each chat in the list of chats.
-    Or if group when joined. Else 2001-09-11T12:46:00Z.
-    """
-    for chat in chats:
-        last_message_date = message_service.get_last_message_date_for_contact(user_id, chat["contact_id"])
-
-        if last_message_date:
-            chat["last_message_timestamp"] = last_message_date
-        else:
-            if group_service.is_id_group(chat["contact_id"]):
-                chat["last_message_timestamp"] = chat.get("joined_at", "2001-09-11T12:46:00Z")
-            else:
-                chat["last_message_timestamp"] = "2001-09-11T12:46:00Z"
-    return chats
-
+chat_list_service = ChatListService()
+send_service = SendService()
 
 
 #############################
@@ -205,15 +188,11 @@ def change_profile():
 def get_chats():
     user_id = get_jwt_identity()
 
-    contacts = contact_service.get_user_contacts_by_user_id(user_id)
-    if "error" in contacts:
-        return jsonify(contacts), 500
-
-    groups = group_service.get_groups_by_user_id(user_id)
-    if "error" in groups:
-        return jsonify(groups), 500
+    chats = chat_list_service.get_chats(user_id)
+    if "error" in chats:
+        return jsonify(chats), 500
 
-    return jsonify({"chats": add_last_message_to_chats(user_id, contacts + groups)})
+    return jsonify({"chats": chats})
 
 
 @api_bp.route("/getAllUsers", methods=['GET'])
@@ -242,24 +221,62 @@ def get_chat_messages():
     data = request.json if request.is_json else request.args
     chat_id = data.get('chat_id')
     page = data.get('page', type=int)
+    before = data.get('before')
+    after = data.get('after')
+    limit = data.get('limit', type=int)
+
+    is_group, error = authorize_chat(user_id, chat_id)
+    if error:
+        return error
+
+    if is_group:
+        result, status_code = message_service.get_messages_with_groups(user_id, chat_id, page, before, after, limit)
+    else:
+        result, status_code = message_service.get_messages_with_contact(user_id, chat_id, page, before, after, limit)
+
+    return jsonify(result), status_code
+
+
+@api_bp.route("/exportChat", methods=['GET'])
+@jwt_required()
+def export_chat():
+    user_id = get_jwt_identity()
+    data = request.json if request.is_json else request.args
+    chat_id = data.get('chat_id')
+    compress = str(data.get('gzip', 'false')).lower() in ('1', 'true')
+
+    is_group, error = authorize_chat(user_id, chat_id)
+    if error:
+        return error
+
+    headers = {"Content-Disposition": f"attachment; filename=chat-{chat_id}.ndjson"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(message_service.export_chat(user_id, chat_id, is_group, compress)),
+        mimetype="application/x-ndjson",
+        headers=headers
+    )
+
+
+@api_bp.route("/markChatRead", methods=['POST'])
+@jwt_required()
+def mark_chat_read():
+    user_id = get_jwt_identity()
+    data = request.json if request.is_json else request.args
+    chat_id = data.get('chat_id')
+    message_id = data.get('message_id')
 
     if not chat_id:
         return jsonify({"error": "'chat_id' is required"}), 400
     if not user_service.does_user_exist(user_id):
         return jsonify({"error": "User not found"}), 400
 
-    if group_service.is_id_group(chat_id):
-        if not group_service.does_group_exist(chat_id):
-            return jsonify({"error": "Group not found"}), 404
-        if not group_service.is_user_member(user_id, chat_id):
-            return jsonify({"error": "User is not a member of the group"}), 403
-        result, status_code = message_service.get_messages_with_groups(user_id, chat_id, page)
-    else:
-        if not user_service.does_user_exist(chat_id):
-            return jsonify({"error": "Contact not found"}), 404
-        result, status_code = message_service.get_messages_with_contact(user_id, chat_id, page)
+    result = message_service.mark_chat_read(user_id, chat_id, message_id)
+    if "error" in result:
+        return jsonify(result), 400
 
-    return jsonify(result), status_code
+    return jsonify(result), 200
 
 
 @api_bp.route("/getOwnProfile", methods=['GET'])
@@ -284,76 +301,33 @@ def get_own_profile():
 def save_message():
     user_id = get_jwt_identity()
     data = request.json if request.is_json else request.args
-    user = User.query.filter_by(user_id=user_id).first()
     recipient_id = data.get("recipient_id")
     content = data.get("content")
-    is_group = group_service.does_group_exist(recipient_id)
-    active_items = items_service.get_active_items(user_id)
-
-    if active_items:  # Check if the list is not empty before iterating
-        for item in active_items:
-            if item['item_name'] == "timeout":
-                return jsonify({"error": "You are currently in timeout and cannot send messages", "until": item['active_until']}), 403
 
-
-    if not recipient_id:
-        return jsonify({"error": "'recipient_id' is required"}), 400
-    if not content:
-        return jsonify({"error": "'content' is required"}), 400
-
-    try:
-        # Check if the sender (current user) is blocked by the recipient
-        recipient_info = UserContact.query.filter_by(user_id=user_id, contact_id=recipient_id).first()
-    except:
-        return jsonify({"error": "recipient information could not be gathered"}), 400
-
-    # Check if sender is blocked by recipient
-    if recipient_info and (recipient_info.status == ContactStatusEnum.BLOCK or recipient_info.status == ContactStatusEnum.FBLOCKED):
-        return jsonify({"error": "Unable to send message because of user rules"}), 403    # Save the message first
-    result = message_service.save_message(user_id, recipient_id, content, is_group=is_group)
-    
+    result, status_code = send_service.send(user_id, recipient_id, content)
     if "error" in result:
-        return jsonify(result), 400
+        return jsonify(result), status_code
 
-    # Update streak after successful message send (only for direct messages, not groups)
-    if not is_group:
-        contact_service.update_streak(user_id, recipient_id)
-    
-    # Handle LASTWORDS status after successful message save
-    is_last_words = recipient_info and recipient_info.status == ContactStatusEnum.LASTWORDS
-    if is_last_words:
-        recipient_info.status = ContactStatusEnum.FBLOCKED
-        db.session.commit()    # Send websocket message (unless it was last words)
-    if not is_last_words:
-        websockets.send_message(user, recipient_id, content, is_group=is_group)
-
-    # Kontakte automatisch hinzufügen (beidseitig) - only for direct messages, not groups
-    if not is_group:
-        for uid, cid in [(user_id, recipient_id), (recipient_id, user_id)]:
-            exists = UserContact.query.filter_by(user_id=uid, contact_id=cid).first()
-            if not exists:
-                db.session.add(UserContact(
-                    user_id=uid,
-                    contact_id=cid,
-                    status=ContactStatusEnum.NEW,
-                    streak=0,
-                    continue_streak=True
-                ))
-                websockets.new_contact(cid, uid)
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": f"Contact add failed: {str(e)}"}), 500
+    websockets.deliver_message(result, recipient_id, content)
 
     # Return appropriate response based on status
-    if is_last_words:
+    if result["last_words"]:
         return jsonify({"success": "Your last message has been send you are now blocked"}), 200
     else:
         return jsonify({"success": "Message saved successfully", "message_id": result["message_id"]})
 
 
+@api_bp.route("/metrics", methods=['GET'])
+def get_metrics():
+    # operators only: the X-Metrics-Token header must match METRICS_TOKEN, unset turns the endpoint off
+    token = current_app.config["METRICS_TOKEN"]
+    if not token:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Metrics-Token", "").encode(), token.encode()):
+        return jsonify({"error": "Invalid metrics token"}), 401
+    return jsonify(metrics.snapshot()), 200
+
+
 # Simple test endpoint
 @api_bp.route("/")
 @jwt_required()
@@ -661,6 +635,35 @@ def delete_message():
     if "error" in result:
         return jsonify(result), 400
 
-    recipient_id = message_service.get_recipient_id_by_message_id(message_id)
-    websockets.updated_message(recipient_id, user_id)
+    message = message_service.get_message_by_id(message_id)
+    if message:
+        websockets.updated_message(message.recipient_user_id, user_id, message.is_group)
     return jsonify({"success": "Message deleted successfully"}), 200
+
+
+#############################
+## HELPER FUNCTIONS
+#############################
+
+def authorize_chat(user_id, chat_id):
+    """
+    Membership/contact checks for reading a chat.
+
+    Returns:
+        tuple: (is_group, None) if the user may read the chat, else (None, error response)
+    """
+    if not chat_id:
+        return None, (jsonify({"error": "'chat_id' is required"}), 400)
+    if not user_service.does_user_exist(user_id):
+        return None, (jsonify({"error": "User not found"}), 400)
+
+    if group_service.is_id_group(chat_id):
+        if not group_service.does_group_exist(chat_id):
+            return None, (jsonify({"error": "Group not found"}), 404)
+        if not group_service.is_user_member(user_id, chat_id):
+            return None, (jsonify({"error": "User is not a member of the group"}), 403)
+        return True, None
+
+    if not user_service.does_user_exist(chat_id):
+        return None, (jsonify({"error": "Contact not found"}), 404)
+    return False, None
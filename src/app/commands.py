@@ -0,0 +1,64 @@
+import click
+
+
+def register_commands(app):
+    """Register maintenance commands on the flask CLI (`flask --app src/main.py <command>`)."""
+
+    @app.cli.command("rebuild-conversations")
+    def rebuild_conversations():
+        """Rebuild the conversation read model from the message tables."""
+        from app.services.conversation_service import ConversationService
+
+        result = ConversationService().rebuild()
+        if "error" in result:
+            raise click.ClickException(result["error"])
+        click.echo(f"Rebuilt {result['rows']} conversation rows.")
+
+    @app.cli.command("db-upgrade")
+    @click.option("--target", type=int, default=None, help="Version to migrate to (default: latest).")
+    def db_upgrade(target):
+        """Apply pending schema migrations."""
+        from app.migrations import upgrade, current_version
+
+        applied = upgrade(target)
+        click.echo(f"Applied {len(applied)} migration(s), schema is at version {current_version()}.")
+
+    @app.cli.command("db-version")
+    def db_version():
+        """Show the applied and the latest schema version."""
+        from app.migrations import current_version, head_version
+
+        click.echo(f"current: {current_version()} head: {head_version()}")
+
+    @app.cli.command("check-query-plans")
+    def check_query_plans_command():
+        """Fail if a hot service query does a full table scan."""
+        from app.migrations.query_plans import check_query_plans
+
+        result = check_query_plans()
+        if "skipped" in result:
+            click.echo(result["skipped"])
+            return
+        for name, plan in result["plans"].items():
+            click.echo(f"{name}: {' | '.join(plan)}")
+        if result["failures"]:
+            names = ", ".join(name for name, _ in result["failures"])
+            raise click.ClickException(f"Full table scan in: {names}")
+
+    @app.cli.command("expire-streaks")
+    def expire_streaks():
+        """Reset the streaks of all pairs that stopped writing each other (what the background job does)."""
+        from app.services.streak_service import StreakService
+
+        result = StreakService().expire_streaks(batch_size=app.config["STREAK_EXPIRY_BATCH"])
+        if "error" in result:
+            raise click.ClickException(result["error"])
+        click.echo(f"Checked {result['checked']} streak(s), {result['expired']} expired.")
+
+    @app.cli.command("reset-presence")
+    def reset_presence():
+        """Mark every user offline in the presence store."""
+        from app.services.presence_store import get_presence_store
+
+        get_presence_store().reset()
+        click.echo("Presence reset.")
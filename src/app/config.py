@@ -5,7 +5,50 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///umoc.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_THREADS = int(os.getenv('DB_THREADS', 10))  # thread pool for the database calls in src/serve.py
     DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
+    MESSAGE_PAGE_SIZE = 20  # legacy ?page= pagination
+    MESSAGE_PAGE_MAX = int(os.getenv('MESSAGE_PAGE_MAX', 100))  # hard cap for every message page
+    # write-behind: queue the writes of /saveMessage and commit them in batches (see app/services/write_behind.py)
+    MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'False').lower() == 'true'
+    WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', 200))
+    WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 5))
+    WRITE_BEHIND_WAIT = os.getenv('WRITE_BEHIND_WAIT', 'True').lower() == 'true'  # wait for the commit by default
+    WRITE_BEHIND_WAIT_TIMEOUT = 5  # seconds
+    # multi-worker Socket.IO: redis://host:6379/0 (or local://127.0.0.1:6499 for the local broker), unset = one worker
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    LOCAL_QUEUE_KEY = os.getenv('LOCAL_QUEUE_KEY')  # shared secret of the local:// broker, see app/websocket/local_queue.py
+    CONNECTION_REGISTRY_URL = os.getenv('CONNECTION_REGISTRY_URL')  # defaults to SOCKETIO_MESSAGE_QUEUE if that is redis
+    CONNECTION_REGISTRY_TTL_S = int(os.getenv('CONNECTION_REGISTRY_TTL_S', 60))  # connections of a crashed worker drop out after this
+    INVALIDATION_BUS_URL = os.getenv('INVALIDATION_BUS_URL')  # redis:// or local:// URL, defaults to SOCKETIO_MESSAGE_QUEUE
+    # typing indicator: at most one receive_char per sender and chat per interval, see app/websocket/typing_throttle.py
+    TYPING_INTERVAL_MS = int(os.getenv('TYPING_INTERVAL_MS', 300))
+    TYPING_STALE_MS = int(os.getenv('TYPING_STALE_MS', 2000))
+    TYPING_MAX_PENDING = int(os.getenv('TYPING_MAX_PENDING', 10000))
+    # presence store: redis URL, defaults to a redis SOCKETIO_MESSAGE_QUEUE, else in memory
+    PRESENCE_STORE_URL = os.getenv('PRESENCE_STORE_URL')
+    PRESENCE_TTL_S = int(os.getenv('PRESENCE_TTL_S', 60))  # offline this long after a worker crashed
+    PRESENCE_INTERVAL_MS = int(os.getenv('PRESENCE_INTERVAL_MS', 500))  # presence_diff frames, see app/websocket/presence.py
+    # missed-event replay, see app/websocket/event_log.py
+    EVENT_LOG_URL = os.getenv('EVENT_LOG_URL')  # redis URL, defaults to a redis SOCKETIO_MESSAGE_QUEUE, else in memory
+    EVENT_LOG_RETENTION = int(os.getenv('EVENT_LOG_RETENTION', 200))  # events per user/group room
+    EVENT_LOG_MAX_ROOMS = int(os.getenv('EVENT_LOG_MAX_ROOMS', 100000))
+    EVENT_LOG_TTL_S = int(os.getenv('EVENT_LOG_TTL_S', 3 * 86400))
+    # connect admission, see app/websocket/admission.py
+    CONNECT_RATE = int(os.getenv('CONNECT_RATE', 1000))  # new connections per second and worker
+    CONNECT_BURST = int(os.getenv('CONNECT_BURST', 2000))
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 50000))  # verified tokens kept per worker
+    USER_CACHE_TTL_S = int(os.getenv('USER_CACHE_TTL_S', 300))
+    # per-connection outbound queues, see app/websocket/outbound.py
+    OUTBOUND_QUEUE_SIZE = int(os.getenv('OUTBOUND_QUEUE_SIZE', 256))  # events per connection; a bigger replay is a resync
+    OUTBOUND_BURST = int(os.getenv('OUTBOUND_BURST', 32))  # events a connection is sent per interval
+    OUTBOUND_SLOW_S = int(os.getenv('OUTBOUND_SLOW_S', 10))  # disconnect a client that was backlogged this long
+    OUTBOUND_INTERVAL_MS = int(os.getenv('OUTBOUND_INTERVAL_MS', 50))
+    # streak expiry job, see app/services/streak_expiry.py (0 = off, run `flask expire-streaks` instead)
+    STREAK_EXPIRY_INTERVAL_S = int(os.getenv('STREAK_EXPIRY_INTERVAL_S', 900))
+    STREAK_EXPIRY_BATCH = int(os.getenv('STREAK_EXPIRY_BATCH', 500))  # contact rows per transaction
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # X-Metrics-Token for GET /metrics, unset = endpoint off
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))  # rows fetched per round trip by /exportChat
     
 class TestConfig(Config):
     TESTING = True
@@ -0,0 +1,113 @@
+"""
+In-process metrics.
+
+A small registry of counters, gauges and summaries (count/sum/min/max/last) that
+services record into and `/metrics` returns as JSON. Values live per process and
+start from zero on every restart.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._summaries = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self._summaries.get(name)
+            if summary is None:
+                self._summaries[name] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+                return
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+            summary["last"] = value
+
+    def snapshot(self):
+        with self._lock:
+            summaries = {
+                name: {**summary, "avg": summary["sum"] / summary["count"]}
+                for name, summary in self._summaries.items()
+            }
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges), "summaries": summaries}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+metrics = Metrics()
+
+
+##############################
+## QUERY COUNTING
+##############################
+
+_active_counters = threading.local()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.commits = 0
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements and commits the current thread issues inside the block.
+
+    Only the engine of an app set up with init_query_counting is counted.
+    """
+    counter = QueryCounter()
+    stack = getattr(_active_counters, "stack", None)
+    if stack is None:
+        stack = _active_counters.stack = []
+    stack.append(counter)
+    try:
+        yield counter
+    finally:
+        stack.remove(counter)
+
+
+def init_query_counting(app):
+    """Count statements and commits of the app's engine for count_queries()."""
+    with app.app_context():
+        from app import db
+        engine = db.engine
+    if not event.contains(engine, "before_cursor_execute", _count_statement):
+        event.listen(engine, "before_cursor_execute", _count_statement)
+        event.listen(engine, "commit", _count_commit)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    stack = getattr(_active_counters, "stack", None)
+    if not stack:
+        return
+    for counter in stack:
+        counter.count += 1
+
+
+def _count_commit(conn):
+    stack = getattr(_active_counters, "stack", None)
+    if not stack:
+        return
+    for counter in stack:
+        counter.commits += 1
@@ -0,0 +1,111 @@
+"""
+Versioned schema migrations.
+
+Every migration is a function registered in app.migrations.versions with a
+strictly increasing version number. Applied versions are recorded in the
+`schema_version` table, so `upgrade()` only runs what a database is missing.
+Migrations must be idempotent: a database created by `db.create_all()` already
+has the latest tables and indexes and is simply stamped.
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, insert, select
+
+from app import db
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration function `fn(connection)`."""
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def head_version():
+    _load_versions()
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version():
+    """Highest applied version, 0 for a database that was never migrated."""
+    with db.engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def upgrade(target=None):
+    """Apply all pending migrations up to `target` (default: head), each in its own transaction.
+
+    Returns:
+        list: (version, description) of the applied migrations
+    """
+    _load_versions()
+    target = head_version() if target is None else target
+    current = current_version()
+
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if current < version <= target:
+            with db.engine.begin() as conn:
+                fn(conn)
+                conn.execute(insert(schema_version).values(
+                    version=version, description=description, applied_at=datetime.utcnow()
+                ))
+            print(f"Applied migration {version}: {description}")
+            applied.append((version, description))
+    return applied
+
+
+def stamp_head():
+    """Mark a freshly created schema (db.create_all) as fully migrated."""
+    _load_versions()
+    with db.engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        applied = set(conn.execute(select(schema_version.c.version)).scalars())
+        for version, description, _ in MIGRATIONS:
+            if version not in applied:
+                conn.execute(insert(schema_version).values(
+                    version=version, description=description, applied_at=datetime.utcnow()
+                ))
+
+
+##############################
+## HELPER FUNCTIONS
+##############################
+
+def create_index_if_missing(conn, index):
+    index.create(conn, checkfirst=True)
+
+
+def add_column_if_missing(conn, table_name, column):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    columns = [c['name'] for c in inspect(conn).get_columns(table_name)]
+    if column.name in columns:
+        return
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f'ALTER TABLE "{table_name}" ADD COLUMN {column.name} {column_type}')
+
+
+def drop_column_if_exists(conn, table_name, column_name):
+    """ALTER TABLE ... DROP COLUMN if the column exists (SQLite 3.35+)."""
+    columns = [c['name'] for c in inspect(conn).get_columns(table_name)]
+    if column_name not in columns:
+        return
+    conn.exec_driver_sql(f'ALTER TABLE "{table_name}" DROP COLUMN {column_name}')
+
+
+def _load_versions():
+    # Imported lazily so the migration functions register themselves on first use
+    from app.migrations import versions  # noqa: F401
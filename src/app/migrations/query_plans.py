@@ -0,0 +1,93 @@
+"""
+EXPLAIN QUERY PLAN check for the service-layer hot queries.
+
+Every query the chat, message, streak and item paths run on each request is
+built through the same service helper the request uses and explained against
+the current database. Any full table scan of a hot table is reported.
+Only SQLite plans are understood; other dialects are skipped.
+"""
+from datetime import datetime
+
+from app import db
+from app.models.user import UserContact
+from app.models.message import Message
+
+HOT_TABLES = ("message", "message_read", "group_member", "user_contact", "active_items", "conversation")
+
+SAMPLE_USER = "00000000-0000-0000-0000-000000000001"
+SAMPLE_CONTACT = "00000000-0000-0000-0000-000000000002"
+SAMPLE_GROUP = "00000000-2222-0000-1111-000000000001"
+
+
+def hot_queries():
+    """(name, query) for every hot query, built by the services themselves."""
+    from app.services.chat_list_service import ChatListService
+    from app.services.conversation_service import ConversationService
+    from app.services.item_service import ItemService
+    from app.services.message_service import MessageService
+    from app.services.streak_service import StreakService
+
+    messages = MessageService()
+    chat_list = ChatListService()
+    now = datetime.utcnow()
+
+    queries = [
+        ("group page", messages.group_messages_query(SAMPLE_GROUP)
+            .order_by(Message.send_at.desc(), Message.message_id.desc()).limit(21)),
+        ("group page before cursor", messages.group_messages_query(SAMPLE_GROUP)
+            .filter(Message.send_at <= now)
+            .order_by(Message.send_at.desc(), Message.message_id.desc()).limit(21)),
+        ("direct page (legacy offset)", messages.contact_messages_query(SAMPLE_USER, SAMPLE_CONTACT)
+            .order_by(Message.send_at, Message.message_id).limit(20).offset(20)),
+        ("latest direct message", messages.latest_direct_message_query(SAMPLE_USER, SAMPLE_CONTACT).limit(1)),
+        ("unread count direct", messages.unread_count_query(SAMPLE_USER, SAMPLE_CONTACT)),
+        ("unread count group", messages.unread_count_query(SAMPLE_USER, SAMPLE_GROUP, is_group=True)),
+        ("group memberships", chat_list.memberships_query(SAMPLE_USER)),
+        ("reverse contacts", UserContact.query.filter(
+            UserContact.contact_id == SAMPLE_USER, UserContact.user_id.in_([SAMPLE_CONTACT]))),
+        ("active items", ItemService().active_items_query(SAMPLE_USER)),
+        ("conversations", ConversationService().conversations_query(SAMPLE_USER)),
+        ("streak pair", StreakService().pair_query(SAMPLE_USER, SAMPLE_CONTACT)),
+    ]
+    for i, part in enumerate(messages.contact_messages_parts(SAMPLE_USER, SAMPLE_CONTACT)):
+        queries.append((f"direct page part {i}", part
+                        .order_by(Message.send_at.desc(), Message.message_id.desc()).limit(21)))
+    return queries
+
+
+def explain(query):
+    """Return the EXPLAIN QUERY PLAN detail lines for an ORM query."""
+    statement = getattr(query, "statement", query)
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True})
+    params = compiled.construct_params()
+    positional = tuple(params[name] for name in compiled.positiontup)
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", positional).fetchall()
+    return [row[-1] for row in rows]
+
+
+def check_query_plans():
+    """
+    Explain every hot query and collect full table scans.
+
+    Returns:
+        dict: {"skipped": reason} for unsupported dialects, else {"failures": [(name, plan)], "plans": {...}}
+    """
+    if db.engine.dialect.name != "sqlite":
+        return {"skipped": f"query plan check only supports sqlite, not {db.engine.dialect.name}"}
+
+    failures = []
+    plans = {}
+    for name, query in hot_queries():
+        plan = explain(query)
+        plans[name] = plan
+        if any(_is_table_scan(line) for line in plan):
+            failures.append((name, plan))
+    return {"failures": failures, "plans": plans}
+
+
+def _is_table_scan(line):
+    # "SCAN message" / "SCAN TABLE message" (older SQLite) / "SCAN message USING INDEX ..." are full scans,
+    # "SEARCH message USING INDEX ..." is an index seek
+    words = line.replace("TABLE ", "").split()
+    return len(words) >= 2 and words[0] == "SCAN" and words[1] in HOT_TABLES
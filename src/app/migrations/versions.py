@@ -0,0 +1,334 @@
+"""
+The migrations, frozen at their version.
+
+Tables, indexes and backfills are spelled out here as they were when the
+migration was written, never taken from app.models or the services, so
+replaying an old version gives the same schema however the models change
+later. A migration that needs a table declares the columns it touches.
+"""
+from datetime import datetime, time
+
+from sqlalchemy import (
+    Boolean, Column, Date, DateTime, Enum, ForeignKey, Index, Integer, MetaData, PrimaryKeyConstraint, String, Table,
+    and_, case, delete, exists, func, insert, literal, or_, select, union_all, update
+)
+
+from app.migrations import migration, create_index_if_missing, add_column_if_missing, drop_column_if_exists
+
+##############################
+## SCHEMA AT VERSION 1
+##############################
+
+v1 = MetaData()
+
+v1_user = Table(
+    'user', v1,
+    Column('user_id', String, primary_key=True),
+    Column('username', String(25), unique=True, index=True, nullable=False),
+    Column('password', String, nullable=False),
+    Column('profile_picture', String),
+    Column('salt', String, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('session_id', String),
+    Column('public_key', String),
+    Column('encrypted_private_key', String),
+    Column('points', Integer),
+    Column('is_online', Boolean),
+)
+
+v1_user_contact = Table(
+    'user_contact', v1,
+    Column('user_id', String, ForeignKey('user.user_id'), primary_key=True),
+    Column('contact_id', String, ForeignKey('user.user_id'), primary_key=True),
+    Column('status', Enum('FRIEND', 'FFRIEND', 'UNFRIEND', 'PENDINGFRIEND', 'LASTWORDS', 'BLOCK', 'FBLOCKED',
+                          'UNBLOCK', 'NEW', 'TIMEOUT', 'NTCON', name='contactstatusenum'), nullable=False),
+    Column('time_out', DateTime),
+    Column('streak', Integer),
+    Column('continue_streak', Boolean),
+    Column('last_streak_update', Date),
+)
+
+v1_group = Table(
+    'group', v1,
+    Column('group_id', String, primary_key=True),
+    Column('group_name', String, nullable=False),
+    Column('admin_user_id', String, ForeignKey('user.user_id')),
+    Column('group_picture', String),
+    Column('created_at', DateTime, nullable=False),
+)
+
+v1_group_member = Table(
+    'group_member', v1,
+    Column('group_id', String, ForeignKey('group.group_id'), primary_key=True),
+    Column('user_id', String, ForeignKey('user.user_id'), primary_key=True),
+    Column('encrypted_g_private_key', String),
+    Column('joined_at', DateTime, nullable=False),
+    Column('role', Enum('ADMIN', 'MEMBER', 'GUEST', name='grouproleenum'), nullable=False),
+)
+
+v1_message = Table(
+    'message', v1,
+    Column('message_id', String, primary_key=True),
+    Column('sender_user_id', String, ForeignKey('user.user_id'), nullable=False),
+    Column('recipient_user_id', String, nullable=False),
+    Column('encrypted_content', String, nullable=False),
+    Column('type', Enum('TEXT', 'DELETED_TEXT', 'IMAGE', 'ITEM', 'LOCATION', 'AUDIO', 'VIDEO',
+                        name='messagetypeenum')),
+    Column('send_at', DateTime, nullable=False),
+    Column('updated_at', DateTime),
+    Column('is_group', Boolean),
+)
+
+Table(
+    'g_message_status', v1,
+    Column('message_id', String, ForeignKey('message.message_id'), primary_key=True),
+    Column('user_id', String, ForeignKey('user.user_id'), primary_key=True),
+)
+
+v1_message_read = Table(
+    'message_read', v1,
+    Column('message_id', String, ForeignKey('message.message_id', ondelete="CASCADE"), primary_key=True),
+    Column('reader_id', String, ForeignKey('user.user_id', ondelete="CASCADE"), primary_key=True),
+    Column('read_at', DateTime, nullable=False),
+)
+
+Table(
+    'items', v1,
+    Column('id', Integer, primary_key=True),
+    Column('name', String, unique=True, nullable=False),
+    Column('price', Integer, nullable=False),
+)
+
+v1_active_items = Table(
+    'active_items', v1,
+    Column('id', Integer, primary_key=True),
+    Column('item', String, nullable=False),
+    Column('user_id', String, ForeignKey('user.user_id'), nullable=False),
+    Column('send_by_user_id', String, ForeignKey('user.user_id'), nullable=False),
+    Column('active_until', DateTime, nullable=False),
+)
+
+Table(
+    'inventory', v1,
+    Column('item_id', Integer, ForeignKey('items.id'), nullable=False),
+    Column('user_id', String, ForeignKey('user.user_id'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    PrimaryKeyConstraint('item_id', 'user_id'),
+)
+
+v1_conversation = Table(
+    'conversation', v1,
+    Column('user_id', String, ForeignKey('user.user_id'), primary_key=True),
+    Column('chat_id', String, primary_key=True),
+    Column('is_group', Boolean, nullable=False),
+    Column('last_message_id', String, ForeignKey('message.message_id')),
+    Column('last_message_at', DateTime),
+    Column('last_sender_id', String),
+    Column('unread_count', Integer, nullable=False),
+    Column('version', Integer, nullable=False),
+)
+
+
+@migration(1, "initial schema")
+def create_missing_tables(conn):
+    v1.create_all(bind=conn)
+
+
+@migration(2, "hot path indexes for message, membership, contact and item tables")
+def add_hot_path_indexes(conn):
+    for index in (
+        Index('ix_message_sender_recipient_send_at', v1_message.c.sender_user_id, v1_message.c.recipient_user_id,
+              v1_message.c.send_at, v1_message.c.message_id),
+        Index('ix_message_recipient_group_send_at', v1_message.c.recipient_user_id, v1_message.c.is_group,
+              v1_message.c.send_at, v1_message.c.message_id),
+        Index('ix_message_read_reader_id', v1_message_read.c.reader_id, v1_message_read.c.message_id),
+        Index('ix_group_member_user_id', v1_group_member.c.user_id),
+        Index('ix_active_items_user_active_until', v1_active_items.c.user_id, v1_active_items.c.active_until),
+        Index('ix_user_contact_contact_id', v1_user_contact.c.contact_id),
+    ):
+        create_index_if_missing(conn, index)
+
+
+v3 = MetaData()
+
+v3_read_watermark = Table(
+    'read_watermark', v3,
+    Column('user_id', String, ForeignKey(v1_user.c.user_id, ondelete="CASCADE"), primary_key=True),
+    Column('chat_id', String, primary_key=True),
+    Column('read_up_to_at', DateTime, nullable=False),
+    Column('read_up_to_message_id', String, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+
+@migration(3, "read watermarks from message_read, receipts kept for group messages only")
+def read_watermarks_from_receipts(conn):
+    """
+    Every (reader, chat) gets a watermark at its newest receipted message, so older
+    messages without a receipt count as read from now on. Receipts of direct messages
+    are dropped afterwards; group receipts stay for the "read by" details.
+    Unread counters change with this, so the conversation rows are rebuilt from the
+    new watermarks in the same transaction.
+    """
+    message, receipt, watermark = v1_message, v1_message_read, v3_read_watermark
+    watermark.create(conn, checkfirst=True)
+
+    chat_id = case(
+        (message.c.is_group == True, message.c.recipient_user_id),
+        (message.c.recipient_user_id == receipt.c.reader_id, message.c.sender_user_id),
+        else_=message.c.recipient_user_id
+    )
+    ranked = select(
+        receipt.c.reader_id.label("user_id"),
+        chat_id.label("chat_id"),
+        message.c.send_at,
+        message.c.message_id,
+        func.row_number().over(
+            partition_by=(receipt.c.reader_id, chat_id),
+            order_by=(message.c.send_at.desc(), message.c.message_id.desc())
+        ).label("rn")
+    ).join(message, message.c.message_id == receipt.c.message_id).subquery()
+
+    latest = select(
+        ranked.c.user_id, ranked.c.chat_id, ranked.c.send_at, ranked.c.message_id, func.current_timestamp()
+    ).where(
+        ranked.c.rn == 1,
+        ~exists().where(and_(watermark.c.user_id == ranked.c.user_id, watermark.c.chat_id == ranked.c.chat_id))
+    )
+    conn.execute(insert(watermark).from_select([
+        watermark.c.user_id,
+        watermark.c.chat_id,
+        watermark.c.read_up_to_at,
+        watermark.c.read_up_to_message_id,
+        watermark.c.updated_at
+    ], latest))
+
+    conn.execute(delete(receipt).where(
+        receipt.c.message_id.in_(select(message.c.message_id).where(message.c.is_group == False))
+    ))
+
+    _rebuild_conversations_v3(conn)
+
+
+@migration(4, "streak state on user_contact: last message per direction, last counted time")
+def incremental_streak_columns(conn):
+    """
+    The send path keeps streaks from these columns instead of the message table.
+    last_sent_at starts at the newest direct message of the direction, streak_counted_at
+    at the start of the last streak update of a running streak.
+    """
+    add_column_if_missing(conn, 'user_contact', Column('last_sent_at', DateTime))
+    add_column_if_missing(conn, 'user_contact', Column('streak_counted_at', DateTime))
+    table = Table(
+        'user_contact', MetaData(),
+        Column('user_id', String), Column('contact_id', String), Column('streak', Integer),
+        Column('last_streak_update', Date), Column('last_sent_at', DateTime), Column('streak_counted_at', DateTime),
+    )
+    message = v1_message
+
+    newest = select(func.max(message.c.send_at)).where(
+        message.c.sender_user_id == table.c.user_id,
+        message.c.recipient_user_id == table.c.contact_id,
+        message.c.is_group == False
+    ).scalar_subquery()
+    conn.execute(update(table).where(table.c.last_sent_at.is_(None)).values(last_sent_at=newest))
+
+    days = conn.execute(select(table.c.last_streak_update).distinct().where(
+        table.c.streak > 0, table.c.last_streak_update.is_not(None), table.c.streak_counted_at.is_(None)
+    )).scalars().all()
+    for day in days:
+        conn.execute(update(table).where(
+            table.c.streak > 0, table.c.last_streak_update == day, table.c.streak_counted_at.is_(None)
+        ).values(streak_counted_at=datetime.combine(day, time.min)))
+
+
+@migration(5, "drop user.is_online, presence lives in the presence store")
+def drop_user_is_online(conn):
+    drop_column_if_exists(conn, 'user', 'is_online')
+
+
+##############################
+## HELPER FUNCTIONS
+##############################
+
+def _rebuild_conversations_v3(conn):
+    """ConversationService.rebuild_rows as of migration 3: conversation rows from messages and watermarks."""
+    message, member, watermark, conversation = v1_message, v1_group_member, v3_read_watermark, v1_conversation
+    conn.execute(delete(conversation))
+
+    columns = (message.c.message_id, message.c.send_at, message.c.sender_user_id.label("sender_id"))
+    owned = union_all(
+        select(
+            message.c.sender_user_id.label("user_id"),
+            message.c.recipient_user_id.label("chat_id"),
+            literal(False).label("is_group"),
+            *columns
+        ).where(message.c.is_group == False),
+        select(
+            message.c.recipient_user_id.label("user_id"),
+            message.c.sender_user_id.label("chat_id"),
+            literal(False).label("is_group"),
+            *columns
+        ).where(message.c.is_group == False, message.c.recipient_user_id != message.c.sender_user_id),
+        select(
+            member.c.user_id.label("user_id"),
+            message.c.recipient_user_id.label("chat_id"),
+            literal(True).label("is_group"),
+            *columns
+        ).join(member, member.c.group_id == message.c.recipient_user_id)
+        .where(message.c.is_group == True)
+    ).subquery()
+
+    ranked = select(
+        owned,
+        func.row_number().over(
+            partition_by=(owned.c.user_id, owned.c.chat_id),
+            order_by=(owned.c.send_at.desc(), owned.c.message_id.desc())
+        ).label("rn")
+    ).subquery()
+
+    unread = select(
+        owned.c.user_id,
+        owned.c.chat_id,
+        func.count().label("unread_count")
+    ).select_from(
+        owned.outerjoin(watermark, and_(
+            watermark.c.user_id == owned.c.user_id,
+            watermark.c.chat_id == owned.c.chat_id
+        ))
+    ).where(
+        owned.c.sender_id != owned.c.user_id,
+        or_(
+            watermark.c.user_id.is_(None),
+            owned.c.send_at > watermark.c.read_up_to_at,
+            and_(owned.c.send_at == watermark.c.read_up_to_at,
+                 owned.c.message_id > watermark.c.read_up_to_message_id)
+        )
+    ).group_by(owned.c.user_id, owned.c.chat_id).subquery()
+
+    latest = select(
+        ranked.c.user_id,
+        ranked.c.chat_id,
+        ranked.c.is_group,
+        ranked.c.message_id,
+        ranked.c.send_at,
+        ranked.c.sender_id,
+        func.coalesce(unread.c.unread_count, 0),
+        literal(1)
+    ).select_from(
+        ranked.outerjoin(unread, and_(
+            unread.c.user_id == ranked.c.user_id,
+            unread.c.chat_id == ranked.c.chat_id
+        ))
+    ).where(ranked.c.rn == 1)
+
+    conn.execute(insert(conversation).from_select([
+        conversation.c.user_id,
+        conversation.c.chat_id,
+        conversation.c.is_group,
+        conversation.c.last_message_id,
+        conversation.c.last_message_at,
+        conversation.c.last_sender_id,
+        conversation.c.unread_count,
+        conversation.c.version
+    ], latest))
@@ -1,5 +1,6 @@
 from app import db
 from app.models.user import User, UserContact, ContactStatusEnum
-from app.models.message import Message, MessageTypeEnum
+from app.models.message import Message, MessageTypeEnum, ReadWatermark
 from app.models.group import Group, GroupMember, GroupRoleEnum
 from app.models.items import Item, ActiveItems, Inventory
+from app.models.conversation import Conversation
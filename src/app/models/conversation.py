@@ -0,0 +1,31 @@
+from sqlalchemy import Column, String, ForeignKey, DateTime, Boolean, Integer
+from app import db
+
+
+class Conversation(db.Model):
+    """Denormalized inbox row, one per (user, chat).
+
+    Maintained by MessageService on every message write/delete/read and
+    rebuildable from the message tables with ConversationService.rebuild().
+    """
+    __tablename__ = 'conversation'
+
+    user_id = Column(String, ForeignKey('user.user_id'), primary_key=True)
+    chat_id = Column(String, primary_key=True)  # contact user_id or group_id
+    is_group = Column(Boolean, nullable=False, default=False)
+    last_message_id = Column(String, ForeignKey('message.message_id'))
+    last_message_at = Column(DateTime)
+    last_sender_id = Column(String)
+    unread_count = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'chat_id': self.chat_id,
+            'is_group': self.is_group,
+            'last_message_id': self.last_message_id,
+            'last_message_at': self.last_message_at.isoformat() if self.last_message_at else None,
+            'last_sender_id': self.last_sender_id,
+            'unread_count': self.unread_count,
+            'version': self.version
+        }
@@ -40,6 +40,10 @@ class GroupMember(db.Model):
     joined_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     role = db.Column(Enum(GroupRoleEnum), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_group_member_user_id', 'user_id'),
+    )
+
     group = db.relationship('Group', backref='members')
     user = db.relationship('User', backref='group_memberships')
     
@@ -29,6 +29,10 @@ class ActiveItems(db.Model):
     send_by_user_id = db.Column(db.String, db.ForeignKey('user.user_id'), nullable=False)
     active_until = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_active_items_user_active_until', 'user_id', 'active_until'),
+    )
+
     def to_dict(self):
         return {
             'item_name': self.item,
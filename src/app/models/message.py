@@ -1,7 +1,7 @@
 import enum
 import uuid
 from datetime import datetime
-from sqlalchemy import Enum, Column, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import Enum, Column, String, ForeignKey, DateTime, Boolean, Index
 from sqlalchemy.orm import relationship
 from app import db
 
@@ -26,6 +26,13 @@ class Message(db.Model):
     updated_at = Column(DateTime, onupdate=datetime.utcnow)
     is_group = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # direct chats, streaks and last-message lookups: (sender, recipient) ordered by time
+        Index('ix_message_sender_recipient_send_at', 'sender_user_id', 'recipient_user_id', 'send_at', 'message_id'),
+        # group chats and unread counts: (recipient, is_group) ordered by time
+        Index('ix_message_recipient_group_send_at', 'recipient_user_id', 'is_group', 'send_at', 'message_id'),
+    )
+
     sender = relationship('User', foreign_keys=[sender_user_id], backref='messages_sent')
     
     # Remove the problematic recipient relationship that has no proper foreign key
@@ -53,12 +60,19 @@ class GMessageStatus(db.Model):
     user = relationship('User', backref='message_statuses')
 
 class MessageRead(db.Model):
-    """Tracks which users have read which messages."""
+    """Tracks which users have read which group messages ("read by" details).
+
+    Read state itself lives in ReadWatermark; direct messages get no receipts.
+    """
     __tablename__ = 'message_read'
     
     message_id = Column(String, ForeignKey('message.message_id', ondelete="CASCADE"), primary_key=True)
     reader_id = Column(String, ForeignKey('user.user_id', ondelete="CASCADE"), primary_key=True)
     read_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_message_read_reader_id', 'reader_id', 'message_id'),
+    )
     
     # Relationships
     message = relationship("Message", back_populates="read_receipts")
@@ -66,3 +80,16 @@ class MessageRead(db.Model):
     
     def __repr__(self):
         return f"<MessageRead message={self.message_id} reader={self.reader_id}>"
+
+class ReadWatermark(db.Model):
+    """How far a user has read a chat: every message at or before this (send_at, message_id) position is read."""
+    __tablename__ = 'read_watermark'
+
+    user_id = Column(String, ForeignKey('user.user_id', ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(String, primary_key=True)  # contact user_id or group_id
+    read_up_to_at = Column(DateTime, nullable=False)
+    read_up_to_message_id = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ReadWatermark user={self.user_id} chat={self.chat_id} up_to={self.read_up_to_message_id}>"
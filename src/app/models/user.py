@@ -30,15 +30,13 @@ class User(db.Model):
     public_key = db.Column(db.String)
     encrypted_private_key = db.Column(db.String)
     points = db.Column(db.Integer, default=0)
-    is_online = db.Column(db.Boolean, default=False)
 
     def to_dict(self):
         return {
             'user_id': self.user_id,
             'username': self.username,
             'profile_picture': self.profile_picture,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'is_online': self.is_online
+            'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 class UserContact(db.Model):
@@ -51,6 +49,13 @@ class UserContact(db.Model):
     streak = db.Column(db.Integer, default=0)
     continue_streak = db.Column(db.Boolean, default=True)
     last_streak_update = db.Column(db.Date)
+    last_sent_at = db.Column(db.DateTime)       # last direct message of user_id to contact_id
+    streak_counted_at = db.Column(db.DateTime)  # last time the streak was counted (once per day)
+
+    __table_args__ = (
+        # reverse lookups: "who has this user as a contact"
+        db.Index('ix_user_contact_contact_id', 'contact_id'),
+    )
     
     user = db.relationship('User', foreign_keys=[user_id], backref='contacts')
     contact = db.relationship('User', foreign_keys=[contact_id])
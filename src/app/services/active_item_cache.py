@@ -0,0 +1,68 @@
+"""
+In-process cache of the items active on a user (timeout, flashbang, ...).
+
+Loaded from the database on a miss, updated by use_item and evicted exactly at
+`active_until` through a heap of expiry times. Other workers drop their entry
+of a user through the invalidation bus ("active_items" channel).
+
+A load that started before an invalidation of the user (e.g. use_item
+committing meanwhile) is not stored (see versioned_lru.py), so a stale set is
+never served.
+"""
+import heapq
+import threading
+
+from app.services.versioned_lru import VersionedLRU
+
+
+class ActiveItemCache:
+    def __init__(self, max_users=100000):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._effects = VersionedLRU(max_users)  # user_id → {item_name: active_until}
+        self._expiry = []                        # heap of (active_until, user_id, item_name)
+
+    def get(self, user_id, now, loader):
+        """The active items of a user as {item_name: active_until}. loader() reads them on a miss."""
+        with self._lock:
+            self._expire(now)
+            effects = self._effects.get(user_id)
+            if effects is not None:
+                return dict(effects)
+            stamp = self._effects.stamp(user_id)
+
+        loaded = {item_name: active_until for item_name, active_until in loader() if active_until > now}
+        with self._lock:
+            self._store(user_id, loaded, stamp)
+        return dict(loaded)
+
+    def invalidate(self, user_id=None):
+        """Forget a user, or everybody for None."""
+        with self._lock:
+            self._effects.invalidate(user_id)
+            if user_id is None:
+                self._expiry.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._effects)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _store(self, user_id, effects, stamp):
+        if self._effects.store(user_id, effects, stamp):
+            for item_name, active_until in effects.items():
+                heapq.heappush(self._expiry, (active_until, user_id, item_name))
+
+    def _expire(self, now):
+        # heap entries of forgotten users or replaced items are skipped
+        while self._expiry and self._expiry[0][0] <= now:
+            active_until, user_id, item_name = heapq.heappop(self._expiry)
+            effects = self._effects.peek(user_id)
+            if effects is not None and effects.get(item_name) == active_until:
+                del effects[item_name]
+
+
+active_item_cache = ActiveItemCache()
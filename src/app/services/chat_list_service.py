@@ -0,0 +1,101 @@
+from app import db
+from app.models.user import UserContact
+from app.models.group import Group, GroupMember, GroupRoleEnum
+from app.services.user_service import UserService
+from app.services.conversation_service import ConversationService, DEFAULT_LAST_MESSAGE_TIMESTAMP
+from app.services.presence_store import get_presence_store
+
+
+class ChatListService:
+    """Builds the /getChats response from a fixed number of set-based queries.
+
+    Instead of resolving every contact, group and last message one by one, the
+    chat list is assembled from:
+      1. the user lookup,
+      2. the user's contacts,
+      3. groups joined to the user's membership/role,
+      4. all members of those groups,
+      5. last message timestamps from the user's conversation rows,
+    plus one query for the profile cards (names, pictures) of contacts and
+    members that are not in the profile card cache yet.
+
+    It never writes: broken streaks are reset by the StreakService expiry job.
+    """
+
+    def __init__(self):
+        self.user_service = UserService()
+        self.conversation_service = ConversationService()
+
+    def get_chats(self, user_id):
+        user = self.user_service.get_user_by_id(user_id)
+        if not user:
+            return {"error": "User not found"}
+
+        try:
+            contacts = UserContact.query.filter(UserContact.user_id == user_id).all()
+            memberships = self.memberships_query(user_id).all()
+            member_rows = self._member_rows(memberships)
+            cards = self.user_service.get_profile_cards(
+                [contact.contact_id for contact in contacts] + [member_id for _, member_id, _ in member_rows]
+            )
+            chats = self._build_contacts(contacts, cards) + self._build_groups(memberships, member_rows, cards)
+
+            last_messages = self.conversation_service.get_last_message_dates(user_id)
+            for chat in chats:
+                last_message_date = last_messages.get(chat["contact_id"])
+                chat["last_message_timestamp"] = (
+                    last_message_date.isoformat() if last_message_date else DEFAULT_LAST_MESSAGE_TIMESTAMP
+                )
+            return chats
+        except Exception as e:
+            return {"error": f"Database error: {str(e)}"}
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _build_contacts(self, contacts, cards):
+        contacts = [contact for contact in contacts if contact.contact_id in cards]
+        online = get_presence_store().online([contact.contact_id for contact in contacts])
+
+        return [{
+            "is_group": False,
+            "contact_id": contact.contact_id,
+            "name": cards[contact.contact_id].username,
+            "picture_url": cards[contact.contact_id].profile_picture,
+            "status": contact.status.value,
+            "streak": contact.streak,
+            "is_online": contact.contact_id in online,
+        } for contact in contacts]
+
+    def _member_rows(self, memberships):
+        """(group_id, user_id, role) of every member of the given groups."""
+        if not memberships:
+            return []
+        return db.session.query(GroupMember.group_id, GroupMember.user_id, GroupMember.role) \
+            .filter(GroupMember.group_id.in_([group.group_id for group, _ in memberships])) \
+            .all()
+
+    def _build_groups(self, memberships, member_rows, cards):
+        members_by_group = {group.group_id: [] for group, _ in memberships}
+        for group_id, member_id, role in member_rows:
+            card = cards.get(member_id)
+            if card:
+                members_by_group[group_id].append({
+                    "contact_id": member_id,
+                    "name": card.username,
+                    "picture_url": card.profile_picture,
+                    "role": role.value
+                })
+
+        return [{
+            **group.to_dict(),
+            "am_admin": role == GroupRoleEnum.ADMIN,
+            "members": members_by_group[group.group_id]
+        } for group, role in memberships]
+
+    def memberships_query(self, user_id):
+        """(Group, role) rows for every group the user is a member of."""
+        return db.session.query(Group, GroupMember.role) \
+            .join(GroupMember, GroupMember.group_id == Group.group_id) \
+            .filter(GroupMember.user_id == user_id)
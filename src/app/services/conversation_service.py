@@ -0,0 +1,202 @@
+from sqlalchemy import and_, case, delete, func, insert, literal, or_, select, tuple_, union_all
+
+from app import db
+from app.models.conversation import Conversation
+from app.models.group import GroupMember
+from app.models.message import Message, ReadWatermark
+from app.services.group_service import GroupService
+
+DEFAULT_LAST_MESSAGE_TIMESTAMP = "2001-09-11T12:46:00Z"
+
+
+class ConversationService:
+    """Maintains the per-user conversation (inbox) read model.
+
+    The record_* methods never commit; they are called by MessageService
+    inside the transaction of the message write they belong to.
+    """
+
+    def record_message(self, message):
+        """Point every owner's conversation row at the new message and bump unread counts."""
+        owners = self._owners(message)
+        if not owners:
+            return
+
+        db.session.query(Conversation).filter(
+            tuple_(Conversation.user_id, Conversation.chat_id).in_(owners)
+        ).update({
+            Conversation.last_message_id: message.message_id,
+            Conversation.last_message_at: message.send_at,
+            Conversation.last_sender_id: message.sender_user_id,
+            Conversation.unread_count: Conversation.unread_count + case(
+                (Conversation.user_id == message.sender_user_id, 0), else_=1
+            ),
+            Conversation.version: Conversation.version + 1
+        }, synchronize_session=False)
+
+        existing = set(db.session.query(Conversation.user_id, Conversation.chat_id).filter(
+            tuple_(Conversation.user_id, Conversation.chat_id).in_(owners)
+        ).all())
+        missing = [{
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "is_group": bool(message.is_group),
+            "last_message_id": message.message_id,
+            "last_message_at": message.send_at,
+            "last_sender_id": message.sender_user_id,
+            "unread_count": 0 if user_id == message.sender_user_id else 1,
+            "version": 1
+        } for user_id, chat_id in owners if (user_id, chat_id) not in existing]
+        if missing:
+            db.session.execute(insert(Conversation), missing)
+
+    def record_delete(self, message):
+        """Bump the version of every conversation the deleted message belongs to."""
+        owners = self._owners(message)
+        if not owners:
+            return
+
+        db.session.query(Conversation).filter(
+            tuple_(Conversation.user_id, Conversation.chat_id).in_(owners)
+        ).update({Conversation.version: Conversation.version + 1}, synchronize_session=False)
+
+    def record_read(self, reader_id, chat_id, unread_count):
+        """Store the reader's unread count for a chat after their read watermark moved."""
+        db.session.query(Conversation).filter(
+            Conversation.user_id == reader_id,
+            Conversation.chat_id == chat_id
+        ).update({
+            Conversation.unread_count: unread_count,
+            Conversation.version: Conversation.version + 1
+        }, synchronize_session=False)
+
+    def get_conversation(self, user_id, chat_id):
+        return db.session.get(Conversation, (user_id, chat_id))
+
+    def get_last_message_dates(self, user_id):
+        """Return {chat_id: last_message_at} for all conversations of a user."""
+        rows = self.conversations_query(user_id) \
+            .with_entities(Conversation.chat_id, Conversation.last_message_at) \
+            .all()
+        return dict(rows)
+
+    def conversations_query(self, user_id):
+        return Conversation.query.filter(Conversation.user_id == user_id)
+
+    def rebuild(self):
+        """Rebuild the whole table from `message` and `read_watermark` in bulk.
+
+        Returns:
+            dict: number of conversation rows written
+        """
+        try:
+            rows = self.rebuild_rows(db.session)
+            db.session.commit()
+            return {"success": True, "rows": rows}
+        except Exception as e:
+            db.session.rollback()
+            return {"error": f"Database error: {str(e)}"}
+
+    def rebuild_rows(self, executor):
+        """Replace every conversation row with the rebuild, on `executor` (a session or
+        connection). Does not commit.
+
+        Returns:
+            int: number of conversation rows written
+        """
+        executor.execute(delete(Conversation))
+
+        owned = self._owned_messages_query().subquery()
+        ranked = select(
+            owned,
+            func.row_number().over(
+                partition_by=(owned.c.user_id, owned.c.chat_id),
+                order_by=(owned.c.send_at.desc(), owned.c.message_id.desc())
+            ).label("rn")
+        ).subquery()
+
+        unread = select(
+            owned.c.user_id,
+            owned.c.chat_id,
+            func.count().label("unread_count")
+        ).select_from(
+            owned.outerjoin(ReadWatermark, and_(
+                ReadWatermark.user_id == owned.c.user_id,
+                ReadWatermark.chat_id == owned.c.chat_id
+            ))
+        ).where(
+            owned.c.sender_id != owned.c.user_id,
+            or_(
+                ReadWatermark.user_id.is_(None),
+                owned.c.send_at > ReadWatermark.read_up_to_at,
+                and_(owned.c.send_at == ReadWatermark.read_up_to_at,
+                     owned.c.message_id > ReadWatermark.read_up_to_message_id)
+            )
+        ).group_by(owned.c.user_id, owned.c.chat_id).subquery()
+
+        latest = select(
+            ranked.c.user_id,
+            ranked.c.chat_id,
+            ranked.c.is_group,
+            ranked.c.message_id,
+            ranked.c.send_at,
+            ranked.c.sender_id,
+            func.coalesce(unread.c.unread_count, 0),
+            literal(1)
+        ).select_from(
+            ranked.outerjoin(unread, and_(
+                unread.c.user_id == ranked.c.user_id,
+                unread.c.chat_id == ranked.c.chat_id
+            ))
+        ).where(ranked.c.rn == 1)
+
+        return executor.execute(insert(Conversation).from_select([
+            Conversation.user_id,
+            Conversation.chat_id,
+            Conversation.is_group,
+            Conversation.last_message_id,
+            Conversation.last_message_at,
+            Conversation.last_sender_id,
+            Conversation.unread_count,
+            Conversation.version
+        ], latest)).rowcount
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _owners(self, message):
+        """(user_id, chat_id) keys of all conversations a message shows up in."""
+        if message.is_group:
+            member_ids = GroupService().get_member_ids(message.recipient_user_id)
+            return [(member_id, message.recipient_user_id) for member_id in member_ids]
+
+        owners = [(message.sender_user_id, message.recipient_user_id)]
+        if message.recipient_user_id != message.sender_user_id:
+            owners.append((message.recipient_user_id, message.sender_user_id))
+        return owners
+
+    def _owned_messages_query(self):
+        """Every message once per conversation owner: both sides of a direct chat and every group member."""
+        columns = (Message.message_id, Message.send_at, Message.sender_user_id.label("sender_id"))
+        return union_all(
+            select(
+                Message.sender_user_id.label("user_id"),
+                Message.recipient_user_id.label("chat_id"),
+                literal(False).label("is_group"),
+                *columns
+            ).where(Message.is_group == False),
+            select(
+                Message.recipient_user_id.label("user_id"),
+                Message.sender_user_id.label("chat_id"),
+                literal(False).label("is_group"),
+                *columns
+            ).where(Message.is_group == False, Message.recipient_user_id != Message.sender_user_id),
+            select(
+                GroupMember.user_id.label("user_id"),
+                Message.recipient_user_id.label("chat_id"),
+                literal(True).label("is_group"),
+                *columns
+            ).join(GroupMember, GroupMember.group_id == Message.recipient_user_id)
+            .where(Message.is_group == True)
+        )
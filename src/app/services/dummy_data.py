@@ -35,7 +35,6 @@ def insert_example_data():
         session_id=SESSION_UUID1,
         public_key="public_key_user1",
         encrypted_private_key="encrypted_private_key_user1",
-        is_online=True,
         points=20
     )
 
@@ -49,7 +48,6 @@ def insert_example_data():
         session_id=SESSION_UUID2,
         public_key="public_key_user2",
         encrypted_private_key="encrypted_private_key_user2",
-        is_online=False,
         points=20
     )
 
@@ -64,7 +62,6 @@ def insert_example_data():
         session_id=SESSION_UUID3,
         public_key="public_key_user3",
         encrypted_private_key="encrypted_private_key_user3",
-        is_online=True,
         points=20
     )
 
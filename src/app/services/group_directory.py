@@ -0,0 +1,70 @@
+"""
+In-process directory of the groups: existence, members and their roles.
+
+GroupService answers does_group_exist, is_id_group, is_user_member and
+is_user_admin from here instead of one query each. A group is loaded on the
+first miss (one query for the group and its members) and kept until a
+GroupService mutator invalidates it after its commit. Ids that are no group
+(contact ids passed to is_id_group) are remembered in a small separate cache
+for missing_ttl seconds only, so a group created meanwhile is found even if its
+invalidation never arrived.
+
+A load that started before an invalidation of the group is not stored (see
+versioned_lru.py), so a stale member list is never served. Other workers drop their entry through the
+invalidation bus ("groups" channel).
+
+Counters: group_directory.hits, group_directory.misses.
+"""
+import threading
+import time
+
+from app.metrics import metrics
+from app.services.versioned_lru import VersionedLRU
+
+
+class GroupDirectory:
+    def __init__(self, max_groups=100000, max_missing=10000, missing_ttl=5.0, clock=time.monotonic):
+        self.max_groups = max_groups
+        self.missing_ttl = missing_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._groups = VersionedLRU(max_groups)    # group_id → {user_id: role}
+        self._missing = VersionedLRU(max_missing)  # id that is no group → until when that is believed
+
+    def members(self, group_id, loader):
+        """
+        {user_id: GroupRoleEnum} of a group, None if there is no such group.
+        loader(group_id) reads the same from the database on a miss.
+        """
+        with self._lock:
+            entry = self._groups.get(group_id)
+            if entry is not None:
+                metrics.incr("group_directory.hits")
+                return entry
+            missing_until = self._missing.peek(group_id)
+            if missing_until is not None and missing_until > self.clock():
+                metrics.incr("group_directory.hits")
+                return None
+            stamps = self._groups.stamp(group_id), self._missing.stamp(group_id)
+
+        metrics.incr("group_directory.misses")
+        loaded = loader(group_id)
+        with self._lock:
+            if loaded is not None:
+                self._groups.store(group_id, loaded, stamps[0])
+            else:
+                self._missing.store(group_id, self.clock() + self.missing_ttl, stamps[1])
+        return loaded
+
+    def invalidate(self, group_id=None):
+        """Forget a group, or every group for None."""
+        with self._lock:
+            self._groups.invalidate(group_id)
+            self._missing.invalidate(group_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._groups)
+
+
+group_directory = GroupDirectory()
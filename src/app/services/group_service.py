@@ -2,7 +2,12 @@ import uuid
 from datetime import datetime
 from app import db
 from app.models.group import Group, GroupMember, GroupRoleEnum
+from app.services.group_directory import group_directory
+from app.services.invalidation import invalidation_bus
+from app.services.user_service import UserService
 
+GROUPS_CHANNEL = "groups"  # a group, its members or their roles changed
+invalidation_bus.subscribe(GROUPS_CHANNEL, group_directory.invalidate)
 
 class GroupService:
     def create_group(self, user_id, group_name, group_pic, group_members):
@@ -42,6 +47,7 @@ class GroupService:
         db.session.add(new_member)
         try:
             db.session.commit()
+            self._group_changed(new_group.group_id)
             return {
                 "group": new_group,
                 "members": self.get_group_members(new_group.group_id),
@@ -62,6 +68,7 @@ class GroupService:
         db.session.delete(group)
         try:
             db.session.commit()
+            self._group_changed(group_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
@@ -79,6 +86,7 @@ class GroupService:
         db.session.add(new_member)
         try:
             db.session.commit()
+            self._group_changed(group_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
@@ -94,6 +102,7 @@ class GroupService:
         db.session.delete(member)
         try:
             db.session.commit()
+            self._group_changed(group_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
@@ -152,6 +161,7 @@ class GroupService:
             member.role = GroupRoleEnum.MEMBER
         try:
             db.session.commit()
+            self._group_changed(group_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
@@ -167,6 +177,7 @@ class GroupService:
         db.session.delete(member)
         try:
             db.session.commit()
+            self._group_changed(group_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
@@ -177,34 +188,31 @@ class GroupService:
     ##############################
 
     def is_user_admin(self, user_id, group_id):
-        group_member = GroupMember.query.filter_by(user_id=user_id, group_id=group_id).first()
-        if group_member and group_member.role == GroupRoleEnum.ADMIN:
-            return True
-        return False
+        members = self._members(group_id)
+        return members is not None and members.get(user_id) == GroupRoleEnum.ADMIN
 
     def is_user_member(self, user_id, group_id):
-        group_member = GroupMember.query.filter_by(user_id=user_id, group_id=group_id).first()
-        if group_member:
-            return True
-        return False
+        members = self._members(group_id)
+        return members is not None and user_id in members
 
     def does_group_exist(self, group_id):
-        group = Group.query.filter_by(group_id=group_id).first()
-        return group is not None
+        return self._members(group_id) is not None
 
     def get_group_members(self, group_id):
         if not self.does_group_exist(group_id): return {"error": "Group not found"}
 
-        members = GroupMember.query.filter_by(group_id=group_id).all()
+        members = db.session.query(GroupMember.user_id, GroupMember.role).filter_by(group_id=group_id).all()
+        cards = UserService().get_profile_cards([user_id for user_id, _ in members])
         result = []
-        for member in members:
-            user = member.user
-            result.append({
-                "contact_id": member.user_id,
-                "name": user.username,
-                "picture_url": user.profile_picture,
-                "role": member.role.value
-            })
+        for user_id, role in members:
+            card = cards.get(user_id)
+            if card:
+                result.append({
+                    "contact_id": user_id,
+                    "name": card.username,
+                    "picture_url": card.profile_picture,
+                    "role": role.value
+                })
 
         return result
 
@@ -225,8 +233,31 @@ class GroupService:
             "members": self.get_group_members(group.group_id)
         } for group in groups]
 
-    def is_id_group(self, group_id):
-        group = Group.query.filter_by(group_id=group_id).first()
-        if not group: return False
+    def get_member_ids(self, group_id):
+        return list(self._members(group_id) or ())
 
-        return True
+    def get_group_ids_by_user_id(self, user_id):
+        return [group_id for (group_id,) in
+                db.session.query(GroupMember.group_id).filter(GroupMember.user_id == user_id).all()]
+
+    def is_id_group(self, group_id):
+        return self.does_group_exist(group_id)
+
+    def _members(self, group_id):
+        """{user_id: role} of a group from the group directory, None if there is no such group."""
+        if not group_id:
+            return None
+        return group_directory.members(group_id, self._load_members)
+
+    def _load_members(self, group_id):
+        rows = db.session.query(Group.group_id, GroupMember.user_id, GroupMember.role) \
+            .outerjoin(GroupMember, GroupMember.group_id == Group.group_id) \
+            .filter(Group.group_id == group_id) \
+            .all()
+        if not rows:
+            return None
+        return {user_id: role for _, user_id, role in rows if user_id is not None}
+
+    def _group_changed(self, group_id):
+        # after the commit, so a reload can't see the old rows
+        invalidation_bus.publish(GROUPS_CHANNEL, group_id)
@@ -0,0 +1,126 @@
+"""
+Cache invalidation between workers.
+
+In-process caches subscribe to a channel and drop the entry of a key when it is
+published. Without a shared backend only the caches of this process are reached.
+With INVALIDATION_BUS_URL (or SOCKETIO_MESSAGE_QUEUE) the keys are also sent to
+every other worker, over Redis pub/sub or the local broker of local:// URLs
+(app/websocket/local_queue.py). Several workers without a bus would serve stale
+entries, e.g. memberships in is_user_member, so create_app refuses to start then.
+"""
+import json
+import threading
+import uuid
+from collections import defaultdict
+
+
+class InvalidationBus:
+    def __init__(self):
+        self.origin = uuid.uuid4().hex  # messages of this process are not handled twice
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(list)
+        self._remote = None  # sends a message to the other workers
+
+    def subscribe(self, channel, callback):
+        """callback(key) is called for every key published on the channel, key None means everything"""
+        with self._lock:
+            self._subscribers[channel].append(callback)
+
+    def publish(self, channel, key=None):
+        self.dispatch(channel, key)
+        if self._remote is not None:
+            try:
+                self._remote({"origin": self.origin, "channel": channel, "key": key})
+            except Exception as e:
+                print(f"Invalidation of {channel}:{key} could not be published: {e}")
+
+    def dispatch(self, channel, key=None):
+        """Hand a key to the subscribers in this process."""
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(key)
+            except Exception as e:
+                print(f"Invalidation callback for {channel} failed: {e}")
+
+    def connect(self, url, remote_channel="umoc:invalidate", key=None):
+        """Also reach the other workers, over Redis pub/sub or the local broker (key is its LOCAL_QUEUE_KEY)."""
+        if self._remote is not None:
+            return
+        if url.startswith("local://"):
+            self._connect_local(url, remote_channel, key)
+        else:
+            self._connect_redis(url, remote_channel)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _connect_redis(self, url, remote_channel):
+        import redis
+
+        client = redis.Redis.from_url(url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(remote_channel)
+        self._remote = lambda data: client.publish(remote_channel, json.dumps(data))
+
+        def messages():
+            for message in pubsub.listen():
+                try:
+                    yield json.loads(message["data"])
+                except (TypeError, ValueError):
+                    continue
+
+        self._start_listener(messages())
+
+    def _connect_local(self, url, remote_channel, key):
+        from app.websocket import local_queue
+
+        address = local_queue.parse_url(url)
+        subscriber = local_queue.connect(address, key, "subscribe", remote_channel)
+        publisher = local_queue.connect(address, key, "publish", remote_channel)
+        publish_lock = threading.Lock()
+
+        def remote(data):
+            nonlocal publisher
+            with publish_lock:
+                try:
+                    local_queue.send_frame(publisher, data)
+                except OSError:
+                    # broker restarted, retry once
+                    publisher = local_queue.connect(address, key, "publish", remote_channel)
+                    local_queue.send_frame(publisher, data)
+
+        def messages():
+            while True:
+                yield local_queue.recv_frame(subscriber)
+
+        self._remote = remote
+        self._start_listener(messages())
+
+    def _start_listener(self, messages):
+        threading.Thread(target=self._listen, args=(messages,), name="invalidation-bus", daemon=True).start()
+
+    def _listen(self, messages):
+        try:
+            for data in messages:
+                if isinstance(data, dict) and data.get("origin") != self.origin:
+                    self.dispatch(data.get("channel"), data.get("key"))
+        except (EOFError, OSError) as e:
+            print(f"Invalidation bus disconnected: {e}")
+
+
+invalidation_bus = InvalidationBus()
+
+
+def init_invalidation_bus(app):
+    url = app.config.get("INVALIDATION_BUS_URL") or app.config.get("SOCKETIO_MESSAGE_QUEUE")
+    if not url:
+        return  # one worker, the caches of this process are all there is
+    if not url.startswith(("redis://", "rediss://", "unix://", "local://")):
+        raise RuntimeError(
+            f"No invalidation bus for {url}: set INVALIDATION_BUS_URL to a redis:// or local:// URL, "
+            "the caches of several workers can't be kept coherent without it"
+        )
+    invalidation_bus.connect(url, key=app.config.get("LOCAL_QUEUE_KEY"))
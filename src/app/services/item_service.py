@@ -1,8 +1,13 @@
 from datetime import datetime, timedelta
 from app import db
 from app.models.items import Item, ActiveItems, Inventory
+from app.services.active_item_cache import active_item_cache
+from app.services.invalidation import invalidation_bus
 from app.services.user_service import UserService
 
+ACTIVE_ITEMS_CHANNEL = "active_items"
+invalidation_bus.subscribe(ACTIVE_ITEMS_CHANNEL, active_item_cache.invalidate)
+
 
 class ItemService:
 
@@ -72,11 +77,15 @@ class ItemService:
 
         try:
             db.session.commit()
-            return {"success": True}, datetime.utcnow() + timedelta(hours=2) + timedelta(minutes=1)
         except Exception as e:
             db.session.rollback()
             return {"error": f"Database error: {str(e)}"}, None
 
+        # other workers reload the user's items, this one knows them already
+        invalidation_bus.publish(ACTIVE_ITEMS_CHANNEL, to_user_id)
+        self.get_active_until(to_user_id)
+        return {"success": True}, active_item.active_until
+
     def get_item_list(self):
         """Get list of all items"""
         items = Item.query.all()
@@ -84,11 +93,29 @@ class ItemService:
         
     def get_active_items(self, user_id):
         """Get all active items for a user that are still active"""
-        active_items = ActiveItems.query.filter(
+        return [
+            {'item_name': item_name, 'active_until': active_until.isoformat()}
+            for item_name, active_until in self.get_active_until(user_id).items()
+        ]
+
+    def get_active_until(self, user_id):
+        """{item_name: active_until} of the items active on a user, from the active item cache"""
+        return active_item_cache.get(
+            user_id,
+            self._now(),
+            lambda: self.active_items_query(user_id).with_entities(ActiveItems.item, ActiveItems.active_until).all()
+        )
+
+    def is_timed_out(self, user_id):
+        """Returns the end of the user's timeout, or None"""
+        return self.get_active_until(user_id).get("timeout")
+
+    def active_items_query(self, user_id):
+        """Query for the items currently active on a user"""
+        return ActiveItems.query.filter(
             ActiveItems.user_id == user_id,
-            ActiveItems.active_until > datetime.utcnow() + timedelta(hours=2)  # Active for at least 1 minute
-        ).all()
-        return [item.to_dict() for item in active_items]
+            ActiveItems.active_until > self._now()  # Active for at least 1 minute
+        )
 
     def get_inventory(self, user_id):
         """Get inventory for a user"""
@@ -115,6 +142,7 @@ class ItemService:
         deleted_count = ActiveItems.query.filter(ActiveItems.active_until < now).delete()
         try:
             db.session.commit()
+            invalidation_bus.publish(ACTIVE_ITEMS_CHANNEL)
             return {"success": True, "deleted_count": deleted_count}
         except Exception as e:
             db.session.rollback()
@@ -134,8 +162,17 @@ class ItemService:
 
         try:
             db.session.commit()
+            invalidation_bus.publish(ACTIVE_ITEMS_CHANNEL)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
             return {"error": f"Database error: {str(e)}"}
 
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    @staticmethod
+    def _now():
+        # active_until is stored two hours ahead of UTC
+        return datetime.utcnow() + timedelta(hours=2)
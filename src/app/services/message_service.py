@@ -1,15 +1,43 @@
+import base64
 from datetime import datetime
+import json
 import uuid
-from sqlalchemy import or_, and_, func
+import zlib
+from flask import current_app
+from sqlalchemy import or_, and_, func, insert, literal
+from sqlalchemy.orm import aliased
 
 from app import db
-from app.models.message import Message, MessageRead, MessageTypeEnum
+from app.models.message import Message, MessageRead, MessageTypeEnum, ReadWatermark
 from app.models.user import User
-from app.models.group import Group, GroupMember
+from app.models.group import Group
+from app.services.conversation_service import ConversationService, DEFAULT_LAST_MESSAGE_TIMESTAMP
+from app.services.group_service import GroupService
+from app.services.user_service import UserService
+
+
+def encode_cursor(message):
+    """Opaque keyset cursor for a message: its (send_at, message_id) position."""
+    raw = f"{message.send_at.isoformat()}|{message.message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError for malformed cursors."""
+    try:
+        send_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(send_at), message_id
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
 
 
 class MessageService:
     """Service to handle message-related operations."""
+
+    def __init__(self):
+        self.conversation_service = ConversationService()
+        self.group_service = GroupService()
+        self.user_service = UserService()
     
     def save_message(self, user_id, recipient_id, content, is_group=False, message_type=MessageTypeEnum.TEXT):
         """Save a new message to the database."""
@@ -20,13 +48,11 @@ class MessageService:
         
         # Check if recipient exists
         if is_group:
-            recipient = Group.query.get(recipient_id)
-            if not recipient:
+            if not self.group_service.does_group_exist(recipient_id):
                 return {"error": "Group not found"}
                 
             # Check if sender is a member of the group
-            member = GroupMember.query.filter_by(group_id=recipient_id, user_id=user.user_id).first()
-            if not member:
+            if not self.group_service.is_user_member(user.user_id, recipient_id):
                 return {"error": "You are not a member of this group"}
         else:
             recipient = User.query.get(recipient_id)
@@ -46,133 +72,92 @@ class MessageService:
         
         db.session.add(message)
         try:
+            db.session.flush()
+            self.conversation_service.record_message(message)
             db.session.commit()
             return {"message_id": message.message_id}
         except Exception as e:
             db.session.rollback()
             return {"error": f"Database error: {str(e)}"}
 
-    def get_messages_with_groups(self, user_id, group_id, page=None):
+    def get_messages_with_groups(self, user_id, group_id, page=None, before=None, after=None, limit=None):
         """
         Get messages between a user and a group.
 
         Args:
             user_id: The ID of the user
             group_id: The ID of the group
-            page: Optional. Page number for pagination (default: None, returns all messages)
+            page: Optional. Legacy page number for offset pagination (20 messages per page)
+            before: Optional. Cursor, returns the messages directly older than it
+            after: Optional. Cursor, returns the messages directly newer than it
+            limit: Optional. Page size for cursor pagination, capped at MESSAGE_PAGE_MAX
 
         Returns:
             tuple: JSON response and status code
         """
         try:
-            spec_user = User.query.filter_by(user_id=user_id).first()
-            group = Group.query.get(group_id)
-            member = GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first()
-
-            if not spec_user:
+            if not self.user_service.get_profile_card(user_id):
                 return {"error": "Invalid user ID"}, 400
-            if not group:
+            if not self.group_service.does_group_exist(group_id):
                 return {"error": "Group not found"}, 400
-            if not member:
+            if not self.group_service.is_user_member(user_id, group_id):
                 return {"error": "You are not a member of this group"}, 403
 
             # Query messages in the group
-            base_query = Message.query.filter(
-                Message.recipient_user_id == group_id,
-                Message.is_group.is_(True)
-            ).order_by(Message.send_at)
-
-            # Pagination logic
-            if page is not None:
-                page = int(page)
-                per_page = 20
-                messages = base_query.limit(per_page).offset((page - 1) * per_page).all()
-            else:
-                messages = base_query.all()
+            rows, page_info = self._fetch_page(
+                self.group_messages_query(group_id), self.get_watermark(user_id, group_id),
+                page, before, after, limit
+            )
 
             # Format the messages for response
-            formatted_messages = []
-            for msg in messages:
-                # Get sender info
-                sender = User.query.get(msg.sender_user_id)
-                sender_username = sender.username if sender else "Unknown User"
-
-                message_data = {
-                    'message_id': msg.message_id,
-                    'sender_user_id': msg.sender_user_id,
-                    'sender_username': sender_username,
-                    'recipient_id': msg.recipient_user_id,
-                    'content': msg.encrypted_content,
-                    'type': msg.type.value if hasattr(msg.type, 'value') else 'text',
-                    'timestamp': msg.send_at.isoformat() if msg.send_at else None,
-                }
-                formatted_messages.append(message_data)
+            cards = self._sender_cards(rows)
+            formatted_messages = [self._format_message(row, cards) for row in rows]
 
-            return {"messages": formatted_messages}, 200
+            return {"messages": formatted_messages, **page_info}, 200
 
+        except ValueError as e:
+            return {"error": str(e)}, 400
         except Exception as e:
             db.session.rollback()
             return {"error": str(e)}, 500
 
-    def get_messages_with_contact(self, user_id, contact_id, page=None):
+    def get_messages_with_contact(self, user_id, contact_id, page=None, before=None, after=None, limit=None):
         """
         Get messages between a user and their contact.
 
         Args:
             user_id: The ID of the user
             contact_id: The ID of the contact
-            page: Optional. Page number for pagination (default: None, returns all messages)
+            page: Optional. Legacy page number for offset pagination (20 messages per page)
+            before: Optional. Cursor, returns the messages directly older than it
+            after: Optional. Cursor, returns the messages directly newer than it
+            limit: Optional. Page size for cursor pagination, capped at MESSAGE_PAGE_MAX
 
         Returns:
             tuple: JSON response and status code
         """
         try:
-            # First, get the user by user_id
-            spec_user = User.query.filter_by(user_id=user_id).first()
-            if not spec_user:
+            # Check that the user and the contact exist
+            cards = self.user_service.get_profile_cards([user_id, contact_id])
+            if user_id not in cards:
                 return {"error": "Invalid user ID"}, 400
-
-            # Check if the contact exists
-            contact = User.query.get(contact_id)
-            if not contact:
+            if contact_id not in cards:
                 return {"error": "Contact not found"}, 400
 
             # Query messages between the user and the contact (in both directions)
-            base_query = Message.query.filter(
-                or_(
-                    and_(Message.sender_user_id == spec_user.user_id, Message.recipient_user_id == contact_id),
-                    and_(Message.sender_user_id == contact_id, Message.recipient_user_id == spec_user.user_id)
-                )
-            ).order_by(Message.send_at)
-
-            # Pagination logic
-            if page is not None:
-                page = int(page)
-                per_page = 20
-                messages = base_query.limit(per_page).offset((page - 1) * per_page).all()
-            else:
-                messages = base_query.all()
+            rows, page_info = self._fetch_page(
+                self.contact_messages_query(user_id, contact_id),
+                self.get_watermark(user_id, contact_id), page, before, after, limit,
+                parts=self.contact_messages_parts(user_id, contact_id)
+            )
 
             # Format the messages for response
-            formatted_messages = []
-            for msg in messages:
-                # Get sender info
-                sender = User.query.get(msg.sender_user_id)
-                sender_username = sender.username if sender else "Unknown User"
-
-                message_data = {
-                    'message_id': msg.message_id,
-                    'sender_user_id': msg.sender_user_id,
-                    'sender_username': sender_username,
-                    'recipient_id': msg.recipient_user_id,
-                    'content': msg.encrypted_content,
-                    'type': msg.type.value if hasattr(msg.type, 'value') else 'text',
-                    'timestamp': msg.send_at.isoformat() if msg.send_at else None,
-                }
-                formatted_messages.append(message_data)
+            formatted_messages = [self._format_message(row, cards) for row in rows]
 
-            return {"messages": formatted_messages}, 200
+            return {"messages": formatted_messages, **page_info}, 200
 
+        except ValueError as e:
+            return {"error": str(e)}, 400
         except Exception as e:
             db.session.rollback()
             return {"error": str(e)}, 500
@@ -186,47 +171,40 @@ class MessageService:
             if is_group:
                 # For group chats
                 # First check if user is part of this group
-                member = GroupMember.query.filter_by(group_id=chat_id, user_id=user_id).first()
-                if not member:
+                if not self.group_service.is_user_member(user_id, chat_id):
                     return {"error": "You are not a member of this group"}
                 
                 # Get group messages
-                query = Message.query.filter(
-                    Message.is_group is True,
-                    Message.recipient_user_id == chat_id
-                ).order_by(Message.send_at.desc())
-                
+                query = self.group_messages_query(chat_id)
             else:
                 # For direct messages
-                query = Message.query.filter(
-                    Message.is_group is False,
-                    or_(
-                        and_(Message.sender_user_id == user_id, Message.recipient_user_id == chat_id),
-                        and_(Message.sender_user_id == chat_id, Message.recipient_user_id == user_id)
-                    )
-                ).order_by(Message.send_at.desc())
+                query = self.contact_messages_query(user_id, chat_id).filter(Message.is_group.is_(False))
             
             # Count total messages for pagination info
             total_messages = query.count()
             total_pages = (total_messages + page_size - 1) // page_size  # Ceiling division
             
-            # Get the messages for the current page
-            messages = query.limit(page_size).offset(offset).all()
+            # Get the messages for the current page, group name and read flag joined in
+            rows = self._with_read(query, self.get_watermark(user_id, chat_id)) \
+                .outerjoin(Group, and_(Group.group_id == Message.recipient_user_id, Message.is_group.is_(True))) \
+                .add_columns(Group.group_name) \
+                .order_by(Message.send_at.desc(), Message.message_id.desc()) \
+                .limit(page_size).offset(offset).all()
+            cards = self.user_service.get_profile_cards(
+                [row[0].sender_user_id for row in rows] +
+                [row[0].recipient_user_id for row in rows if not row[0].is_group]
+            )
             
             # Format messages for response
             formatted_messages = []
-            for msg in messages:
-                # Get sender info (using the relationship)
-                sender = msg.sender
-                
-                # For recipient info, we need to handle user vs group differently
-                # since we don't have a direct relationship anymore
+            for row in rows:
+                msg = row[0]
                 if msg.is_group:
-                    recipient = Group.query.get(msg.recipient_user_id)
-                    recipient_name = recipient.name if recipient else "Unknown Group"
+                    recipient_name = row.group_name or "Unknown Group"
                 else:
-                    recipient = User.query.get(msg.recipient_user_id)
+                    recipient = cards.get(msg.recipient_user_id)
                     recipient_name = recipient.username if recipient else "Unknown User"
+                sender = cards.get(msg.sender_user_id)
                 
                 message_data = {
                     'message_id': msg.message_id,
@@ -238,7 +216,7 @@ class MessageService:
                     'type': msg.type.value,
                     'timestamp': msg.send_at.isoformat(),
                     'is_group': msg.is_group,
-                    'read': self.is_message_read(msg.message_id, user_id)
+                    'read': bool(row.read)
                 }
                 formatted_messages.append(message_data)
             
@@ -252,31 +230,73 @@ class MessageService:
             db.session.rollback()
             return {"error": str(e)}
 
+    def export_chat(self, user_id, chat_id, is_group=False, compress=False):
+        """
+        Stream the full history of a chat as newline-delimited JSON, oldest message first.
+
+        The rows are read through a server-side cursor in batches of EXPORT_BATCH_SIZE and
+        serialized one by one, so memory stays flat for chats of any length. Authorization
+        is the caller's job (same checks as for getChatMessages).
+
+        Args:
+            user_id: The ID of the user
+            chat_id: The ID of the contact or group
+            is_group: Whether chat_id is a group
+            compress: gzip the stream
+
+        Returns:
+            generator: chunks (bytes) of the NDJSON document
+        """
+        batch_size = current_app.config["EXPORT_BATCH_SIZE"]
+        query = self.group_messages_query(chat_id) if is_group else self.contact_messages_query(user_id, chat_id)
+        sender = aliased(User)
+        statement = query.outerjoin(sender, sender.user_id == Message.sender_user_id) \
+            .with_entities(
+                Message.message_id,
+                Message.sender_user_id,
+                sender.username.label("sender_username"),
+                Message.recipient_user_id,
+                Message.encrypted_content,
+                Message.type,
+                Message.send_at
+            ) \
+            .order_by(Message.send_at, Message.message_id) \
+            .statement
+        rows = db.session.execute(statement.execution_options(yield_per=batch_size))
+
+        gzip = zlib.compressobj(wbits=31) if compress else None
+        for batch in rows.partitions():
+            chunk = "".join(json.dumps({
+                'message_id': row.message_id,
+                'sender_user_id': row.sender_user_id,
+                'sender_username': row.sender_username or "Unknown User",
+                'recipient_id': row.recipient_user_id,
+                'content': row.encrypted_content,
+                'type': row.type.value if hasattr(row.type, 'value') else 'text',
+                'timestamp': row.send_at.isoformat() if row.send_at else None,
+            }) + "\n" for row in batch).encode()
+            yield gzip.compress(chunk) + gzip.flush(zlib.Z_SYNC_FLUSH) if gzip else chunk
+        if gzip:
+            yield gzip.flush()
+
     def get_last_message_date_for_contact(self, user_id, contact_id) -> str:
-        """Get the last message exchanged with a contact."""
+        """Get the timestamp of the last message exchanged with a contact or group."""
         try:
-            # Get the last message between user and contact
-            last_message = Message.query.filter(
-                or_(
-                    and_(Message.sender_user_id == user_id, Message.recipient_user_id == contact_id),
-                    and_(Message.sender_user_id == contact_id, Message.recipient_user_id == user_id)
-                )
-            ).order_by(Message.send_at.desc()).first()
-
-            if not last_message:
-                return "2001-09-11T12:46:00Z"
+            conversation = self.conversation_service.get_conversation(user_id, contact_id)
+            if not conversation or not conversation.last_message_at:
+                return DEFAULT_LAST_MESSAGE_TIMESTAMP
 
-            return last_message.send_at.isoformat()
+            return conversation.last_message_at.isoformat()
 
         except Exception as _:
             db.session.rollback()
-            return "2001-09-11T12:46:00Z"
+            return DEFAULT_LAST_MESSAGE_TIMESTAMP
 
     def mark_as_read(self, message_id, reader_id):
-        """Mark a message as read by a user."""
+        """Mark a message, and with it everything older in its chat, as read by a user."""
         try:
             # Check if message exists
-            message = Message.query.get(message_id)
+            message = db.session.get(Message, message_id)
             if not message:
                 return {"error": "Message not found"}
             
@@ -284,80 +304,108 @@ class MessageService:
             if not message.is_group and message.recipient_user_id != reader_id and message.sender_user_id != reader_id:
                 return {"error": "Unauthorized"}
             
-            if message.is_group:
-                # Check if user is a member of the group
-                member = GroupMember.query.filter_by(
-                    group_id=message.recipient_user_id, 
-                    user_id=reader_id
-                ).first()
-                if not member:
-                    return {"error": "Not a member of this group"}
-            
             # Don't mark sender's own messages as read
             if message.sender_user_id == reader_id:
                 return {"success": True}
-                
-            # Check if already marked as read
-            existing = MessageRead.query.filter_by(
-                message_id=message_id,
-                reader_id=reader_id
-            ).first()
-            
-            if not existing:
-                # Create new read receipt
-                read_receipt = MessageRead(
-                    message_id=message_id,
-                    reader_id=reader_id,
-                    read_at=datetime.utcnow()
-                )
-                db.session.add(read_receipt)
-                db.session.commit()
-            
-            return {"success": True}
+
+            chat_id = message.recipient_user_id if message.is_group else message.sender_user_id
+            result = self.mark_chat_read(reader_id, chat_id, message_id)
+            return {"success": True} if "error" not in result else result
             
         except Exception as e:
             db.session.rollback()
             return {"error": str(e)}
+
+    def mark_chat_read(self, user_id, chat_id, up_to_message_id=None):
+        """
+        Mark a chat as read up to a message.
+
+        Moves the user's read watermark for the chat forward (never back). For groups a
+        receipt is stored for every newly read message, for the "read by" details.
+
+        Args:
+            user_id: The ID of the reader
+            chat_id: The ID of the contact or group
+            up_to_message_id: Optional. Last read message, defaults to the newest message of the chat
+
+        Returns:
+            dict: the watermark message and the remaining unread count, or an error
+        """
+        try:
+            is_group = self.group_service.is_id_group(chat_id)
+            if is_group:
+                if not self.group_service.is_user_member(user_id, chat_id):
+                    return {"error": "Not a member of this group"}
+                query = self.group_messages_query(chat_id)
+            else:
+                if not db.session.get(User, chat_id):
+                    return {"error": "Contact not found"}
+                query = self.contact_messages_query(user_id, chat_id)
+
+            if up_to_message_id:
+                target = query.filter(Message.message_id == up_to_message_id).first()
+                if not target:
+                    return {"error": "Message not found"}
+            else:
+                target = query.order_by(Message.send_at.desc(), Message.message_id.desc()).first()
+
+            watermark = self.get_watermark(user_id, chat_id)
+            if target and (not watermark or (target.send_at, target.message_id) >
+                           (watermark.read_up_to_at, watermark.read_up_to_message_id)):
+                if is_group:
+                    newly_read = query.filter(
+                        Message.sender_user_id != user_id,
+                        *self._up_to(target.send_at, target.message_id)
+                    )
+                    if watermark:
+                        newly_read = newly_read.filter(*self._after_watermark(watermark))
+                    already_received = db.session.query(MessageRead.message_id).filter(MessageRead.reader_id == user_id)
+                    newly_read = newly_read.filter(~Message.message_id.in_(already_received))
+                    db.session.execute(insert(MessageRead).from_select(
+                        [MessageRead.message_id, MessageRead.reader_id, MessageRead.read_at],
+                        newly_read.with_entities(Message.message_id, literal(user_id), literal(datetime.utcnow()))
+                    ))
+
+                if not watermark:
+                    watermark = ReadWatermark(user_id=user_id, chat_id=chat_id)
+                    db.session.add(watermark)
+                watermark.read_up_to_at = target.send_at
+                watermark.read_up_to_message_id = target.message_id
+                db.session.flush()
+
+            unread_count = self.unread_count_query(user_id, chat_id, is_group).scalar() or 0
+            self.conversation_service.record_read(user_id, chat_id, unread_count)
+            db.session.commit()
+
+            return {
+                "success": True,
+                "read_up_to": watermark.read_up_to_message_id if watermark else None,
+                "unread_count": unread_count
+            }
+
+        except Exception as e:
+            db.session.rollback()
+            return {"error": str(e)}
     
     def is_message_read(self, message_id, user_id):
         """Check if a message has been read by a user."""
-        read = MessageRead.query.filter_by(
-            message_id=message_id,
-            reader_id=user_id
-        ).first()
-        
-        return read is not None
+        message = db.session.get(Message, message_id)
+        if not message:
+            return False
+
+        chat_id = message.recipient_user_id if message.is_group or message.sender_user_id == user_id \
+            else message.sender_user_id
+        watermark = self.get_watermark(user_id, chat_id)
+        return watermark is not None and (message.send_at, message.message_id) <= \
+            (watermark.read_up_to_at, watermark.read_up_to_message_id)
+
+    def get_watermark(self, user_id, chat_id):
+        return db.session.get(ReadWatermark, (user_id, chat_id))
     
     def get_unread_count(self, user_id, chat_id, is_group=False):
         """Get count of unread messages in a chat."""
         try:
-            if is_group:
-                # Get unread messages for group
-                query = db.session.query(func.count(Message.message_id)).filter(
-                    Message.is_group is True,
-                    Message.recipient_user_id == chat_id,
-                    Message.sender_user_id != user_id,
-                    ~Message.message_id.in_(
-                        db.session.query(MessageRead.message_id).filter(
-                            MessageRead.reader_id == user_id
-                        )
-                    )
-                )
-            else:
-                # Get unread messages for direct chat
-                query = db.session.query(func.count(Message.message_id)).filter(
-                    Message.is_group is False,
-                    Message.recipient_user_id == user_id,
-                    Message.sender_user_id == chat_id,
-                    ~Message.message_id.in_(
-                        db.session.query(MessageRead.message_id).filter(
-                            MessageRead.reader_id == user_id
-                        )
-                    )
-                )
-            
-            return query.scalar() or 0
-            
+            return self.unread_count_query(user_id, chat_id, is_group).scalar() or 0
         except Exception as _:
             return 0
 
@@ -373,6 +421,7 @@ class MessageService:
 
             # Delete the message
             message.type = MessageTypeEnum.DELETED_TEXT
+            self.conversation_service.record_delete(message)
             db.session.commit()
 
             return {"success": True}
@@ -381,6 +430,9 @@ class MessageService:
             db.session.rollback()
             return {"error": str(e)}
 
+    def get_message_by_id(self, message_id):
+        return db.session.get(Message, message_id)
+
     def get_recipient_id_by_message_id(self, message_id):
         """Get the recipient ID for a given message ID."""
         try:
@@ -393,3 +445,162 @@ class MessageService:
         except Exception as e:
             db.session.rollback()
             return None
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def group_messages_query(self, group_id):
+        """Unordered query over all messages of a group chat."""
+        return Message.query.filter(
+            Message.recipient_user_id == group_id,
+            Message.is_group.is_(True)
+        )
+
+    def contact_messages_query(self, user_id, contact_id):
+        """Unordered query over all messages between two users (in both directions)."""
+        return Message.query.filter(
+            or_(
+                and_(Message.sender_user_id == user_id, Message.recipient_user_id == contact_id),
+                and_(Message.sender_user_id == contact_id, Message.recipient_user_id == user_id)
+            )
+        )
+
+    def contact_messages_parts(self, user_id, contact_id):
+        """The two directions of a direct chat as separate queries, each one an index range."""
+        parts = [Message.query.filter(Message.sender_user_id == user_id, Message.recipient_user_id == contact_id)]
+        if user_id != contact_id:
+            parts.append(Message.query.filter(Message.sender_user_id == contact_id, Message.recipient_user_id == user_id))
+        return parts
+
+    def latest_direct_message_query(self, sender_id, recipient_id):
+        """Newest-first query over the direct messages one user sent to another."""
+        return Message.query.filter(
+            Message.sender_user_id == sender_id,
+            Message.recipient_user_id == recipient_id,
+            Message.is_group == False
+        ).order_by(Message.send_at.desc())
+
+    def unread_count_query(self, user_id, chat_id, is_group=False):
+        """Count query for the messages of a chat after the user's read watermark (a range on the message index)."""
+        if is_group:
+            chat_filter = (
+                Message.recipient_user_id == chat_id,
+                Message.is_group.is_(True),
+                Message.sender_user_id != user_id
+            )
+        else:
+            chat_filter = (
+                Message.sender_user_id == chat_id,
+                Message.recipient_user_id == user_id,
+                Message.is_group.is_(False)
+            )
+        query = db.session.query(func.count(Message.message_id)).filter(*chat_filter)
+
+        watermark = self.get_watermark(user_id, chat_id)
+        if watermark:
+            query = query.filter(*self._after_watermark(watermark))
+        return query
+
+    def _after_watermark(self, watermark):
+        """Filter for the messages positioned after a read watermark."""
+        return (
+            Message.send_at >= watermark.read_up_to_at,
+            or_(Message.send_at > watermark.read_up_to_at,
+                Message.message_id > watermark.read_up_to_message_id)
+        )
+
+    def _up_to(self, send_at, message_id):
+        """Filter for the messages positioned at or before (send_at, message_id)."""
+        return (
+            Message.send_at <= send_at,
+            or_(Message.send_at < send_at, Message.message_id <= message_id)
+        )
+
+    def _with_read(self, query, watermark):
+        """Adds whether the message is within the reader's `watermark` to every row."""
+        read = and_(*self._up_to(watermark.read_up_to_at, watermark.read_up_to_message_id)) \
+            if watermark else literal(False)
+        return query.add_columns(read.label("read"))
+
+    def _sender_cards(self, rows):
+        """Profile cards of the senders of a page of (message, read) rows."""
+        return self.user_service.get_profile_cards([row[0].sender_user_id for row in rows])
+
+    def _format_message(self, row, cards):
+        """Response dict for a (message, read) row of a message page, sender names from `cards`."""
+        msg = row[0]
+        sender = cards.get(msg.sender_user_id)
+        return {
+            'message_id': msg.message_id,
+            'sender_user_id': msg.sender_user_id,
+            'sender_username': sender.username if sender else "Unknown User",
+            'recipient_id': msg.recipient_user_id,
+            'content': msg.encrypted_content,
+            'type': msg.type.value if hasattr(msg.type, 'value') else 'text',
+            'timestamp': msg.send_at.isoformat() if msg.send_at else None,
+        }
+
+    def _fetch_page(self, query, watermark, page=None, before=None, after=None, limit=None, parts=None):
+        """
+        Load one page of messages in chronological order.
+
+        Old clients pass `page` and get offset pagination over `query`. Everybody else gets
+        keyset pagination on (send_at, message_id): `before`/`after` seek from a cursor, no
+        cursor returns the newest messages. For keyset pages every query in `parts` (disjoint
+        slices of `query`, e.g. the two directions of a direct chat) is seeked separately and
+        the results are merged. The page size is always capped at MESSAGE_PAGE_MAX.
+
+        Every row carries the read flag from the reader's `watermark` (see _with_read), so a
+        page costs the same number of queries at any size. Sender names come from the profile
+        card cache (_sender_cards).
+
+        Returns:
+            tuple: list of (message, read) rows and the pagination info for the response
+        """
+        max_page_size = current_app.config["MESSAGE_PAGE_MAX"]
+        query = self._with_read(query, watermark)
+
+        if page is not None and before is None and after is None:
+            per_page = current_app.config["MESSAGE_PAGE_SIZE"]
+            page = max(int(page), 1)
+            messages = query.order_by(Message.send_at, Message.message_id) \
+                .limit(per_page).offset((page - 1) * per_page).all()
+            return messages, {}
+
+        page_size = min(max(int(limit or max_page_size), 1), max_page_size)
+        parts = [self._with_read(part, watermark) for part in parts] if parts else [query]
+
+        if after is not None:
+            send_at, message_id = decode_cursor(after)
+            messages = []
+            for part in parts:
+                messages += part.filter(
+                    Message.send_at >= send_at,
+                    or_(Message.send_at > send_at, Message.message_id > message_id)
+                ).order_by(Message.send_at, Message.message_id).limit(page_size + 1).all()
+            messages.sort(key=lambda row: (row[0].send_at, row[0].message_id))
+            has_more = len(messages) > page_size
+            messages = messages[:page_size]
+        else:
+            if before is not None:
+                send_at, message_id = decode_cursor(before)
+                parts = [part.filter(
+                    Message.send_at <= send_at,
+                    or_(Message.send_at < send_at, Message.message_id < message_id)
+                ) for part in parts]
+            messages = []
+            for part in parts:
+                messages += part.order_by(Message.send_at.desc(), Message.message_id.desc()) \
+                    .limit(page_size + 1).all()
+            messages.sort(key=lambda row: (row[0].send_at, row[0].message_id), reverse=True)
+            has_more = len(messages) > page_size
+            messages = list(reversed(messages[:page_size]))
+
+        return messages, {
+            "has_more": has_more,
+            "cursors": {
+                "before": encode_cursor(messages[0][0]) if messages else before,
+                "after": encode_cursor(messages[-1][0]) if messages else after
+            }
+        }
@@ -0,0 +1,104 @@
+"""
+Presence store: who is online, without writing to the user table.
+
+A user is online while their presence entry is alive. Entries are set when the
+first device connects, refreshed by a heartbeat of the worker that holds the
+connection (every PRESENCE_TTL_S / 3) and removed when the last device
+disconnects. If a worker crashes, its users go offline after PRESENCE_TTL_S.
+
+The local store is per process. With PRESENCE_STORE_URL (or a redis
+SOCKETIO_MESSAGE_QUEUE) the entries are Redis keys with a TTL, shared by all workers.
+"""
+import threading
+import time
+
+
+class LocalPresenceStore:
+    def __init__(self, ttl=60, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._expires = {}  # user_id → expiry time
+
+    def set_online(self, user_ids):
+        """Mark users online (or refresh them) for another ttl seconds."""
+        expires = self.clock() + self.ttl
+        with self._lock:
+            for user_id in user_ids:
+                self._expires[user_id] = expires
+
+    def set_offline(self, user_id):
+        with self._lock:
+            self._expires.pop(user_id, None)
+
+    def online(self, user_ids):
+        """The users of user_ids that are online."""
+        now = self.clock()
+        with self._lock:
+            return {user_id for user_id in user_ids if self._expires.get(user_id, 0) > now}
+
+    def is_online(self, user_id):
+        return user_id in self.online([user_id])
+
+    def reset(self):
+        with self._lock:
+            self._expires.clear()
+
+
+class RedisPresenceStore:
+    def __init__(self, url, ttl=60, prefix="umoc:presence"):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def set_online(self, user_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.set(self._key(user_id), 1, ex=self.ttl)
+        pipe.execute()
+
+    def set_offline(self, user_id):
+        self.redis.delete(self._key(user_id))
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        values = self.redis.mget([self._key(user_id) for user_id in user_ids])
+        return {user_id for user_id, value in zip(user_ids, values) if value is not None}
+
+    def is_online(self, user_id):
+        return self.redis.exists(self._key(user_id)) > 0
+
+    def reset(self):
+        keys = list(self.redis.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _key(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+
+presence_store = LocalPresenceStore()
+
+
+def init_presence_store(app):
+    """Pick the store for the app's configuration. A new local store starts empty, everybody offline."""
+    global presence_store
+    url = app.config.get("PRESENCE_STORE_URL") or app.config.get("SOCKETIO_MESSAGE_QUEUE")
+    ttl = app.config["PRESENCE_TTL_S"]
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        presence_store = RedisPresenceStore(url, ttl)
+    elif not isinstance(presence_store, LocalPresenceStore) or presence_store.ttl != ttl:
+        presence_store = LocalPresenceStore(ttl)
+    return presence_store
+
+
+def get_presence_store():
+    return presence_store
@@ -0,0 +1,71 @@
+"""
+In-process cache of profile cards: user_id, username and profile picture.
+
+Contact lists, group member lists, the chat list and sender names of message
+pages only need these three fields of a user, so instead of loading full User
+rows (password, keys, salt, ...) they ask UserService for cards. The misses of a
+call are loaded with one column-only query and kept in an LRU of max_size
+cards. Unknown ids are not cached. (The user search has to ask the database
+anyway, it selects the same three columns.)
+
+A card changes only through change_username and change_profile_picture. They
+publish on the invalidation bus ("users" channel) after their commit, which
+drops the card here and on every other worker. As in the group directory, a
+load that started before an invalidation of one of its users is not stored.
+
+Counters: profile_cards.hits, profile_cards.misses (per card).
+"""
+import threading
+from collections import namedtuple
+
+from app.metrics import metrics
+from app.services.versioned_lru import VersionedLRU
+
+ProfileCard = namedtuple("ProfileCard", ["user_id", "username", "profile_picture"])
+
+
+class ProfileCardCache:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._cards = VersionedLRU(max_size)  # user_id → ProfileCard
+
+    def cards(self, user_ids, loader):
+        """
+        {user_id: ProfileCard} of the existing users among user_ids.
+        loader(user_ids) reads the cards of the missing ones from the database in one query.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for user_id in dict.fromkeys(user_ids):
+                card = self._cards.get(user_id)
+                if card is not None:
+                    found[user_id] = card
+                elif user_id is not None:
+                    missing.append(user_id)
+            stamps = {user_id: self._cards.stamp(user_id) for user_id in missing}
+
+        metrics.incr("profile_cards.hits", len(found))
+        if not missing:
+            return found
+
+        metrics.incr("profile_cards.misses", len(missing))
+        loaded = loader(missing)
+        with self._lock:
+            for card in loaded:
+                found[card.user_id] = card
+                self._cards.store(card.user_id, card, stamps.get(card.user_id))
+        return found
+
+    def invalidate(self, user_id=None):
+        """Forget a user's card, or every card for None."""
+        with self._lock:
+            self._cards.invalidate(user_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cards)
+
+
+profile_cards = ProfileCardCache()
@@ -0,0 +1,202 @@
+from datetime import datetime
+import uuid
+from flask import current_app
+from sqlalchemy import or_, and_
+
+from app import db
+from app.metrics import metrics, count_queries
+from app.models.user import User, UserContact, ContactStatusEnum
+from app.models.message import Message, MessageTypeEnum
+from app.services.group_service import GroupService
+from app.services.item_service import ItemService
+from app.services.message_service import MessageService
+from app.services.streak_service import StreakService
+from app.services.write_behind import get_write_behind
+
+
+class SendService:
+    """The /saveMessage write path in a single transaction.
+
+    Validation, the message insert, the conversation rows, the block/last-words
+    rules, the streak and the automatic contact rows are written with one commit
+    and a bounded number of queries. The query count of every send is recorded
+    as the "send.queries" metric.
+
+    With MESSAGE_WRITE_BEHIND the validation stays in the request and the whole
+    write (message, conversation rows, streak, points, contact rows) becomes one
+    job of the write-behind queue, committed in a batch with other sends but never
+    split from its message (see app/services/write_behind.py).
+    """
+
+    def __init__(self):
+        self.message_service = MessageService()
+        self.item_service = ItemService()
+        self.group_service = GroupService()
+        self.streak_service = StreakService()
+
+    def send(self, user_id, recipient_id, content, message_type=MessageTypeEnum.TEXT, wait=None):
+        """
+        Validate and store a message sent by a user.
+
+        Args:
+            user_id: The ID of the sender
+            recipient_id: The ID of the contact or group
+            content: The (encrypted) message content
+            message_type: Optional. MessageTypeEnum of the message
+            wait: Optional. With MESSAGE_WRITE_BEHIND, wait for the batch commit
+                (defaults to WRITE_BEHIND_WAIT)
+
+        Returns:
+            tuple: result and status code. On success the result has the `message_id`, `send_at`,
+            the `sender`, `is_group`, `last_words` and the `new_contacts` (user_id, contact_id)
+            rows that were created, for the websocket notifications. A send that was queued
+            without waiting has "pending": True, its `last_words` and `new_contacts` are the ones
+            the request read.
+        """
+        with count_queries() as counter:
+            result = self._send(user_id, recipient_id, content, message_type, wait)
+
+        metrics.incr("send.total")
+        metrics.observe("send.queries", counter.count)
+        metrics.observe("send.commits", counter.commits)
+        return result
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _send(self, user_id, recipient_id, content, message_type, wait):
+        sender = db.session.get(User, user_id)
+        if not sender:
+            return {"error": "User not found"}, 400
+
+        timeout_until = self.item_service.is_timed_out(user_id)
+        if timeout_until:
+            return {
+                "error": "You are currently in timeout and cannot send messages",
+                "until": timeout_until.isoformat()
+            }, 403
+
+        if not recipient_id:
+            return {"error": "'recipient_id' is required"}, 400
+        if not content:
+            return {"error": "'content' is required"}, 400
+
+        is_group = self.group_service.is_id_group(recipient_id)
+        recipient = None
+        own_contact = reverse_contact = None
+        if is_group:
+            if not self.group_service.is_user_member(user_id, recipient_id):
+                return {"error": "You are not a member of this group"}, 400
+        else:
+            recipient = db.session.get(User, recipient_id)
+            if not recipient:
+                return {"error": "Recipient not found"}, 400
+
+            own_contact, reverse_contact = self._contacts(user_id, recipient_id)
+
+            # Check if sender is blocked by recipient
+            if own_contact and own_contact.status in (ContactStatusEnum.BLOCK, ContactStatusEnum.FBLOCKED):
+                return {"error": "Unable to send message because of user rules"}, 403
+
+        message = Message(
+            message_id=str(uuid.uuid4()),
+            sender_user_id=user_id,
+            recipient_user_id=recipient_id,
+            encrypted_content=content,
+            type=message_type,
+            send_at=datetime.utcnow(),
+            is_group=is_group
+        )
+        if current_app.config["MESSAGE_WRITE_BEHIND"]:
+            return self._enqueue(message, sender, own_contact, reverse_contact, wait)
+
+        try:
+            last_words, new_contacts = self._write(message, own_contact, reverse_contact)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return {"error": f"Database error: {str(e)}"}, 500
+        return self._result(message, sender, last_words, new_contacts), 200
+
+    def _write(self, message, own_contact, reverse_contact):
+        """Everything a send writes, without the commit. Returns (last_words, new_contacts)."""
+        user_id, recipient_id = message.sender_user_id, message.recipient_user_id
+        db.session.add(message)
+        db.session.flush()
+        self.message_service.conversation_service.record_message(message)
+
+        if message.is_group:
+            return False, []
+
+        self.streak_service.record_message(user_id, recipient_id, message.send_at)
+
+        # Handle LASTWORDS status
+        last_words = own_contact is not None and own_contact.status == ContactStatusEnum.LASTWORDS
+        if last_words:
+            own_contact.status = ContactStatusEnum.FBLOCKED
+
+        # Kontakte automatisch hinzufügen (beidseitig)
+        new_contacts = self._missing_contacts(user_id, recipient_id, own_contact, reverse_contact)
+        for uid, cid in new_contacts:
+            db.session.add(UserContact(
+                user_id=uid,
+                contact_id=cid,
+                status=ContactStatusEnum.NEW,
+                streak=0,
+                continue_streak=True,
+                last_sent_at=message.send_at if uid == user_id else None
+            ))
+        return last_words, new_contacts
+
+    def _enqueue(self, message, sender, own_contact, reverse_contact, wait):
+        """Hand the write of a validated send to the write-behind queue."""
+        wait = current_app.config["WRITE_BEHIND_WAIT"] if wait is None else wait
+        row = {column.name: getattr(message, column.name) for column in Message.__table__.columns}
+        future = get_write_behind(current_app._get_current_object()).submit(lambda: self._queued_write(row))
+
+        if not wait:
+            last_words = own_contact is not None and own_contact.status == ContactStatusEnum.LASTWORDS
+            new_contacts = [] if message.is_group else self._missing_contacts(
+                message.sender_user_id, message.recipient_user_id, own_contact, reverse_contact)
+            return {**self._result(message, sender, last_words, new_contacts), "pending": True}, 200
+
+        try:
+            last_words, new_contacts = future.result(timeout=current_app.config["WRITE_BEHIND_WAIT_TIMEOUT"])
+        except Exception as e:
+            return {"error": f"Database error: {str(e)}"}, 500
+        return self._result(message, sender, last_words, new_contacts), 200
+
+    def _queued_write(self, row):
+        # runs on the writer's session: the contact rows are read again there
+        message = Message(**row)
+        own_contact = reverse_contact = None
+        if not message.is_group:
+            own_contact, reverse_contact = self._contacts(message.sender_user_id, message.recipient_user_id)
+        return self._write(message, own_contact, reverse_contact)
+
+    def _contacts(self, user_id, recipient_id):
+        """(own, reverse) UserContact rows of a direct chat, None where missing."""
+        contacts = UserContact.query.filter(or_(
+            and_(UserContact.user_id == user_id, UserContact.contact_id == recipient_id),
+            and_(UserContact.user_id == recipient_id, UserContact.contact_id == user_id)
+        )).all()
+        own_contact = next((c for c in contacts if c.user_id == user_id), None)
+        reverse_contact = next((c for c in contacts if c.user_id == recipient_id), None)
+        return own_contact, reverse_contact
+
+    def _missing_contacts(self, user_id, recipient_id, own_contact, reverse_contact):
+        missing = [(user_id, recipient_id)] if not own_contact else []
+        if not reverse_contact and recipient_id != user_id:
+            missing.append((recipient_id, user_id))
+        return missing
+
+    def _result(self, message, sender, last_words, new_contacts):
+        return {
+            "message_id": message.message_id,
+            "send_at": message.send_at,
+            "sender": sender,
+            "is_group": message.is_group,
+            "last_words": last_words,
+            "new_contacts": new_contacts
+        }
@@ -0,0 +1,71 @@
+"""
+Background job that expires broken streaks.
+
+Instead of validating streaks while they are read (/getChats), a background
+thread runs StreakService.expire_streaks every STREAK_EXPIRY_INTERVAL_S: one
+pass over all contact pairs with a streak, in batches of STREAK_EXPIRY_BATCH
+rows. A reset shows up at most one interval late. The job is idempotent, so
+several workers may run it; STREAK_EXPIRY_INTERVAL_S=0 turns it off for
+deployments that run `flask --app src/main.py expire-streaks` from cron instead.
+
+Metrics: streak_expiry.runs/.batches/.checked/.expired/.failed, the duration
+summary streak_expiry.duration_ms and the gauges streak_expiry.progress (rows
+checked by the running pass) and streak_expiry.last_run.
+"""
+import atexit
+import threading
+
+from app import db
+
+_create_lock = threading.Lock()
+
+
+class StreakExpiryJob:
+    def __init__(self, app, interval=900, batch_size=500):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="streak-expiry", daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        """One pass over all streaks, see StreakService.expire_streaks."""
+        from app.services.streak_service import StreakService
+
+        with self.app.app_context():
+            try:
+                result = StreakService().expire_streaks(batch_size=self.batch_size)
+                if "error" in result:
+                    print(f"Streak expiry failed: {result['error']}")
+                return result
+            finally:
+                db.session.remove()
+
+    def stop(self, timeout=10):
+        """Stop after the running pass. Registered with atexit."""
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+
+def start_streak_expiry(app):
+    """Start the app's expiry job once, unless STREAK_EXPIRY_INTERVAL_S is 0."""
+    with _create_lock:
+        job = app.extensions.get("streak_expiry")
+        if job is None and app.config["STREAK_EXPIRY_INTERVAL_S"] > 0:
+            job = StreakExpiryJob(
+                app,
+                interval=app.config["STREAK_EXPIRY_INTERVAL_S"],
+                batch_size=app.config["STREAK_EXPIRY_BATCH"]
+            )
+            app.extensions["streak_expiry"] = job
+            atexit.register(job.stop)
+        return job
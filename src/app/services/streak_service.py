@@ -0,0 +1,197 @@
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, case, func, not_, or_, select, true, tuple_, update
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.metrics import metrics
+from app.models.user import User, UserContact
+
+STREAK_WINDOW = timedelta(hours=24)
+
+
+class StreakService:
+    """Streaks kept incrementally on the two UserContact rows of a pair.
+
+    Every row knows when its user last sent a direct message to the contact
+    (`last_sent_at`) and when the streak of the pair was last counted
+    (`streak_counted_at`). A direct message then needs neither the message
+    table nor the user rows, only one conditional UPDATE of the two rows of the
+    pair. The rules are the ones update_streak and check_streak_validity
+    applied before:
+      - the streak counts if the recipient also sent within 24 hours and it was
+        not counted yet today (both users get a point),
+      - it is kept if it was already counted today,
+      - it is reset to 0 if the recipient did not write within 24 hours, unless
+        the pair was already checked today (last_streak_update).
+    The one change: "counted today" is read from streak_counted_at instead of
+    last_streak_update, which the check had just set, so a streak can get past 1.
+
+    record_message never commits, it runs inside the transaction of the send.
+    Pairs that stop writing are reset by expire_streaks, a background job (see
+    app/services/streak_expiry.py), so reading a streak has no side effects.
+    """
+
+    def record_message(self, sender_id, recipient_id, now):
+        """
+        Count a direct message for the streak of the pair.
+
+        Args:
+            sender_id: The ID of the sender
+            recipient_id: The ID of the recipient
+            now: send_at of the message
+
+        Returns:
+            tuple: (streak, counted) after the message, None if the users have no contact rows
+        """
+        rows = db.session.execute(
+            self.record_update(sender_id, recipient_id, now).returning(UserContact.streak, UserContact.streak_counted_at),
+            execution_options={"synchronize_session": "fetch"}
+        ).all()
+        if not rows:
+            return None
+
+        counted = any(counted_at == now for _, counted_at in rows)
+        if counted:
+            db.session.execute(
+                update(User)
+                .where(User.user_id.in_({sender_id, recipient_id}))
+                .values(points=func.coalesce(User.points, 0) + 1),
+                execution_options={"synchronize_session": "fetch"}
+            )
+        return max(streak or 0 for streak, _ in rows), counted
+
+    def record_update(self, sender_id, recipient_id, now):
+        """
+        The UPDATE of both contact rows of the pair for a message.
+
+        The state of the pair (when the recipient last sent, whether it was checked or counted
+        today) is aggregated in a subquery over both rows, which the database computes once
+        before it writes either row. The row's own columns are checked as well, so a send that
+        waited for the row lock of a concurrent one doesn't count the same day twice.
+        """
+        day_start = datetime.combine(now.date(), datetime.min.time())
+        day_end = day_start + timedelta(days=1)
+
+        def counted_today(row):
+            return and_(row.streak_counted_at.is_not(None), row.streak_counted_at >= day_start,
+                        row.streak_counted_at < day_end, func.coalesce(row.streak, 0) > 0)
+
+        rows = aliased(UserContact)
+        pair = select(
+            func.min(rows.user_id).label("pair_key"),
+            func.max(case((rows.user_id == recipient_id, rows.last_sent_at))).label("recipient_sent"),
+            func.max(case((rows.last_streak_update == now.date(), 1), else_=0)).label("checked"),
+            func.max(case((counted_today(rows), 1), else_=0)).label("counted"),
+        ).where(self._pair(rows, sender_id, recipient_id)).subquery()
+
+        # a message to oneself is its own answer
+        both_recent = true() if sender_id == recipient_id else \
+            and_(pair.c.recipient_sent.is_not(None), pair.c.recipient_sent >= now - STREAK_WINDOW)
+        counts = and_(both_recent, pair.c.counted == 0, not_(counted_today(UserContact)))
+        resets = and_(not_(both_recent), pair.c.checked == 0,
+                      or_(UserContact.last_streak_update.is_(None), UserContact.last_streak_update != now.date()))
+
+        return update(UserContact).where(
+            self._pair(UserContact, sender_id, recipient_id),
+            pair.c.pair_key == self._pair_key(UserContact)
+        ).values(
+            last_sent_at=case((UserContact.user_id == sender_id, now), else_=UserContact.last_sent_at),
+            streak=case((counts, func.coalesce(UserContact.streak, 0) + 1), (resets, 0), else_=UserContact.streak),
+            streak_counted_at=case((counts, now), else_=UserContact.streak_counted_at),
+            last_streak_update=now.date()
+        )
+
+    def pair_query(self, sender_id, recipient_id):
+        """Both contact rows of the pair, the lookup record_update does (see check-query-plans)."""
+        return select(UserContact).where(self._pair(UserContact, sender_id, recipient_id))
+
+    def expire_streaks(self, now=None, batch_size=500):
+        """
+        Reset the streak of every pair where one side did not write within 24 hours.
+
+        Walks the contact rows with a streak in primary key order, batch_size rows per
+        transaction, and resets both rows of a broken pair in one UPDATE. The condition is
+        evaluated by the UPDATE itself, so a message sent meanwhile is never overwritten
+        with a stale decision. Checked rows get last_streak_update = today.
+
+        Returns:
+            dict: `checked` and `expired` rows, or an error
+        """
+        now = now or datetime.utcnow()
+        started = time.monotonic()
+        checked = expired = 0
+        after = None
+        metrics.set_gauge("streak_expiry.progress", 0)
+
+        try:
+            while True:
+                query = select(UserContact.user_id, UserContact.contact_id).where(UserContact.streak > 0)
+                if after is not None:
+                    query = query.where(tuple_(UserContact.user_id, UserContact.contact_id) > after)
+                keys = [tuple(key) for key in db.session.execute(
+                    query.order_by(UserContact.user_id, UserContact.contact_id).limit(batch_size)
+                )]
+                if not keys:
+                    break
+                after = keys[-1]
+
+                # both rows of every pair, so they can't get out of step
+                pairs = set(keys) | {(contact_id, user_id) for user_id, contact_id in keys}
+                expired += db.session.execute(
+                    self.expiry_update(pairs, now), execution_options={"synchronize_session": False}
+                ).rowcount
+                db.session.execute(
+                    update(UserContact)
+                    .where(tuple_(UserContact.user_id, UserContact.contact_id).in_(pairs))
+                    .values(last_streak_update=now.date()),
+                    execution_options={"synchronize_session": False}
+                )
+                db.session.commit()
+
+                checked += len(keys)
+                metrics.incr("streak_expiry.batches")
+                metrics.set_gauge("streak_expiry.progress", checked)
+        except Exception as e:
+            db.session.rollback()
+            metrics.incr("streak_expiry.failed")
+            return {"error": f"Database error: {str(e)}"}
+
+        metrics.incr("streak_expiry.runs")
+        metrics.incr("streak_expiry.checked", checked)
+        metrics.incr("streak_expiry.expired", expired)
+        metrics.observe("streak_expiry.duration_ms", (time.monotonic() - started) * 1000)
+        metrics.set_gauge("streak_expiry.last_run", now.isoformat())
+        return {"checked": checked, "expired": expired}
+
+    def expiry_update(self, pairs, now):
+        """The UPDATE that resets the broken streaks among the given (user_id, contact_id) rows."""
+        cutoff = now - STREAK_WINDOW
+        reverse = aliased(UserContact)
+        contact_sent = select(reverse.last_sent_at).where(
+            reverse.user_id == UserContact.contact_id,
+            reverse.contact_id == UserContact.user_id
+        ).scalar_subquery()
+
+        return update(UserContact).where(
+            tuple_(UserContact.user_id, UserContact.contact_id).in_(pairs),
+            UserContact.streak > 0,
+            or_(
+                UserContact.last_sent_at.is_(None), UserContact.last_sent_at < cutoff,
+                contact_sent.is_(None), contact_sent < cutoff
+            )
+        ).values(streak=0, last_streak_update=now.date())
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _pair_key(self, rows):
+        """The smaller user id of the row's pair, the same on both rows."""
+        return case((rows.user_id < rows.contact_id, rows.user_id), else_=rows.contact_id)
+
+    def _pair(self, rows, sender_id, recipient_id):
+        return or_(
+            and_(rows.user_id == sender_id, rows.contact_id == recipient_id),
+            and_(rows.user_id == recipient_id, rows.contact_id == sender_id)
+        )
@@ -1,10 +1,34 @@
 import uuid
 from datetime import datetime
 import time
+from flask import g, has_request_context, request
 from app import db
+from app.metrics import metrics
 from app.models.user import User
 
 from app.models.user import UserContact
+from app.services.presence_store import get_presence_store
+from app.services.invalidation import invalidation_bus
+from app.services.profile_cards import ProfileCard, profile_cards
+
+USERS_CHANNEL = "users"  # a user's cached data changed (username, ...)
+invalidation_bus.subscribe(USERS_CHANNEL, profile_cards.invalidate)
+
+
+def init_user_lookups(app):
+    """User lookups by id are remembered for the rest of the request (UserService.get_user_by_id)."""
+    @app.teardown_request
+    def forget_user_lookups(exc=None):
+        g.pop("user_lookups", None)
+
+
+def _user_lookups():
+    """user_id → User (None for no such user) of the current request, None outside of requests."""
+    if not has_request_context():
+        return None
+    if "user_lookups" not in g:
+        g.user_lookups = {}
+    return g.user_lookups
 
 
 class UserService:
@@ -46,7 +70,6 @@ class UserService:
         # Generate a new session ID
         session_id = str(uuid.uuid4())
         user.session_id = session_id
-        user.is_online = True
         
         try:
             db.session.commit()
@@ -61,7 +84,6 @@ class UserService:
             return {"error": "Session not found"}  # Not Found
         
         user.session_id = None
-        user.is_online = False
         
         try:
             db.session.commit()
@@ -71,12 +93,11 @@ class UserService:
             return {"error": f"An unexpected error occurred during logout: {e}"}  # Internal error
     
     def logout_user_by_user_id(self, user_id):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}  # Not Found
         
         user.session_id = None
-        user.is_online = False
         
         try:
             db.session.commit()
@@ -86,31 +107,33 @@ class UserService:
             return {"error": f"An unexpected error occurred during logout: {e}"}  # Internal error
         
     def change_username(self, user_id, new_username):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}
         user.username = new_username
         try:
             db.session.commit()
+            invalidation_bus.publish(USERS_CHANNEL, user_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
             return {"error": f"An unexpected error occurred: {e}"}
         
     def change_profile_picture(self, user_id, new_profile_picture):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}
         user.profile_picture = new_profile_picture
         try:
             db.session.commit()
+            invalidation_bus.publish(USERS_CHANNEL, user_id)
             return {"success": True}
         except Exception as e:
             db.session.rollback()
             return {"error": f"An unexpected error occurred: {e}"}
         
     def change_password(self, user_id, old_password, new_password):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}
         if user.password != old_password:
@@ -128,17 +151,49 @@ class UserService:
         return User.query.filter_by(session_id=session_id).first()
     
     def get_user_by_id(self, user_id):
-        return User.query.filter_by(user_id=user_id).first()
+        """
+        The user, None if there is none. A request asks the database once per user id, repeated
+        lookups (route checks, then the services) get the same object. Counted per endpoint as
+        user_lookup.hits.<endpoint> / user_lookup.misses.<endpoint>.
+        """
+        lookups = _user_lookups()
+        if lookups is None:
+            return User.query.filter_by(user_id=user_id).first()
+
+        endpoint = request.endpoint or "socketio"
+        if user_id in lookups:
+            metrics.incr(f"user_lookup.hits.{endpoint}")
+            return lookups[user_id]
+        metrics.incr(f"user_lookup.misses.{endpoint}")
+        lookups[user_id] = User.query.filter_by(user_id=user_id).first()
+        return lookups[user_id]
     
+    def get_profile_cards(self, user_ids):
+        """{user_id: ProfileCard} of the existing users among user_ids, see app/services/profile_cards.py."""
+        return profile_cards.cards(user_ids, self._load_profile_cards)
+
+    def get_profile_card(self, user_id):
+        """The ProfileCard of a user, None if there is no such user."""
+        return self.get_profile_cards([user_id]).get(user_id)
+
+    def user_dicts(self, users):
+        """User.to_dict of every user plus is_online, from one presence store lookup."""
+        online = get_presence_store().online([user.user_id for user in users])
+        return [{**user.to_dict(), "is_online": user.user_id in online} for user in users]
+
     def get_all_users_by_word(self, word):
         try:
-            users = User.query.filter(User.username.ilike(f"{word}%")).limit(20).all()
+            users = [ProfileCard(*row) for row in
+                     db.session.query(User.user_id, User.username, User.profile_picture)
+                     .filter(User.username.ilike(f"{word}%")).limit(20).all()]
+            online = get_presence_store().online([user.user_id for user in users])
             result = []
             for user in users:
                 result.append({
                     "user_id": user.user_id,
                     "username": user.username,
-                    "profile_picture": user.profile_picture
+                    "profile_picture": user.profile_picture,
+                    "is_online": user.user_id in online
                 })
             return result
         except Exception as e:
@@ -149,10 +204,10 @@ class UserService:
         return User.query.filter_by(username=username).first()
 
     def does_user_exist(self, user_id):
-        return User.query.filter_by(user_id=user_id).first() is not None
+        return self.get_user_by_id(user_id) is not None
 
     def get_user_streak(self, user_id):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}
 
@@ -163,7 +218,7 @@ class UserService:
         return streak
     
     def get_user_points(self, user_id):
-        user = User.query.filter_by(user_id=user_id).first()
+        user = self.get_user_by_id(user_id)
         if not user:
             return {"error": "User not found"}
         return user.points
@@ -171,4 +226,13 @@ class UserService:
     def update_streak(user_id):
         pass
 
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _load_profile_cards(self, user_ids):
+        return [ProfileCard(*row) for row in
+                db.session.query(User.user_id, User.username, User.profile_picture)
+                .filter(User.user_id.in_(user_ids)).all()]
+
 
@@ -0,0 +1,63 @@
+"""
+LRU map whose loads can race with invalidations.
+
+The in-process caches (group directory, profile cards, active items) load an
+entry outside their lock and store it afterwards. Every invalidation of a key
+bumps its version, and an invalidation of everything bumps the epoch. A load
+takes stamp(key) before it starts and store() keeps the result only if the
+stamp is still current, so a load that raced with an invalidation is never
+served.
+
+Not thread-safe on its own: the caches call it while holding their lock.
+"""
+from collections import OrderedDict
+
+
+class VersionedLRU:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key → value, least recently used first
+        self._versions = {}            # key → invalidations so far, only while loads could race
+        self._epoch = 0                # invalidations of everything
+
+    def get(self, key):
+        """The value of key (now most recently used), None on a miss."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """The value of key without touching the LRU order, None on a miss."""
+        return self._entries.get(key)
+
+    def stamp(self, key):
+        """Version of key, taken before loading it."""
+        return self._epoch, self._versions.get(key, 0)
+
+    def store(self, key, value, stamp):
+        """Keep a loaded value unless key was invalidated since stamp. Returns whether it was kept."""
+        if stamp != self.stamp(key):
+            return False
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key=None):
+        """Forget key, or everything for None."""
+        if key is None:
+            self._entries.clear()
+            self._versions.clear()
+            self._epoch += 1
+        else:
+            self._entries.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            if len(self._versions) > self.max_size:
+                # bounded: forgetting the stamps turns away the loads in flight instead
+                self._versions.clear()
+                self._epoch += 1
+
+    def __len__(self):
+        return len(self._entries)
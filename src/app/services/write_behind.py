@@ -0,0 +1,162 @@
+"""
+Write-behind (group commit) queue for the send path.
+
+With MESSAGE_WRITE_BEHIND enabled, SendService validates a message in the
+request and hands the write of the whole send (message, conversation rows,
+streak, points, contact rows) to this queue as one job instead of committing it
+on its own. A background writer collects up to WRITE_BEHIND_MAX_BATCH jobs or
+waits WRITE_BEHIND_FLUSH_MS, runs them in its own session and commits the whole
+batch in one transaction. If the batch fails, its jobs are run again one by one,
+each in its own transaction, so a bad send only fails itself and never leaves
+half of its rows behind. Every job gets a Future with its result once it is
+committed, so callers can either wait for durability or accept the few
+milliseconds window.
+
+Counters: write_behind.messages, write_behind.failed; summaries:
+write_behind.batch_size, write_behind.commit_ms; gauge: write_behind.queue_depth.
+"""
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from app import db
+from app.metrics import metrics
+
+_STOP = object()
+_create_lock = threading.Lock()
+
+
+class WriteBehindQueue:
+    def __init__(self, app, max_batch=200, flush_interval=0.005):
+        self.app = app
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="message-write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        """
+        Queue a write. job() runs on the writer's session and must not commit; it may run
+        again if its batch fails. Returns a Future with job()'s result, resolved on commit.
+        """
+        if self._stopped:
+            raise RuntimeError("Write-behind queue is stopped")
+
+        future = Future()
+        self._queue.put((job, future))
+        metrics.set_gauge("write_behind.queue_depth", self._queue.qsize())
+        return future
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far is committed (or failed)."""
+        marker = Future()
+        self._queue.put((None, marker))
+        marker.result(timeout=timeout)
+
+    def stop(self, timeout=10):
+        """Flush the queue and stop the writer. Registered with atexit."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                stop = False
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+
+                self._write(batch)
+                if stop:
+                    self._drain()
+                    return
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        for start in range(0, len(batch), self.max_batch):
+            self._write(batch[start:start + self.max_batch])
+
+    def _write(self, batch):
+        # flush() markers carry no job, they resolve once everything before them is written
+        jobs = [(job, future) for job, future in batch if job is not None]
+        markers = [future for job, future in batch if job is None]
+
+        if jobs and not self._commit(jobs) and len(jobs) > 1:
+            # one bad send must not fail the whole batch: the others are written one by one
+            for job in jobs:
+                self._commit([job])
+
+        for future in markers:
+            future.set_result(None)
+        metrics.set_gauge("write_behind.queue_depth", self._queue.qsize())
+
+    def _commit(self, jobs):
+        """Run the jobs and commit them in one transaction. False if it failed."""
+        started = time.monotonic()
+        try:
+            results = [job() for job, _ in jobs]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Write-behind batch of {len(jobs)} sends failed: {e}")
+            if len(jobs) == 1:
+                metrics.incr("write_behind.failed")
+                jobs[0][1].set_exception(e)
+            return False
+        else:
+            metrics.incr("write_behind.messages", len(jobs))
+            metrics.observe("write_behind.batch_size", len(jobs))
+            metrics.observe("write_behind.commit_ms", (time.monotonic() - started) * 1000)
+            for (_, future), result in zip(jobs, results):
+                future.set_result(result)
+            return True
+        finally:
+            db.session.remove()
+
+
+def get_write_behind(app):
+    """The app's write-behind queue, started on first use and flushed at interpreter exit."""
+    with _create_lock:
+        write_behind = app.extensions.get("message_write_behind")
+        if write_behind is None:
+            write_behind = WriteBehindQueue(
+                app,
+                max_batch=app.config["WRITE_BEHIND_MAX_BATCH"],
+                flush_interval=app.config["WRITE_BEHIND_FLUSH_MS"] / 1000
+            )
+            app.extensions["message_write_behind"] = write_behind
+            atexit.register(write_behind.stop)
+        return write_behind
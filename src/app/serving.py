@@ -0,0 +1,63 @@
+"""
+Production serving on green threads (eventlet or gevent), see src/serve.py.
+
+Sockets are cooperative once the process is monkey patched, but the database
+drivers are C code: a sqlite3 (or psycopg2) query blocks the whole event loop,
+and with it every websocket of the worker, until it returns. `offload_database`
+runs every DB-API call of the app's engines in a bounded pool of real threads
+(DB_THREADS), so a slow query holds one pool thread instead of the loop.
+"""
+from sqlalchemy import event
+
+from app import db
+
+
+class OffloadedDBAPI:
+    """A DB-API connection (or cursor) whose method calls run in the thread pool."""
+
+    def __init__(self, target, run):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_run", run)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value  # description, rowcount, lastrowid, ...
+
+        def call(*args, **kwargs):
+            result = self._run(value, *args, **kwargs)
+            return OffloadedDBAPI(result, self._run) if name == "cursor" else result
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+
+def thread_pool_runner(mode, threads):
+    """run(fn, *args, **kwargs) in a pool of `threads` real threads, for the given async mode."""
+    if mode == "eventlet":
+        from eventlet import tpool
+
+        tpool.set_num_threads(threads)
+        return tpool.execute
+    if mode == "gevent":
+        from gevent.threadpool import ThreadPool
+
+        pool = ThreadPool(threads)
+        return lambda fn, *args, **kwargs: pool.apply(fn, args, kwargs)
+    raise ValueError(f"Unknown async mode: {mode}")
+
+
+def offload_database(app, mode, threads):
+    """Make new connections of all engines of the app run their calls in the thread pool."""
+    run = thread_pool_runner(mode, threads)
+
+    def connect(dialect, connection_record, cargs, cparams):
+        if dialect.name == "sqlite":
+            cparams["check_same_thread"] = False  # the pool threads take turns on a connection
+        return OffloadedDBAPI(run(dialect.loaded_dbapi.connect, *cargs, **cparams), run)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "do_connect", connect)
+            engine.dispose()  # connections opened before (migrations) are not offloaded
@@ -0,0 +1,110 @@
+"""
+Connect admission: what handle_connect checks before a connection is accepted.
+
+After a deploy every client reconnects at once. New connections are admitted by a
+token bucket (CONNECT_RATE per second, bursts up to CONNECT_BURST per worker), the
+others are refused as "busy" and come back with the client's reconnect backoff.
+A verified token is decoded once per worker and its identity kept until the token
+expires, and the user behind it is looked up in a cache of known users instead of
+the user table. Presence of the admitted users is written in batches by the
+presence flusher, see websockets.py.
+
+Counters: connect.admitted, connect.rejected, connect.identity_hits/_misses,
+connect.user_hits/_misses.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import metrics
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate    # tokens per second
+        self.burst = burst  # bucket size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = clock()
+
+    def try_acquire(self):
+        """Take a token if there is one."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class IdentityCache:
+    """token → user_id of verified tokens, until the token expires."""
+
+    def __init__(self, decode, max_size=50000, clock=time.time):
+        self.decode = decode  # decode(token) → claims, raises for invalid or expired tokens
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._identities = OrderedDict()  # token → (user_id, exp), least recently used first
+
+    def identity(self, token):
+        with self._lock:
+            cached = self._identities.get(token)
+            if cached is not None and cached[1] > self.clock():
+                self._identities.move_to_end(token)
+                metrics.incr("connect.identity_hits")
+                return cached[0]
+
+        metrics.incr("connect.identity_misses")
+        claims = self.decode(token)
+        with self._lock:
+            self._identities[token] = (claims["sub"], claims.get("exp", 0))
+            while len(self._identities) > self.max_size:
+                self._identities.popitem(last=False)
+        return claims["sub"]
+
+    def clear(self):
+        with self._lock:
+            self._identities.clear()
+
+
+class KnownUsers:
+    """user_id → username of existing users, for ttl seconds or until invalidated."""
+
+    def __init__(self, loader, ttl=300, max_size=100000, clock=time.monotonic):
+        self.loader = loader  # loader(user_id) → username, None if there is no such user
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # user_id → (username, loaded_at)
+
+    def username(self, user_id):
+        """The username, None for an unknown user (not cached, so a new user is found right away)."""
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None and self.clock() - cached[1] < self.ttl:
+                self._users.move_to_end(user_id)
+                metrics.incr("connect.user_hits")
+                return cached[0]
+
+        metrics.incr("connect.user_misses")
+        username = self.loader(user_id)
+        if username is not None:
+            with self._lock:
+                self._users[user_id] = (username, self.clock())
+                self._users.move_to_end(user_id)
+                while len(self._users) > self.max_size:
+                    self._users.popitem(last=False)
+        return username
+
+    def invalidate(self, user_id=None):
+        """Forget a user, or everybody for None."""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
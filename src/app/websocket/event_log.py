@@ -0,0 +1,222 @@
+"""
+Event log for missed-event replay.
+
+Every new_message, chat_change and item_used emit gets a sequence number (one
+counter for the whole log, so the numbers only grow) and is kept in a bounded log
+per room: the user room of the recipient or the group room. A reconnecting client
+sends the last seq it has seen and gets the events of its rooms after that seq,
+or "resync required" if some of them were already dropped from the log.
+
+The local log lives in memory (EVENT_LOG_RETENTION events per room, at most
+EVENT_LOG_MAX_ROOMS rooms). With EVENT_LOG_URL (or a redis SOCKETIO_MESSAGE_QUEUE)
+the log is kept in Redis and shared by all workers.
+"""
+import json
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+
+class LocalEventLog:
+    def __init__(self, retention=200, max_rooms=100000):
+        self.retention = retention
+        self.max_rooms = max_rooms
+        self.epoch = uuid.uuid4().hex  # a client with another epoch has seqs of an earlier log
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._floor = 0  # newest seq of the rooms that were evicted completely
+        self._rooms = OrderedDict()  # room → {"events": deque of (seq, event, data, skip_user_id), "trimmed": seq}
+
+    def append(self, rooms, event, data, skip_user_id=None):
+        """Log an event in the given rooms, returns its seq."""
+        with self._lock:
+            self._seq += 1
+            entry = (self._seq, event, data, skip_user_id)
+            for room in rooms:
+                log = self._rooms.get(room)
+                if log is None:
+                    # the room may have been evicted before: its older events are gone
+                    log = self._rooms[room] = {"events": deque(), "trimmed": self._floor}
+                self._rooms.move_to_end(room)
+                log["events"].append(entry)
+                while len(log["events"]) > self.retention:
+                    log["trimmed"] = log["events"].popleft()[0]
+
+            while len(self._rooms) > self.max_rooms:
+                _, evicted = self._rooms.popitem(last=False)
+                self._floor = max(self._floor, evicted["events"][-1][0])
+            return self._seq
+
+    def since(self, starts, user_id):
+        """
+        The events after the start seq of every room, oldest first.
+
+        Args:
+            starts: room → seq the client has seen in that room
+            user_id: events that skipped this user (its own group messages) are left out
+
+        Returns:
+            tuple: (list of (seq, event, data), resync_required)
+        """
+        events = {}
+        with self._lock:
+            for room, start in starts.items():
+                log = self._rooms.get(room)
+                if log is None:
+                    if start < self._floor:
+                        return [], True
+                    continue
+                if log["trimmed"] > start:
+                    return [], True
+                for seq, event, data, skip_user_id in log["events"]:
+                    if seq > start and skip_user_id != user_id:
+                        events[seq] = (seq, event, data)
+        return [events[seq] for seq in sorted(events)], False
+
+    def latest(self):
+        with self._lock:
+            return self._seq
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._floor = 0
+
+
+class RedisEventLog:
+    """
+    The log in Redis: one list per room, trimmed to `retention`, and the seq of its
+    newest dropped entry. Both keys expire together, `ttl` (plus one bucket) after
+    the last event of the room.
+
+    Events that are gone with an expired room are covered by a floor: a list of
+    marks, the newest seq of every BUCKET_S seconds with events. Marks older than
+    `ttl` are folded into the floor key, so every room that expired has its events
+    below the floor. A missing room is a resync for a client behind the floor, and
+    a recreated room starts with the floor as its dropped seq.
+    """
+
+    BUCKET_S = 60
+
+    FLOOR = """
+    local function floor_seq(marks_key, floor_key, now, ttl, bucket_s)
+        local floor = tonumber(redis.call('GET', floor_key) or '0')
+        while true do
+            local oldest = redis.call('LINDEX', marks_key, 0)
+            if not oldest then break end
+            local bucket, mark = string.match(oldest, '^(%d+)|(%d+)$')
+            if (tonumber(bucket) + 1) * bucket_s > now - ttl then break end
+            redis.call('LPOP', marks_key)
+            floor = math.max(floor, tonumber(mark))
+            redis.call('SET', floor_key, floor)
+        end
+        return floor
+    end
+    """
+
+    APPEND = FLOOR + """
+    local seq = redis.call('INCR', KEYS[1])
+    local retention = tonumber(ARGV[1])
+    local ttl = tonumber(ARGV[2])
+    local bucket_s = tonumber(ARGV[4])
+    local entry = seq .. '|' .. ARGV[3]
+    local now = tonumber(redis.call('TIME')[1])
+    local floor = floor_seq(KEYS[2], KEYS[3], now, ttl, bucket_s)
+
+    local bucket = math.floor(now / bucket_s)
+    local newest = redis.call('LINDEX', KEYS[2], -1)
+    if newest and tonumber(string.match(newest, '^(%d+)|')) == bucket then
+        redis.call('LSET', KEYS[2], -1, bucket .. '|' .. seq)
+    else
+        redis.call('RPUSH', KEYS[2], bucket .. '|' .. seq)
+    end
+
+    for i = 4, #KEYS, 2 do
+        if redis.call('RPUSH', KEYS[i], entry) == 1 then
+            -- new or recreated list: whatever it had before is below the floor
+            redis.call('SET', KEYS[i + 1], math.max(floor, tonumber(redis.call('GET', KEYS[i + 1]) or '0')))
+        elseif redis.call('LLEN', KEYS[i]) > retention then
+            local dropped = redis.call('LPOP', KEYS[i])
+            redis.call('SET', KEYS[i + 1], string.match(dropped, '^(%d+)|'))
+        end
+        redis.call('EXPIRE', KEYS[i], ttl + bucket_s)
+        redis.call('EXPIRE', KEYS[i + 1], ttl + bucket_s)
+    end
+    return seq
+    """
+
+    CURRENT_FLOOR = FLOOR + """
+    local now = tonumber(redis.call('TIME')[1])
+    return floor_seq(KEYS[1], KEYS[2], now, tonumber(ARGV[1]), tonumber(ARGV[2]))
+    """
+
+    def __init__(self, url, retention=200, ttl=3 * 86400, prefix="umoc:events"):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.retention = retention
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis.set(f"{prefix}:epoch", uuid.uuid4().hex, nx=True)
+        self.epoch = self.redis.get(f"{prefix}:epoch")
+        self._append = self.redis.register_script(self.APPEND)
+        self._floor = self.redis.register_script(self.CURRENT_FLOOR)
+
+    def append(self, rooms, event, data, skip_user_id=None):
+        keys = [f"{self.prefix}:seq", f"{self.prefix}:marks", f"{self.prefix}:floor"]
+        for room in rooms:
+            keys += [self._key(room, "log"), self._key(room, "trimmed")]
+        payload = json.dumps({"event": event, "data": data, "skip": skip_user_id})
+        return int(self._append(keys=keys, args=[self.retention, self.ttl, payload, self.BUCKET_S]))
+
+    def since(self, starts, user_id):
+        rooms = list(starts)
+        pipe = self.redis.pipeline(transaction=False)
+        self._floor(keys=[f"{self.prefix}:marks", f"{self.prefix}:floor"], args=[self.ttl, self.BUCKET_S],
+                    client=pipe)
+        for room in rooms:
+            pipe.lrange(self._key(room, "log"), 0, -1)
+            pipe.get(self._key(room, "trimmed"))
+        results = pipe.execute()
+        floor = int(results[0] or 0)
+
+        events = {}
+        for i, room in enumerate(rooms):
+            entries, trimmed = results[1 + 2 * i:3 + 2 * i]
+            start = starts[room]
+            if not entries:
+                if start < floor:
+                    return [], True  # the room expired with events the client did not see
+                continue
+            if int(trimmed or 0) > start:
+                return [], True  # dropped by retention, or before the list was recreated
+            for entry in entries:
+                seq, payload = entry.split("|", 1)
+                seq = int(seq)
+                if seq > start:
+                    payload = json.loads(payload)
+                    if payload["skip"] != user_id:
+                        events[seq] = (seq, payload["event"], payload["data"])
+        return [events[seq] for seq in sorted(events)], False
+
+    def latest(self):
+        return int(self.redis.get(f"{self.prefix}:seq") or 0)
+
+    def clear(self):
+        keys = [key for key in self.redis.scan_iter(f"{self.prefix}:*") if not key.endswith(":epoch")]
+        if keys:
+            self.redis.delete(*keys)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _key(self, room, kind):
+        return f"{self.prefix}:{room}:{kind}"
+
+
+def create_event_log(app):
+    url = app.config.get("EVENT_LOG_URL") or app.config.get("SOCKETIO_MESSAGE_QUEUE")
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisEventLog(url, app.config["EVENT_LOG_RETENTION"], app.config["EVENT_LOG_TTL_S"])
+    return LocalEventLog(app.config["EVENT_LOG_RETENTION"], app.config["EVENT_LOG_MAX_ROOMS"])
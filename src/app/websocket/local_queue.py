@@ -0,0 +1,200 @@
+"""
+Local stand-in for the Socket.IO message queue, for development and tests.
+
+    SOCKETIO_MESSAGE_QUEUE=local://127.0.0.1:6499
+    LOCAL_QUEUE_KEY=<shared secret>
+
+Every worker publishes its emits, room changes and cache invalidations to a small
+broker process, which relays them to the workers subscribed to the channel, the
+same way Redis pub/sub does in production (SOCKETIO_MESSAGE_QUEUE=redis://...).
+Start the broker once, with the same LOCAL_QUEUE_KEY in its environment:
+
+    python -m app.websocket.local_queue 6499
+
+The broker only listens on 127.0.0.1. Frames are length-prefixed JSON (never
+pickle), and a connection is only served after it answered the broker's
+challenge with an HMAC of the key.
+"""
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import secrets
+import socket
+import struct
+import sys
+import threading
+from urllib.parse import urlparse
+
+import socketio
+
+HOST = "127.0.0.1"
+MAX_FRAME = 16 * 1024 * 1024  # bytes, bigger frames close the connection
+_HEADER = struct.Struct("!I")
+
+
+def parse_url(url):
+    """(host, port) of a local:// URL, the host has to be a loopback address."""
+    parsed = urlparse(url)
+    host = parsed.hostname or HOST
+    if host != "localhost" and not ipaddress.ip_address(host).is_loopback:
+        raise ValueError(f"The local queue only runs on localhost, not on {host}")
+    return host, parsed.port or 6499
+
+
+def send_frame(sock, data):
+    payload = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """The next JSON frame, EOFError once the connection is closed."""
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_FRAME:
+        raise EOFError(f"frame of {size} bytes")
+    try:
+        return json.loads(_recv_exactly(sock, size))
+    except ValueError as e:
+        raise EOFError(f"invalid frame: {e}") from e
+
+
+class LocalBroker:
+    """Relays every published message to the subscribers of its channel."""
+
+    def __init__(self, port=6499, key=None):
+        if not key:
+            raise ValueError("LOCAL_QUEUE_KEY is not set")
+        self.key = key.encode("utf-8")
+        self.listener = socket.create_server((HOST, port))
+        self.address = self.listener.getsockname()
+        self._lock = threading.Lock()
+        self._subscribers = {}  # channel → sockets
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.listener.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _serve(self, conn):
+        try:
+            hello = self._authenticate(conn)
+            if hello is None:
+                conn.close()
+                return
+            channel = str(hello.get("channel"))
+            if hello.get("role") == "subscribe":
+                with self._lock:
+                    self._subscribers.setdefault(channel, []).append(conn)
+                    send_frame(conn, {"ok": True})
+                return  # subscribers only receive
+            send_frame(conn, {"ok": True})
+            while True:
+                self._relay(channel, recv_frame(conn))
+        except (EOFError, OSError):
+            conn.close()
+
+    def _authenticate(self, conn):
+        """The client's hello frame if it answered the challenge with the key, else None."""
+        challenge = secrets.token_hex(16)
+        send_frame(conn, {"challenge": challenge})
+        hello = recv_frame(conn)
+        if not isinstance(hello, dict):
+            return None
+        expected = _digest(self.key, challenge)
+        if not hmac.compare_digest(expected, str(hello.get("digest", ""))):
+            return None
+        return hello
+
+    def _relay(self, channel, data):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, [])
+            for subscriber in list(subscribers):
+                try:
+                    send_frame(subscriber, data)
+                except OSError:
+                    subscribers.remove(subscriber)
+
+
+def run_broker(port=6499, key=None, ready=None):
+    broker = LocalBroker(port, key)
+    if ready is not None:
+        ready.set()
+    broker.serve_forever()
+
+
+def connect(address, key, role, channel):
+    """An authenticated connection to the broker, as publisher or subscriber of channel."""
+    if not key:
+        raise ValueError("LOCAL_QUEUE_KEY is not set")
+    sock = socket.create_connection(address)
+    try:
+        challenge = recv_frame(sock)["challenge"]
+        send_frame(sock, {"role": role, "channel": channel, "digest": _digest(key.encode("utf-8"), challenge)})
+        recv_frame(sock)  # the broker's confirmation, it closes the connection on a wrong key
+    except (EOFError, KeyError, TypeError) as e:
+        sock.close()
+        raise ConnectionError(f"The local queue refused the connection: {e}") from e
+    return sock
+
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """Client manager for the local broker, used instead of RedisManager for local:// URLs."""
+    name = "local"
+
+    def __init__(self, url="local://127.0.0.1:6499", channel="flask-socketio", write_only=False, logger=None,
+                 key=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = parse_url(url)
+        self.key = key
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        self.subscribed = threading.Event()  # set once this worker receives the messages of the others
+
+    def _publish(self, data):
+        with self._publish_lock:
+            if self._publisher is None:
+                self._publisher = connect(self.address, self.key, "publish", self.channel)
+            try:
+                send_frame(self._publisher, data)
+            except OSError:
+                # broker restarted, retry once
+                self._publisher = connect(self.address, self.key, "publish", self.channel)
+                send_frame(self._publisher, data)
+
+    def _listen(self):
+        conn = connect(self.address, self.key, "subscribe", self.channel)
+        self.subscribed.set()
+        while True:
+            yield recv_frame(conn)  # a dict, so PubSubManager never tries to unpickle it
+
+
+##############################
+## HELPER FUNCTIONS
+##############################
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _digest(key, challenge):
+    return hmac.new(key, challenge.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+if __name__ == "__main__":
+    queue_port = int(sys.argv[1]) if len(sys.argv) > 1 else 6499
+    queue_key = os.getenv("LOCAL_QUEUE_KEY")
+    if not queue_key:
+        sys.exit("Set LOCAL_QUEUE_KEY, the workers need the same key")
+    print(f"Local Socket.IO message queue on {HOST}:{queue_port}")
+    run_broker(queue_port, queue_key)
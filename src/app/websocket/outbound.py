@@ -0,0 +1,212 @@
+"""
+Outbound queues: a bounded queue per connection between the emits and Socket.IO.
+
+python-socketio hands every emit to the Engine.IO socket of the recipient, whose
+queue has no limit: a burst of events (a big group fan-out, typing storms, a
+replay) lands there at once. Here the client manager (OutboundManager, the
+client_manager of the Socket.IO server) routes the emits of every connection
+through its own queue instead. A connection gets at most OUTBOUND_BURST events
+per flush interval (OUTBOUND_INTERVAL_MS); the rest waits in its queue of at
+most OUTBOUND_QUEUE_SIZE events, which a background flusher sends in the next
+intervals. An emit only appends, it never waits for a client.
+
+Events have priorities by name: new_message, chat_change and all other events
+first, then item_used and presence_diff, then receive_char. A full queue drops
+its lowest priority events first (the oldest of them). A connection whose full
+queue holds first priority events only, or that has been backlogged for
+OUTBOUND_SLOW_S, is disconnected: it reconnects and gets the missed messages
+from the event log. Clients whose link stalled entirely are dropped by the
+Engine.IO ping timeout.
+
+Metrics: outbound.queued, outbound.dropped, outbound.disconnected and the gauges
+outbound.backlogged (connections with queued events), outbound.depth (queued
+events of all of them), outbound.depth_max and outbound.depth_top (the deepest
+`top` connections as user_id and depth). Sids are never exposed.
+"""
+import heapq
+import threading
+import time
+from collections import deque
+
+import socketio
+
+from app.metrics import metrics
+
+HIGH, ITEMS, TYPING = 0, 1, 2
+PRIORITIES = {'item_used': ITEMS, 'presence_diff': ITEMS, 'receive_char': TYPING}
+
+
+def priority_of(event):
+    return PRIORITIES.get(event, HIGH)
+
+
+class _Connection:
+    def __init__(self, budget):
+        self.queues = (deque(), deque(), deque())  # one per priority, of (event, data, namespace)
+        self.count = 0
+        self.budget = budget          # events it may still be sent in this interval
+        self.sending = False          # a flush is sending a batch, new events queue behind it
+        self.backlogged_since = None  # since when it has queued events
+
+    def pop(self):
+        for queue in self.queues:
+            if queue:
+                self.count -= 1
+                return queue.popleft()
+        return None
+
+
+class OutboundQueues:
+    def __init__(self, send, disconnect, user_of, size=256, burst=32, slow_after=10.0, interval=0.05, top=10,
+                 clock=time.monotonic):
+        self.send = send              # send(sid, event, data, namespace), OutboundManager.deliver
+        self.disconnect = disconnect  # disconnect(sid)
+        self.user_of = user_of        # user_of(sid) → user_id, for the depth_top gauge
+        self.size = size
+        self.burst = burst
+        self.slow_after = slow_after
+        self.interval = interval
+        self.top = top
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._connections = {}  # sid → _Connection, only while it got events in this interval
+
+    def submit(self, sid, event, data, namespace='/'):
+        """Send an event now if the connection has budget left, else queue it."""
+        send_now = False
+        with self._lock:
+            connection = self._connections.get(sid)
+            if connection is None:
+                connection = self._connections[sid] = _Connection(self.burst)
+            if not connection.count and not connection.sending and connection.budget > 0:
+                connection.budget -= 1
+                send_now = True
+            else:
+                if connection.backlogged_since is None:
+                    connection.backlogged_since = self.clock()
+                if self._enqueue(connection, priority_of(event), (event, data, namespace)):
+                    return
+                self._connections.pop(sid, None)
+
+        # outside the lock: a send can close a timed out socket and run the disconnect handler
+        if send_now:
+            self.send(sid, event, data, namespace)
+        else:
+            self._disconnect(sid)
+
+    def flush(self):
+        """Start a new interval: send queued events within the budget, disconnect the chronically backlogged."""
+        now = self.clock()
+        batches = []
+        slow = []
+        with self._lock:
+            for sid, connection in list(self._connections.items()):
+                if connection.count and now - connection.backlogged_since > self.slow_after:
+                    del self._connections[sid]
+                    slow.append(sid)
+                    continue
+                batch = [connection.pop() for _ in range(min(self.burst, connection.count))]
+                connection.budget = self.burst - len(batch)
+                if batch:
+                    connection.sending = True
+                    batches.append((sid, batch))
+                elif not connection.count:
+                    del self._connections[sid]  # idle, it starts the next interval with the full budget
+
+        for sid, batch in batches:
+            for event, data, namespace in batch:
+                self.send(sid, event, data, namespace)
+        with self._lock:
+            for sid, _ in batches:
+                connection = self._connections.get(sid)
+                if connection is not None:
+                    connection.sending = False
+                    if not connection.count:
+                        connection.backlogged_since = None
+            depths = {sid: connection.count for sid, connection in self._connections.items() if connection.count}
+
+        metrics.set_gauge("outbound.backlogged", len(depths))
+        metrics.set_gauge("outbound.depth", sum(depths.values()))
+        metrics.set_gauge("outbound.depth_max", max(depths.values(), default=0))
+        deepest = heapq.nlargest(self.top, depths.items(), key=lambda item: item[1])
+        metrics.set_gauge("outbound.depth_top", [{"user_id": self.user_of(sid), "depth": depth} for sid, depth in deepest])
+        for sid in slow:
+            self._disconnect(sid)
+        return sum(len(batch) for _, batch in batches)
+
+    def forget(self, sid):
+        with self._lock:
+            self._connections.pop(sid, None)
+
+    def capacity(self):
+        """Events a connection can take at once without being disconnected: the burst plus the queue."""
+        return self.burst + self.size
+
+    def depth(self, sid):
+        with self._lock:
+            connection = self._connections.get(sid)
+            return connection.count if connection else 0
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _enqueue(self, connection, priority, item):
+        """Queue an event, making room by dropping. False if there is no room (all first priority)."""
+        metrics.incr("outbound.queued")
+        if connection.count >= self.size:
+            lowest = max(p for p, queue in enumerate(connection.queues) if queue)
+            if lowest < priority:
+                metrics.incr("outbound.dropped")
+                return True  # the new event is the least important one
+            if lowest == HIGH:
+                return False
+            connection.queues[lowest].popleft()
+            connection.count -= 1
+            metrics.incr("outbound.dropped")
+        connection.queues[priority].append(item)
+        connection.count += 1
+        return True
+
+    def _disconnect(self, sid):
+        metrics.incr("outbound.disconnected")
+        try:
+            self.disconnect(sid)
+        except Exception as e:
+            print(f"Disconnecting slow client failed: {e}")
+
+
+class OutboundManager(socketio.Manager):
+    """
+    Client manager whose emits to connections go through the outbound queues. Emits with
+    a callback (acks) are sent directly. Other managers get it mixed in behind them with
+    outbound_manager(), so the emits that arrive from other workers take the same path.
+    """
+    outbound = None
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if self.outbound is None or callback is not None:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        if namespace not in self.rooms:
+            return None
+        skip_sid = skip_sid if isinstance(skip_sid, list) else [skip_sid]
+        for sid, _ in list(self.get_participants(namespace, room)):
+            if sid not in skip_sid:
+                self.outbound.submit(sid, event, data, namespace)
+        return None
+
+    def deliver(self, sid, event, data, namespace):
+        """Hand a queued event of a connection to Socket.IO."""
+        super().emit(event, data, namespace, room=sid)
+
+
+def outbound_manager(manager_class):
+    """A subclass of the client manager manager_class that delivers through the outbound queues."""
+    if manager_class is socketio.Manager:
+        return OutboundManager
+    return type(f"Outbound{manager_class.__name__}", (manager_class, OutboundManager), {})
@@ -0,0 +1,47 @@
+"""
+Presence broadcasting.
+
+Online/offline transitions are collected and sent every PRESENCE_INTERVAL_MS as
+one `presence_diff` frame per recipient. Recipients are the users that have the
+person as a contact or share a group with them, and are connected themselves.
+Several transitions of a user within one interval collapse into the last one,
+so a reconnect storm costs at most one frame per recipient and interval.
+
+Counters: presence.transitions, presence.frames.
+"""
+import threading
+from collections import defaultdict
+
+from app.metrics import metrics
+
+
+class PresenceBroadcaster:
+    def __init__(self, audience, send, interval=0.5):
+        self.audience = audience  # audience(user_ids) → {user_id: set of recipient user_ids}
+        self.send = send          # send(recipient_id, changes)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._changes = {}        # user_id → latest change in this interval
+
+    def changed(self, user_id, username, status):
+        metrics.incr("presence.transitions")
+        with self._lock:
+            self._changes[user_id] = {'user_id': user_id, 'username': username, 'status': status}
+
+    def flush(self):
+        """Send the collected transitions, returns the number of frames."""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return 0
+
+        frames = defaultdict(list)
+        for user_id, recipients in self.audience(list(changes)).items():
+            for recipient_id in recipients:
+                if recipient_id != user_id:
+                    frames[recipient_id].append(changes[user_id])
+
+        for recipient_id, recipient_changes in frames.items():
+            self.send(recipient_id, recipient_changes)
+        metrics.incr("presence.frames", len(frames))
+        return len(frames)
@@ -0,0 +1,177 @@
+"""
+Connection registry: which Socket.IO connections (sids) belong to which user.
+
+With a single worker the in-memory registry is enough. With several workers
+(SOCKETIO_MESSAGE_QUEUE set) every worker has to see the connections of the
+others, e.g. to put all devices of a user into a group room or to skip the
+sender's devices, so the registry lives in Redis.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+class ConnectionRegistry(ABC):
+    """Interface of the connection registry."""
+    ttl = None  # seconds a connection stays registered without refresh(), None = until removed
+
+    @abstractmethod
+    def add(self, user_id, sid):
+        """Register a connection. Returns True if it is the first connection of the user."""
+
+    @abstractmethod
+    def remove(self, sid):
+        """Forget a connection. Returns (user_id, last) where last is True if the user has no connection left."""
+
+    @abstractmethod
+    def sids(self, user_id):
+        """All connections of a user, on every worker."""
+
+    @abstractmethod
+    def user_of(self, sid):
+        """The user of a connection, None if it is unknown."""
+
+    @abstractmethod
+    def clear(self):
+        """Forget all connections."""
+
+    def refresh(self, connections):
+        """Heartbeat of a worker for its connections (sid → user_id), needed if ttl is set."""
+
+    def is_online(self, user_id):
+        return bool(self.sids(user_id))
+
+    def online(self, user_ids):
+        """The users of user_ids that have at least one connection."""
+        return {user_id for user_id in user_ids if self.is_online(user_id)}
+
+
+class LocalConnectionRegistry(ConnectionRegistry):
+    """In-memory registry for a single worker (and the tests)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_sids = {}  # user_id → set of sids (one per device)
+        self._sid_users = {}  # sid → user_id
+
+    def add(self, user_id, sid):
+        with self._lock:
+            sids = self._user_sids.setdefault(user_id, set())
+            first = not sids
+            sids.add(sid)
+            self._sid_users[sid] = user_id
+            return first
+
+    def remove(self, sid):
+        with self._lock:
+            user_id = self._sid_users.pop(sid, None)
+            sids = self._user_sids.get(user_id)
+            if sids is None:
+                return user_id, False
+            sids.discard(sid)
+            if sids:
+                return user_id, False  # still connected on another device
+            del self._user_sids[user_id]
+            return user_id, True
+
+    def sids(self, user_id):
+        with self._lock:
+            return set(self._user_sids.get(user_id, ()))
+
+    def user_of(self, sid):
+        with self._lock:
+            return self._sid_users.get(sid)
+
+    def clear(self):
+        with self._lock:
+            self._user_sids.clear()
+            self._sid_users.clear()
+
+
+class RedisConnectionRegistry(ConnectionRegistry):
+    """
+    Registry shared by all workers.
+
+    One sorted set per user, sid → expiry time, and one key per sid holding its
+    user_id. Both expire after ttl seconds unless the worker that holds the
+    connection refreshes them (a heartbeat every ttl / 3), so the connections of a
+    crashed worker drop out after ttl, and a worker removes its own connections
+    when it shuts down. Expiry times come from the workers' clocks, which have to
+    agree to well within the ttl.
+    """
+
+    def __init__(self, url, ttl=60, prefix="umoc:connections", clock=time.time):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.clock = clock
+
+    def add(self, user_id, sid):
+        now = self.clock()
+        pipe = self.redis.pipeline()
+        self._register(pipe, user_id, sid, now)
+        pipe.zremrangebyscore(self._user_key(user_id), "-inf", now)
+        pipe.zcard(self._user_key(user_id))
+        return pipe.execute()[-1] == 1
+
+    def remove(self, sid):
+        user_id = self.redis.get(self._sid_key(sid))
+        if user_id is None:
+            return None, False
+        pipe = self.redis.pipeline()
+        pipe.delete(self._sid_key(sid))
+        pipe.zrem(self._user_key(user_id), sid)
+        pipe.zremrangebyscore(self._user_key(user_id), "-inf", self.clock())
+        pipe.zcard(self._user_key(user_id))
+        _, removed, _, count = pipe.execute()
+        return user_id, bool(removed) and count == 0
+
+    def sids(self, user_id):
+        return set(self.redis.zrangebyscore(self._user_key(user_id), f"({self.clock()}", "+inf"))
+
+    def user_of(self, sid):
+        return self.redis.get(self._sid_key(sid))
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = self.clock()
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(self._user_key(user_id), f"({now}", "+inf")
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def refresh(self, connections):
+        now = self.clock()
+        pipe = self.redis.pipeline(transaction=False)
+        for sid, user_id in connections.items():
+            self._register(pipe, user_id, sid, now)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _register(self, pipe, user_id, sid, now):
+        pipe.zadd(self._user_key(user_id), {sid: now + self.ttl})
+        pipe.expire(self._user_key(user_id), self.ttl)
+        pipe.set(self._sid_key(sid), user_id, ex=self.ttl)
+
+    def _user_key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    def _sid_key(self, sid):
+        return f"{self.prefix}:sid:{sid}"
+
+
+def create_registry(url=None, ttl=60):
+    """LocalConnectionRegistry, or the Redis one for a redis:// URL."""
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisConnectionRegistry(url, ttl)
+    return LocalConnectionRegistry()
@@ -0,0 +1,96 @@
+"""
+Typing indicator throttle.
+
+Every keystroke of a client is a `send_char` event. The throttle forwards the
+first one of a burst right away and coalesces the rest per (sender, chat) into
+at most one emit per TYPING_INTERVAL_MS. Coalesced events that could not be sent
+within TYPING_STALE_MS (the flusher is behind) are dropped, a late typing
+indicator is worse than none.
+
+Counters: typing.received, typing.forwarded, typing.coalesced, typing.dropped.
+"""
+import threading
+import time
+
+from app.metrics import metrics
+
+
+class TypingThrottle:
+    def __init__(self, send, interval=0.3, stale_after=2.0, max_pending=10000, clock=time.monotonic):
+        self.send = send  # send(payload), payload has the latest "char" and all "chars" of the burst
+        self.interval = interval
+        self.stale_after = stale_after
+        self.max_pending = max_pending
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._last_sent = {}  # (sender, chat) → time of the last emit
+        self._pending = {}    # (sender, chat) → coalesced event waiting for its slot
+
+    def submit(self, sender_id, chat_id, payload):
+        """Forward a typing event now, or merge it into the pending one of the same (sender, chat)."""
+        metrics.incr("typing.received")
+        key = (sender_id, chat_id)
+        now = self.clock()
+
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending["payload"] = payload
+                pending["chars"].append(payload["char"])
+                metrics.incr("typing.coalesced")
+                return
+
+            last_sent = self._last_sent.get(key)
+            if last_sent is not None and now - last_sent < self.interval:
+                if len(self._pending) >= self.max_pending:
+                    metrics.incr("typing.dropped")
+                    return
+                self._pending[key] = {
+                    "payload": payload,
+                    "chars": [payload["char"]],
+                    "since": now,
+                    "due": last_sent + self.interval
+                }
+                metrics.incr("typing.coalesced")
+                return
+
+            self._last_sent[key] = now
+
+        self._forward(payload, [payload["char"]])
+
+    def flush(self):
+        """Send the pending events whose slot has come, drop the stale ones."""
+        now = self.clock()
+        due = []
+        with self._lock:
+            for key, pending in list(self._pending.items()):
+                if now - pending["since"] > self.stale_after:
+                    del self._pending[key]
+                    metrics.incr("typing.dropped", len(pending["chars"]))
+                elif now >= pending["due"]:
+                    del self._pending[key]
+                    self._last_sent[key] = now
+                    due.append(pending)
+
+            # senders that stopped typing, their next event is sent right away anyway
+            for key, last_sent in list(self._last_sent.items()):
+                if now - last_sent >= self.interval and key not in self._pending:
+                    del self._last_sent[key]
+
+        for pending in due:
+            self._forward(pending["payload"], pending["chars"])
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    ##############################
+    ## HELPER FUNCTIONS
+    ##############################
+
+    def _forward(self, payload, chars):
+        metrics.incr("typing.forwarded")
+        try:
+            self.send({**payload, "chars": chars})
+        except Exception as e:
+            print(f"Typing event could not be sent: {e}")
@@ -1,25 +1,90 @@
-from datetime import datetime, timezone, UTC
-import uuid
-from flask import request
-from flask_socketio import emit, SocketIO
+import atexit
+import threading
+from datetime import datetime, UTC
+from flask import request, current_app
+from flask_socketio import emit, join_room, SocketIO, ConnectionRefusedError as ConnectRefused
 from flask_jwt_extended import decode_token
-from app.models import db, User, Message, MessageTypeEnum
-from app.models.user import UserContact, ContactStatusEnum
+from socketio import KombuManager, RedisManager
+from app.models import db, User
+from app.models.user import UserContact
 from app.services.group_service import GroupService
-from app.services.user_service import UserService
+from app.services.user_service import UserService, USERS_CHANNEL
+from app.services.invalidation import invalidation_bus
 from app.services.item_service import ItemService
+from app.services.contact_service import ContactService
+from app.services.presence_store import get_presence_store
+from app.services.send_service import SendService
+from app.websocket.registry import LocalConnectionRegistry, create_registry
+from app.websocket.typing_throttle import TypingThrottle
+from app.websocket.presence import PresenceBroadcaster
+from app.websocket.event_log import LocalEventLog, create_event_log
+from app.websocket.outbound import OutboundManager, OutboundQueues, outbound_manager
+from app.websocket.admission import TokenBucket, IdentityCache, KnownUsers
+from app.metrics import metrics
 
 socketio = SocketIO(cors_allowed_origins="*")
 group_service = GroupService()
 user_service = UserService()
 items_service = ItemService()
+contact_service = ContactService()
+send_service = SendService()
 
-user_sids = {}  # user_id → sid
-sid_users = {}  # sid → user_id
+# Every connection joins the room of its user and the rooms of the user's groups,
+# so all fan-outs are single room emits and every device of a user receives them.
+# The registry knows the connections (sids) of every user, on every worker.
+registry = LocalConnectionRegistry()
+# Connections held by this worker: sid → user_id and username, so typing needs no database
+local_connections = {}
 
-def init_websockets(app):
-    global socketio
-    socketio.init_app(app)
+def init_websockets(app, **kwargs):
+    """
+    Attach Socket.IO to the app.
+
+    With SOCKETIO_MESSAGE_QUEUE set, several workers can serve the same clients: emits and
+    room changes go through the queue (redis://..., or local://host:port for the local
+    broker in app/websocket/local_queue.py) and the connection registry is shared.
+    """
+    global registry, event_log
+    message_queue = app.config.get("SOCKETIO_MESSAGE_QUEUE")
+    kwargs["client_manager"] = _client_manager(app, message_queue)
+
+    registry = create_registry(app.config.get("CONNECTION_REGISTRY_URL") or message_queue,
+                               app.config["CONNECTION_REGISTRY_TTL_S"])
+    event_log = create_event_log(app)
+    socketio.init_app(app, **kwargs)
+
+    typing_throttle.interval = app.config["TYPING_INTERVAL_MS"] / 1000
+    typing_throttle.stale_after = app.config["TYPING_STALE_MS"] / 1000
+    typing_throttle.max_pending = app.config["TYPING_MAX_PENDING"]
+    presence.interval = app.config["PRESENCE_INTERVAL_MS"] / 1000
+    outbound.size = app.config["OUTBOUND_QUEUE_SIZE"]
+    outbound.burst = app.config["OUTBOUND_BURST"]
+    outbound.slow_after = app.config["OUTBOUND_SLOW_S"]
+    outbound.interval = app.config["OUTBOUND_INTERVAL_MS"] / 1000
+    connect_bucket.rate = app.config["CONNECT_RATE"]
+    connect_bucket.burst = app.config["CONNECT_BURST"]
+    identities.max_size = app.config["IDENTITY_CACHE_SIZE"]
+    known_users.ttl = app.config["USER_CACHE_TTL_S"]
+
+
+def _load_username(user_id):
+    user = db.session.get(User, user_id)
+    return user.username if user else None
+
+
+# Connect admission (app/websocket/admission.py)
+connect_bucket = TokenBucket(rate=1000, burst=2000)
+identities = IdentityCache(decode_token)
+known_users = KnownUsers(_load_username)
+invalidation_bus.subscribe(USERS_CHANNEL, known_users.invalidate)
+
+
+def user_room(user_id):
+    return f"user:{user_id}"
+
+
+def group_room(group_id):
+    return f"group:{group_id}"
 
 
 ###########################
@@ -27,324 +92,512 @@ def init_websockets(app):
 ###########################
 @socketio.on('connect')
 def handle_connect():
-    print("New connection established")
     token = request.args.get('token')
     if not token:
-        print("No JWT token provided")
+        current_app.logger.debug("Connection without JWT token refused")
         return False
 
+    # reconnect storms: refused clients come back with their reconnect backoff
+    if not connect_bucket.try_acquire():
+        metrics.incr("connect.rejected")
+        raise ConnectRefused('busy')
+
     try:
-        decoded = decode_token(token)
-        user_id = decoded["sub"]
-        print(f"user who logs in: {user_id}")
-        user = User.query.get(user_id)
-        if not user:
+        user_id = identities.identity(token)
+        username = known_users.username(user_id)
+        if username is None:
             return False
+        metrics.incr("connect.admitted")
+
+        first_device = registry.add(user_id, request.sid)
+        local_connections[request.sid] = {"user_id": user_id, "username": username}
+        items_service.get_active_until(user_id)  # load the active item cache for the typing path
+        current_app.logger.debug("Accepting connection for user %s", username)
 
-        user_sids[user_id] = request.sid
-        sid_users[request.sid] = user_id
-        print(f"Accepting connection for user: {user.username}")
-        user_sids[user.user_id] = request.sid  # Store the user's socket ID
+        _start_flusher("outbound", lambda: outbound.interval, outbound.flush)
+        join_room(user_room(user_id))
+        group_ids = group_service.get_group_ids_by_user_id(user_id)
+        for group_id in group_ids:
+            join_room(group_room(group_id))
 
-        user.is_online = True
-        db.session.commit()
+        # events missed since the client's last seq (?last_seq=..&epoch=..)
+        _replay(user_id, group_ids, request.args.get('last_seq', type=int), request.args.get('epoch'))
 
-        # Notify all contacts that the user is online
-        emit('user_status', {
-            'user_id': user.user_id,
-            'username': user.username,
-            'status': 'online'
-        }, broadcast=True)
+        # the presence store and the contacts learn about it with the next presence flush
+        _arrived(user_id)
+        _start_presence_flusher(current_app._get_current_object())
+        if first_device:
+            presence.changed(user_id, username, 'online')
 
         return True
     except Exception as e:
-        print(f"JWT decoding error: {e}")
+        current_app.logger.warning("Connection refused: %s", e)
         return False
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("User disconnected")
     try:
-        user_id = sid_users.get(request.sid)
-        user = User.query.get(user_id)
-        if user:
-            # Update online status
-            user.is_online = False
-            db.session.commit()
-
-            del user_sids[user_id]
-            del sid_users[request.sid]
-
-            # Notify all contacts that the user is offline
-            emit('user_status', {
-                'user_id': user.user_id,
-                'username': user.username,
-                'status': 'offline'
-            }, broadcast=True)
+        connection = local_connections.pop(request.sid, None)
+        outbound.forget(request.sid)
+        user_id, last_device = registry.remove(request.sid)
+        if not last_device or connection is None:
+            return  # unknown connection, or still connected on another device
+
+        _departed(user_id)
+        get_presence_store().set_offline(user_id)
+
+        # Notify the contacts and group members that the user is offline
+        presence.changed(user_id, connection["username"], 'offline')
     except Exception as e:
-        print(f"Disconnection error: {e}")
+        current_app.logger.warning("Disconnection error: %s", e)
 
 
 # New WebSocket Handlers
 @socketio.on('send_char')
 def send_char(data):
-    print("Received action:", data)
-    """Handle various client actions based on the action field"""
+    """Typing indicator. Identity and group membership come from the connection, bursts are coalesced"""
     try:
-        user_id = sid_users.get(request.sid)
-        user = User.query.get(user_id)
-
+        connection = local_connections.get(request.sid)
         recipient_id = data.get('recipient_id')
-        character = data.get('char', '')
-        is_group = group_service.does_group_exist(recipient_id)
-        if not recipient_id:
+        if connection is None or not recipient_id:
             return
 
-        active_items = items_service.get_active_items(user_id)
-        for item in active_items:
-            if item['item_name'] == "timeout":
-                return
-
-        # Send typing notification directly to recipient's socket if they are online
-        if recipient_id in user_sids:
-            emit('receive_char', {
-                'sender_id': user.user_id,
-                'sender_username': user.username,
-                'char': character,
-                'is_group': is_group,
-                'recipient_id': recipient_id,
-            }, room=user_sids[recipient_id])
-        elif is_group:
-            # For groups, send to all members
-            members = group_service.get_group_members(recipient_id)
-            if not isinstance(members, list):
-                return
-            for member in members:
-                if member["contact_id"] in user_sids and member["contact_id"] != user.user_id:
-                    emit('receive_char', {
-                        'sender_id': user.user_id,
-                        'sender_username': user.username,
-                        'char': character,
-                        'is_group': True,
-                        'recipient_id': recipient_id
-                    }, room=user_sids[member["contact_id"]])
+        if items_service.is_timed_out(connection["user_id"]):
+            return
+
+        # a connection is in the room of every group of its user
+        is_group = group_room(recipient_id) in socketio.server.rooms(request.sid, namespace='/')
+        _start_typing_flusher()
+        typing_throttle.submit(connection["user_id"], recipient_id, {
+            'sender_id': connection["user_id"],
+            'sender_username': connection["username"],
+            'char': data.get('char', ''),
+            'is_group': is_group,
+            'recipient_id': recipient_id,
+        })
 
     except Exception as e:
-        print(f"Action handling error: {e}")
+        current_app.logger.warning("Typing event error: %s", e)
         emit('error', {'message': 'Failed to process action'})
 
 
-def send_message(user, recipient_id, content, is_group):
-    print("Websocket Sending message:", content)
+@socketio.on('send_message')
+def handle_send_message(data):
+    """
+    Send a message over the socket, same pipeline as POST /saveMessage.
+
+    The return value is the acknowledgement: the stored message_id and timestamp, or the error
+    and the status code /saveMessage would have answered with. A `client_id` is echoed back.
+    """
+    connection = local_connections.get(request.sid)
+    if connection is None:
+        return {'error': 'Not authenticated', 'status': 401}
+    data = data or {}
+    recipient_id = data.get('recipient_id')
+    content = data.get('content')
+
+    result, status_code = send_service.send(connection["user_id"], recipient_id, content)
+    if "error" in result:
+        return {**result, 'status': status_code, 'client_id': data.get('client_id')}
+
+    deliver_message(result, recipient_id, content)
+    return {
+        'success': True,
+        'message_id': result["message_id"],
+        'timestamp': result["send_at"].isoformat(),
+        'last_words': result["last_words"],
+        'client_id': data.get('client_id')
+    }
+
+
+def deliver_message(result, recipient_id, content):
+    """Push a message stored by SendService.send to the recipients (unless it was last words) and announce new contacts"""
+    if not result["last_words"]:
+        send_message(result["sender"], recipient_id, content, result["is_group"], result["message_id"], result["send_at"])
+    for uid, cid in result["new_contacts"]:
+        new_contact(cid, uid)
+
+
+def send_message(user, recipient_id, content, is_group, message_id=None, send_at=None):
     """Handle send message action"""
     msg_type = "text"
 
     if not recipient_id or not content:
         return
 
-    # Send notification directly to recipient's socket if they are online
-    if recipient_id in user_sids:
-        emit('new_message', {
-            'message_id': str(uuid.uuid4()),
-            'sender_id': user.user_id,
-            'content': content,
-            'type': msg_type,
-            'timestamp': datetime.now(UTC).isoformat(),
-            'is_group': False,
-            'recipient_id': recipient_id
-        }, room=user_sids[recipient_id], namespace='/')
-    elif is_group:
-        # For groups, send to all members
-        members = group_service.get_group_members(recipient_id)
-        if not isinstance(members, list):
-            return
-
-        for member in members:
-            print("websocket: ", member)
-            if member["contact_id"] in user_sids and member["contact_id"] != user.user_id:
-                print("websocket emiting: ", content)
-                emit('new_message', {
-                    'message_id': str(uuid.uuid4()),
-                    'sender_id': user.user_id,
-                    'content': content,
-                    'type': msg_type,
-                    'timestamp': datetime.now(UTC).isoformat(),
-                    'is_group': True,
-                    'recipient_id': recipient_id
-                }, room=user_sids[member["contact_id"]], namespace='/')
+    # One emit to the recipient's devices, or to every other member of the group
+    _emit('new_message', {
+        'message_id': message_id,
+        'sender_id': user.user_id,
+        'content': content,
+        'type': msg_type,
+        'timestamp': send_at.isoformat() if send_at else datetime.now(UTC).isoformat(),
+        'is_group': is_group,
+        'recipient_id': recipient_id
+    }, group_room(recipient_id) if is_group else user_room(recipient_id),
+        skip_user_id=user.user_id if is_group else None)
 
 
 def chat_change(action, recipient_id, data):
-    """Handle chat change actions"""
-    print("Websocket Chat change action:", action)
-    groupmembers = group_service.get_group_members(recipient_id)
-    print("groupmembers: ", groupmembers, type(groupmembers))
+    """Handle chat change actions, keeping the group room in sync with the membership"""
+    room = group_room(recipient_id)
     match action:
         case "leave_group":
-            print("websocket groupmembers leave: ", groupmembers)
-            for member in groupmembers:
-                print("websocket member in leave Group: ", member, type(member))
-                print(user_sids)
-                if member["contact_id"] in user_sids:
-                    print("websocket member emit in leave Group: ", member, type(member))
-                    emit('chat_change', {
-                        'action': action,
-                        'group_id': recipient_id,
-                        'data': {
-                            'user_id': data["user_id"]
-                        }
-                    }, room=user_sids[member["contact_id"]], namespace='/')
+            leave_group_room(data["user_id"], recipient_id)
+            _emit('chat_change', {
+                'action': action,
+                'group_id': recipient_id,
+                'data': {
+                    'user_id': data["user_id"]
+                }
+            }, room, log_also=[user_room(data["user_id"])])
 
 
         case "remove_member":
-            print("websocket groupmembers remove: ", groupmembers)
-            for member in groupmembers:
-                print("websocket member in remove Group: ", member, type(member))
-                if member["contact_id"] in user_sids and member["contact_id"]:
-                    emit('chat_change', {
-                        'action': action,
-                        'group_id': recipient_id,
-                        'data': {
-                            'user_id': data["member_id"],
-                            'by_user_id': data["by_user_id"]
-                        }
-                    }, room=user_sids[member["contact_id"]], namespace='/')
-
-            if data["member_id"] in user_sids and data["member_id"]:
-                # Notify the user who was removed
-                emit('chat_change', {
-                    'action': action,
-                    'group_id': recipient_id,
-                    'data': {
-                        'user_id': data["member_id"],
-                        'by_user_id': data["by_user_id"]
-                    }
-                }, room=user_sids[data["member_id"]], namespace='/')
+            # the removed member is still in the room and gets notified as well
+            _emit('chat_change', {
+                'action': action,
+                'group_id': recipient_id,
+                'data': {
+                    'user_id': data["member_id"],
+                    'by_user_id': data["by_user_id"]
+                }
+            }, room, log_also=[user_room(data["member_id"])])
+            leave_group_room(data["member_id"], recipient_id)
 
 
         case "add_member":
-            print("websocket groupmembers add: ", groupmembers)
-            for member in groupmembers:
-                print("websocket member in remove Group: ", member, type(member))
-                if member["contact_id"] in user_sids and member["contact_id"]:
-                    emit('chat_change', {
-                        'action': action,
-                        'group_id': recipient_id,
-                        'data': {
-                            'user_id': data["member_id"],
-                            'by_user_id': data["by_user_id"]
-                        }
-                    }, room=user_sids[member["contact_id"]], namespace='/')
+            join_group_room(data["member_id"], recipient_id)
+            _emit('chat_change', {
+                'action': action,
+                'group_id': recipient_id,
+                'data': {
+                    'user_id': data["member_id"],
+                    'by_user_id': data["by_user_id"]
+                }
+            }, room, log_also=[user_room(data["member_id"])])  # replay of the group starts here for the new member
 
 
         case "create_group":
-            for member in groupmembers:
-                print("websocket member: ", member, type(member))
-                if member["contact_id"] in user_sids and member["contact_id"]:
-                    emit('chat_change', {
-                        "action": action,
-                        "group_id": recipient_id,
-                        "data": {
-                            'group_name': data["name"],
-                            'group_pic': data["picture_url"],
-                            'members': data["members"],
-                            'am_admin': data["am_admin"],
-                            'created_at': data["created_at"]
-                        }
-                    }, room=user_sids[member["contact_id"]], namespace='/')
+            for member in data["members"]:
+                join_group_room(member["contact_id"], recipient_id)
+            _emit('chat_change', {
+                "action": action,
+                "group_id": recipient_id,
+                "data": {
+                    'group_name': data["name"],
+                    'group_pic': data["picture_url"],
+                    'members': data["members"],
+                    'am_admin': data["am_admin"],
+                    'created_at': data["created_at"]
+                }
+            }, room, log_also=[user_room(member["contact_id"]) for member in data["members"]])
 
 
         case "delete_group":
-            for member in groupmembers:
-                if member["contact_id"] in user_sids and member["contact_id"]:
-                    emit('chat_change', {
-                        "action": action,
-                        "group_id": recipient_id,
-                        "data": {}
-                    }, room=user_sids[member["contact_id"]], namespace='/')
+            _emit('chat_change', {
+                "action": action,
+                "group_id": recipient_id,
+                "data": {}
+            }, room, log_also=[user_room(member_id) for member_id in group_service.get_member_ids(recipient_id)])
+            close_group_room(recipient_id)
 
 
         case "change_group":
-            for member in groupmembers:
-                if member["contact_id"] in user_sids and member["contact_id"]:
-                    emit('chat_change', {
-                        "action": action,
-                        "group_id": recipient_id,
-                        "data": {
-                            'action': data["action"],
-                            'new_value': data["new_value"]
-                        }
-                    }, room=user_sids[member["contact_id"]], namespace='/')
+            _emit('chat_change', {
+                "action": action,
+                "group_id": recipient_id,
+                "data": {
+                    'action': data["action"],
+                    'new_value': data["new_value"]
+                }
+            }, room)
 
 
 def use_item(from_user_id, to_user_id, item_name, active_until):
     """Handle use item action"""
-    print("Websocket Use item action:", item_name, from_user_id, to_user_id)
-
+    current_app.logger.debug("Item %s used by %s on %s", item_name, from_user_id, to_user_id)
     try:
-        if to_user_id not in user_sids:
-            print("User not connected")
-            return
-
         # Emit the item used event to the recipient
-        emit('item_used', {
+        _emit('item_used', {
             'item_name': item_name,
             'active_until': active_until.isoformat() if active_until else None,
-        }, room=user_sids[to_user_id], namespace='/')
+        }, user_room(to_user_id))
     except Exception as e:
-        print("Error emitting item_used event:", e)
+        current_app.logger.warning("Error emitting item_used event: %s", e)
 
 def chat_change_alone(user_id):
-    print("Chat Change", user_id)
     """Handle chat Change"""
     contacts = UserContact.query.filter_by(user_id=user_id).all()
-    print("Contacts for user:", contacts)
     for contact in contacts:
-
         # Notify the user that the contact has changed
-        if contact.contact_id in user_sids:
-            print("Emitting chat change for contact:", contact.contact_id)
-            emit('chat_change', {
-                'user_id': user_id,
-            }, room=user_sids[contact.contact_id], namespace='/')
+        _emit('chat_change', {
+            'user_id': user_id,
+        }, user_room(contact.contact_id))
 
 def new_contact(contact_id, user_id):
-    print("New contact added", contact_id, user_id)
     """Handle new contact action"""
-    if contact_id in user_sids:
-        emit('chat_change', {
-            'user_id': user_id,
-        }, room=user_sids[contact_id], namespace='/')
+    _emit('chat_change', {
+        'user_id': user_id,
+    }, user_room(contact_id))
 
-def updated_message(recipient_id, sender_id):
+def updated_message(recipient_id, sender_id, is_group):
     """Handle updated message action"""
-    print("Websocket Updated message:", recipient_id)
-    is_group = group_service.does_group_exist(recipient_id)
     try:
-        if is_group:
-            members = group_service.get_group_members(recipient_id)
-            print("Group members:", members)
-            if not isinstance(members, list):
-                return
-            for member in members:
-                print("websocket member: ", member, type(member))
-                if member["contact_id"] in user_sids:
-                    emit('new_message', {
-                        'recipient_id': recipient_id,
-                        'is_group': is_group,
-                        'sender_id': sender_id,
-                    }, room=user_sids[member["contact_id"]], namespace='/')
-        else:
-            print("Single recipient:", recipient_id)
-            if recipient_id in user_sids:
-                print("Emitting updated_message to recipient:", recipient_id)
-            else:
-                print("Recipient not connected:", recipient_id)
-            emit('new_message', {
-                'recipient_id': recipient_id,
-                'is_group': is_group,
-                'sender_id': sender_id,
-            }, room=user_sids[recipient_id], namespace='/')
+        _emit('new_message', {
+            'recipient_id': recipient_id,
+            'is_group': is_group,
+            'sender_id': sender_id,
+        }, group_room(recipient_id) if is_group else user_room(recipient_id))
     except Exception as e:
-        print("Error emitting updated_message event:", e)
\ No newline at end of file
+        current_app.logger.warning("Error emitting updated_message event: %s", e)
+
+
+###########################
+## TYPING
+###########################
+
+def _send_typing(payload):
+    # Send typing notification to the recipient's devices or to the other group members
+    is_group = payload['is_group']
+    _emit('receive_char', payload, group_room(payload['recipient_id']) if is_group else user_room(payload['recipient_id']),
+          skip_user_id=payload['sender_id'] if is_group else None)
+
+
+typing_throttle = TypingThrottle(_send_typing)
+
+
+def _start_typing_flusher():
+    """Background task that sends the coalesced typing events once their interval has passed"""
+    _start_flusher("typing", lambda: typing_throttle.interval / 2, typing_throttle.flush)
+
+
+###########################
+## PRESENCE
+###########################
+
+def _presence_audience(user_ids):
+    audience = contact_service.get_presence_audience(user_ids)
+    online = registry.online(set().union(*audience.values()))
+    return {user_id: recipients & online for user_id, recipients in audience.items()}
+
+
+def _send_presence(recipient_id, changes):
+    _emit('presence_diff', {'changes': changes}, user_room(recipient_id))
+
+
+presence = PresenceBroadcaster(_presence_audience, _send_presence)
+
+
+_arrivals = set()  # users that connected since the last presence flush
+_arrivals_lock = threading.Lock()
+
+
+def _arrived(user_id):
+    with _arrivals_lock:
+        _arrivals.add(user_id)
+
+
+def _departed(user_id):
+    with _arrivals_lock:
+        _arrivals.discard(user_id)
+
+
+def flush_arrivals():
+    """Mark the users that connected since the last flush online, in one write to the presence store."""
+    global _arrivals
+    with _arrivals_lock:
+        arrived, _arrivals = _arrivals, set()
+    if arrived:
+        get_presence_store().set_online(arrived)
+
+
+def _start_presence_flusher(app):
+    """
+    Background tasks that send the presence frames every PRESENCE_INTERVAL_MS, keep the users of this
+    worker online and, for a shared registry, keep the connections of this worker registered
+    """
+    def flush():
+        with app.app_context():
+            try:
+                flush_arrivals()
+                presence.flush()
+            except Exception as e:
+                app.logger.warning("Presence flush error: %s", e)
+            finally:
+                db.session.remove()
+
+    def heartbeat():
+        try:
+            get_presence_store().set_online({connection["user_id"] for connection in list(local_connections.values())})
+        except Exception as e:
+            app.logger.warning("Presence heartbeat error: %s", e)
+
+    def registry_heartbeat():
+        try:
+            registry.refresh({sid: connection["user_id"] for sid, connection in list(local_connections.items())})
+        except Exception as e:
+            app.logger.warning("Connection registry heartbeat error: %s", e)
+
+    _start_flusher("presence", lambda: presence.interval, flush)
+    _start_flusher("presence_heartbeat", lambda: get_presence_store().ttl / 3, heartbeat)
+    if registry.ttl is not None:
+        _start_flusher("registry_heartbeat", lambda: registry.ttl / 3, registry_heartbeat)
+
+
+def _unregister_local_connections():
+    """At shutdown, remove the connections of this worker from a shared registry instead of waiting for the ttl"""
+    if registry.ttl is None:
+        return
+    for sid in list(local_connections):
+        try:
+            registry.remove(sid)
+        except Exception:
+            return  # the registry is gone already, the ttl cleans up
+
+
+atexit.register(_unregister_local_connections)
+
+
+
+###########################
+## OUTBOUND QUEUES
+###########################
+
+def _client_manager(app, message_queue):
+    """
+    The client manager of the Socket.IO server: the one Flask-SocketIO would pick for the
+    message queue, delivering through the outbound queues.
+    """
+    if not message_queue:
+        manager = OutboundManager()
+    elif message_queue.startswith("local://"):
+        from app.websocket.local_queue import LocalPubSubManager
+        manager = outbound_manager(LocalPubSubManager)(message_queue, key=app.config.get("LOCAL_QUEUE_KEY"))
+    elif message_queue.startswith(("redis://", "rediss://", "unix://")):
+        manager = outbound_manager(RedisManager)(message_queue, channel="flask-socketio")
+    else:
+        manager = outbound_manager(KombuManager)(message_queue, channel="flask-socketio")
+    manager.outbound = outbound
+    outbound.send = manager.deliver
+    return manager
+
+
+def _disconnect_slow(sid):
+    socketio.server.disconnect(sid, namespace='/')
+
+
+def _user_of(sid):
+    connection = local_connections.get(sid)
+    return connection["user_id"] if connection else None
+
+
+outbound = OutboundQueues(None, _disconnect_slow, _user_of)
+
+
+###########################
+## BACKGROUND FLUSHERS
+###########################
+
+_flushers = {}  # name → server the flusher runs for
+
+
+def _start_flusher(name, interval, flush):
+    if _flushers.get(name) is not socketio.server:
+        _flushers[name] = socketio.server
+        socketio.start_background_task(_run_flusher, socketio.server, interval, flush)
+
+
+def _run_flusher(server, interval, flush):
+    while socketio.server is server:
+        server.sleep(interval())
+        flush()
+
+
+###########################
+## EVENT LOG
+###########################
+
+LOGGED_EVENTS = {'new_message', 'chat_change', 'item_used'}
+event_log = LocalEventLog()
+
+
+def _replay(user_id, group_ids, last_seq, epoch):
+    """
+    Send the events a reconnecting client missed, then `sync` with the epoch and seq to
+    remember. Events of a group start at the user's add_member/create_group event.
+    """
+    resync_required = False
+    events = []
+    if last_seq is not None:
+        if epoch != event_log.epoch:
+            resync_required = True  # the client's seqs belong to an earlier log
+        else:
+            own, resync_required = event_log.since({user_room(user_id): last_seq}, user_id)
+            joined = {
+                data['group_id']: seq for seq, event, data in own
+                if event == 'chat_change' and data.get('action') in ('add_member', 'create_group')
+            }
+            if not resync_required:
+                starts = {group_room(g): max(last_seq, joined.get(g, 0)) for g in group_ids}
+                starts[user_room(user_id)] = last_seq
+                events, resync_required = event_log.since(starts, user_id)
+
+    if len(events) >= outbound.capacity():
+        resync_required = True  # more than the connection can take before `sync`, it would be disconnected
+    if resync_required:
+        metrics.incr("event_log.resync")
+        events = []
+    for seq, event, data in events:
+        emit(event, {**data, 'seq': seq})
+    metrics.incr("event_log.replayed", len(events))
+
+    emit('sync', {
+        'epoch': event_log.epoch,
+        'seq': event_log.latest(),
+        'replayed': len(events),
+        'resync_required': resync_required
+    })
+
+
+###########################
+## ROOM MEMBERSHIP
+###########################
+
+def join_group_room(user_id, group_id):
+    """Put every connection of a user into the group's room, connections on other workers via the queue."""
+    if socketio.server is None:
+        return
+    for sid in registry.sids(user_id):
+        socketio.server.enter_room(sid, group_room(group_id), namespace='/')
+
+
+def leave_group_room(user_id, group_id):
+    """Take every connection of a user out of the group's room."""
+    if socketio.server is None:
+        return
+    for sid in registry.sids(user_id):
+        socketio.server.leave_room(sid, group_room(group_id), namespace='/')
+
+
+def close_group_room(group_id):
+    if socketio.server is None:
+        return
+    socketio.server.close_room(group_room(group_id), namespace='/')
+
+
+def _emit(event, data, room, skip_user_id=None, log_also=()):
+    """
+    Single emit to a room. skip_user_id leaves out every device of that user (e.g. the sender).
+
+    Events in LOGGED_EVENTS get a seq and are kept in the event log of the room (and of the
+    rooms in log_also, without emitting there) for the replay on reconnect.
+    """
+    if socketio.server is None:
+        return  # Socket.IO not initialized (e.g. HTTP only tests)
+    if event in LOGGED_EVENTS:
+        data = {**data, 'seq': event_log.append([room, *log_also], event, data, skip_user_id)}
+        metrics.incr("event_log.appended")
+    skip_sid = list(registry.sids(skip_user_id)) if skip_user_id else None
+    socketio.emit(event, data, to=room, skip_sid=skip_sid or None, namespace='/')
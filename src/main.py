@@ -5,6 +5,7 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import init_database, create_app
+from app.services.streak_expiry import start_streak_expiry
 from app.websocket.websockets import socketio, init_websockets
 
 app = create_app()
@@ -13,6 +14,7 @@ init_websockets(app)
 if __name__ == '__main__':
     # Initialize database for development (comment out for production)
     init_database(app)
+    start_streak_expiry(app)
 
     socketio.run(
         app,
@@ -0,0 +1,67 @@
+"""
+Presence traffic of a reconnect storm: global user_status broadcast vs. presence_diff frames.
+
+    python src/metrics/presence_load.py --users 100 1000 5000 --contacts 20 --storm 5
+
+All users reconnect within --storm seconds (e.g. after a deploy). Every user has
+--contacts random contacts. The old behaviour sent one user_status per transition
+to every connected client, the PresenceBroadcaster sends one frame per recipient
+and interval to the online contacts only.
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.websocket.presence import PresenceBroadcaster
+
+
+def run(users, contacts, storm, interval):
+    rng = random.Random(users)
+    audience_of = {user: set() for user in range(users)}
+    for user in range(users):
+        for contact in rng.sample(range(users), min(contacts, users - 1) + 1):
+            if contact != user:
+                audience_of[contact].add(user)  # user has contact in their list, so sees its presence
+
+    online = set()
+    sent = {"frames": 0, "changes": 0}
+
+    def audience(user_ids):
+        return {user_id: audience_of[user_id] & online for user_id in user_ids}
+
+    def send(recipient_id, changes):
+        sent["frames"] += 1
+        sent["changes"] += len(changes)
+
+    presence = PresenceBroadcaster(audience, send, interval)
+    connect_at = sorted((rng.uniform(0, storm), user) for user in range(users))
+
+    broadcasts = 0
+    next_flush = interval
+    for at, user in connect_at:
+        while at >= next_flush:
+            presence.flush()
+            next_flush += interval
+        online.add(user)
+        broadcasts += len(online)  # user_status with broadcast=True reaches every connected client
+        presence.changed(user, f"user{user}", "online")
+    presence.flush()
+
+    print(f"{users:7d} users  broadcast: {broadcasts:11d} emits   "
+          f"presence_diff: {sent['frames']:9d} frames ({sent['changes']:9d} changes)   "
+          f"{broadcasts / max(sent['frames'], 1):7.1f}x fewer emits")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--contacts", type=int, default=20)
+    parser.add_argument("--storm", type=float, default=5.0, help="seconds in which all users reconnect")
+    parser.add_argument("--interval", type=float, default=0.5, help="PRESENCE_INTERVAL_MS / 1000")
+    args = parser.parse_args()
+
+    for users in args.users:
+        run(users, args.contacts, args.storm, args.interval)
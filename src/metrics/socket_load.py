@@ -0,0 +1,224 @@
+"""
+Concurrent websockets: the development server (main.py) vs. the production entry point (serve.py).
+
+    python src/metrics/socket_load.py --sockets 5000 --modes dev serve
+
+Every mode starts its server on a fresh SQLite file, registers --users users and opens
+--sockets websocket connections (Engine.IO v4, round robin over the users) with at most
+--ramp handshakes in flight. With all sockets open it measures the latency of HTTP
+requests that hit the database (/getChats) and of a message fan-out: one /saveMessage
+per user until the new_message reached every socket of the recipient. A server that
+stops accepting connections (fewer than 99% open) is reported as saturated, without them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import requests
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import CloseConnection, Ping, RejectConnection, Request, TextMessage
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ENTRY_POINTS = {"dev": "main.py", "serve": "serve.py"}
+
+
+class Socket:
+    """Minimal Socket.IO client over a raw websocket: connects, answers pings, counts new_message."""
+
+    def __init__(self, host, port, token):
+        self.host, self.port, self.token = host, port, token
+        self.connected = asyncio.Event()
+        self.messages = 0
+        self.on_message = None
+        self.writer = None
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=2 ** 20)
+        ws = WSConnection(ConnectionType.CLIENT)
+        query = urlencode({"EIO": 4, "transport": "websocket", "token": self.token})
+        self.writer.write(ws.send(Request(host=f"{self.host}:{self.port}", target=f"/socket.io/?{query}")))
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                ws.receive_data(data)
+                for event in ws.events():
+                    if isinstance(event, Ping):
+                        self.writer.write(ws.send(event.response()))
+                    elif isinstance(event, (CloseConnection, RejectConnection)):
+                        return
+                    elif isinstance(event, TextMessage):
+                        self._handle(ws, event.data)
+        finally:
+            self.writer.close()
+
+    def _handle(self, ws, packet):
+        if packet.startswith("0"):
+            self.writer.write(ws.send(TextMessage("40")))  # Engine.IO open → Socket.IO connect
+        elif packet == "2":
+            self.writer.write(ws.send(TextMessage("3")))   # ping → pong
+        elif packet.startswith("40"):
+            self.connected.set()
+        elif packet.startswith('42["new_message"'):
+            self.messages += 1
+            if self.on_message:
+                self.on_message()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_stats(pid):
+    stats = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                stats[key] = value.strip()
+    return stats
+
+
+def start_server(mode, directory, port):
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{os.path.join(directory, f'{mode}.db')}",
+        "PORT": str(port),
+        "DEBUG": "False",
+    }
+    log = open(os.path.join(directory, f"{mode}.log"), "w")
+    server = subprocess.Popen([sys.executable, os.path.join(SRC, ENTRY_POINTS[mode])], env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{mode} server did not start, see {log.name}")
+
+
+def login_users(base, users):
+    tokens = []
+    for i in range(users):
+        credentials = {"username": f"load{i}", "password": "load-password"}
+        requests.post(f"{base}/register", json=credentials, timeout=30)
+        tokens.append(requests.get(f"{base}/login", params=credentials, timeout=30).json())
+    return tokens
+
+
+def percentile(values, p):
+    return sorted(values)[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+async def measure(mode, port, tokens, sockets, ramp):
+    base = f"http://127.0.0.1:{port}"
+    clients = [Socket("127.0.0.1", port, tokens[i % len(tokens)]["access_token"]) for i in range(sockets)]
+    gate = asyncio.Semaphore(ramp)
+    connect_times = []
+
+    async def open_one(client):
+        async with gate:
+            started = time.perf_counter()
+            task = asyncio.create_task(client.run())
+            try:
+                await asyncio.wait_for(client.connected.wait(), 10)
+                connect_times.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                task.cancel()
+            return task
+
+    started = time.perf_counter()
+    tasks = await asyncio.gather(*(open_one(client) for client in clients))
+    connect_all = time.perf_counter() - started
+    print(f"{mode}: {len(connect_times)}/{sockets} sockets open after {connect_all:.1f}s", file=sys.stderr)
+
+    loop = asyncio.get_running_loop()
+    headers = {"Authorization": f"Bearer {tokens[0]['access_token']}"}
+    # a server that stopped accepting sockets does not accept HTTP requests either (no probes, they would hang)
+    saturated = len(connect_times) < sockets * 0.99
+    http_times = []
+    for _ in range(0 if saturated else 50):
+        request_started = time.perf_counter()
+        await loop.run_in_executor(None, lambda: requests.get(f"{base}/getChats", headers=headers, timeout=30))
+        http_times.append(time.perf_counter() - request_started)
+
+    # fan-out: a message to every user, done when all of the recipient's sockets have it
+    fanout_times = []
+    for i, token in enumerate([] if saturated else tokens):
+        recipients = [client for client in clients[i::len(tokens)] if client.connected.is_set()]
+        done = asyncio.Event()
+        remaining = [len(recipients)]
+
+        def received():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+        for client in recipients:
+            client.on_message = received
+        sender = tokens[(i + 1) % len(tokens)]
+        send_started = time.perf_counter()
+        await loop.run_in_executor(None, lambda: requests.post(
+            f"{base}/saveMessage", json={"recipient_id": token["user_id"], "content": "load"},
+            headers={"Authorization": f"Bearer {sender['access_token']}"}, timeout=30))
+        try:
+            await asyncio.wait_for(done.wait(), 10)
+            fanout_times.append(time.perf_counter() - send_started)
+        except asyncio.TimeoutError:
+            pass
+        for client in recipients:
+            client.on_message = None
+
+    result = {
+        "connected": len(connect_times),
+        "connect_all_s": connect_all,
+        "connect_p50_ms": percentile(connect_times, 0.5) * 1000,
+        "connect_p99_ms": percentile(connect_times, 0.99) * 1000,
+        "http_p50_ms": percentile(http_times, 0.5) * 1000,
+        "http_p99_ms": percentile(http_times, 0.99) * 1000,
+        "saturated": saturated,
+        "fanout_p50_ms": percentile(fanout_times, 0.5) * 1000,
+        "fanouts": f"{len(fanout_times)}/{len(tokens)}",
+    }
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return result
+
+
+def run(mode, sockets, users, ramp):
+    directory = tempfile.mkdtemp()
+    port = free_port()
+    server = start_server(mode, directory, port)
+    try:
+        tokens = login_users(f"http://127.0.0.1:{port}", users)
+        result = asyncio.run(measure(mode, port, tokens, sockets, ramp))
+        result.update(process_stats(server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"{mode:6s} {json.dumps(result)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sockets", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--ramp", type=int, default=200, help="handshakes in flight")
+    parser.add_argument("--modes", nargs="+", choices=sorted(ENTRY_POINTS), default=["dev", "serve"])
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        run(mode, args.sockets, args.users, args.ramp)
@@ -0,0 +1,75 @@
+"""
+Sustained sends per second: per-send commits vs. the write-behind queue.
+
+    python src/metrics/write_behind_benchmark.py --threads 8 --messages 500
+
+Every mode runs against a fresh SQLite file in a temp directory. The threads send
+direct messages between two users through SendService.send, the /saveMessage
+path (message, conversation rows, streak and contact rows).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import create_app, db
+from app.config import Config
+from app.models import User, UserContact, ContactStatusEnum
+from app.services.send_service import SendService
+from app.services.write_behind import get_write_behind
+
+
+def run(mode, threads, messages):
+    directory = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        MESSAGE_WRITE_BEHIND = mode != "sync"
+        WRITE_BEHIND_WAIT = mode == "write-behind (wait)"
+        DEBUG = False
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(user_id=f"bench-{i}", username=f"bench{i}", password="x", salt="x") for i in range(2)])
+        db.session.add_all([UserContact(user_id=f"bench-{i}", contact_id=f"bench-{1 - i}",
+                                        status=ContactStatusEnum.FRIEND, streak=0) for i in range(2)])
+        db.session.commit()
+
+    errors = []
+
+    def worker():
+        with app.app_context():
+            service = SendService()
+            for i in range(messages):
+                result, _ = service.send("bench-0", "bench-1", f"message {i}")
+                if "error" in result:
+                    errors.append(result["error"])
+            db.session.remove()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if mode != "sync":
+        get_write_behind(app).stop()
+    elapsed = time.perf_counter() - started
+
+    total = threads * messages - len(errors)
+    print(f"{mode:24} {total:7d} messages in {elapsed:6.2f}s  {total / elapsed:9.1f} sends/s  {len(errors)} errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=250, help="messages per thread")
+    args = parser.parse_args()
+
+    for mode in ("sync", "write-behind (wait)", "write-behind (no wait)"):
+        run(mode, args.threads, args.messages)
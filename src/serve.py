@@ -0,0 +1,51 @@
+"""
+Production entry point: an eventlet (or gevent) server instead of the development setup in main.py.
+
+    python src/serve.py                      # ASYNC_MODE=eventlet, PORT=5000
+    ASYNC_MODE=gevent python src/serve.py    # needs `pip install gevent`
+
+Applies pending migrations on start (MIGRATE_ON_START=false to skip), never resets the
+database, and runs the database calls in a pool of DB_THREADS threads (app/serving.py).
+MAX_CONNECTIONS (10000) caps the concurrent connections, eventlet's default is 1024.
+"""
+import os
+
+ASYNC_MODE = os.getenv('ASYNC_MODE', 'eventlet')
+
+# patch before anything imports socket, threading or time
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    raise SystemExit(f"ASYNC_MODE must be eventlet or gevent, not {ASYNC_MODE}")
+
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import create_app, create_tables
+from app.serving import offload_database
+from app.services.streak_expiry import start_streak_expiry
+from app.websocket.websockets import socketio, init_websockets
+
+app = create_app()
+if os.getenv('MIGRATE_ON_START', 'True').lower() == 'true':
+    create_tables(app)
+offload_database(app, ASYNC_MODE, app.config['DB_THREADS'])
+start_streak_expiry(app)
+init_websockets(app, async_mode=ASYNC_MODE)
+
+if __name__ == '__main__':
+    # every websocket holds one of eventlet's max_size green threads (and a file descriptor, see ulimit -n)
+    server_options = {'max_size': int(os.getenv('MAX_CONNECTIONS', 10000))} if ASYNC_MODE == 'eventlet' else {}
+
+    socketio.run(
+        app,
+        host='0.0.0.0',
+        port=int(os.getenv('PORT', 5000)),
+        log_output=os.getenv('ACCESS_LOG', 'False').lower() == 'true',
+        **server_options
+    )
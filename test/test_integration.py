@@ -5,16 +5,47 @@ import json
 import unittest
 import pytest
 import warnings
+from contextlib import contextmanager
 from flask import request
 from flask_testing import TestCase
+from sqlalchemy import event
 
 # Import from app directly to match the rest of the application
 from app import create_app, db
+from app.migrations import version_metadata
+from app.services.active_item_cache import active_item_cache
+from app.services.group_directory import group_directory
+from app.services.profile_cards import profile_cards
 
 # Filter out the known deprecation warnings from werkzeug/Flask
 warnings.filterwarnings("ignore", category=DeprecationWarning, 
                        module="werkzeug.routing.rules")
 
+def socket_worker(database_uri, message_queue, queue_key, port, subscribed):
+    """Second worker process for the multi-worker test: serves Socket.IO on its own port"""
+    from app.config import Config
+    from app.websocket import websockets
+
+    class WorkerConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        SOCKETIO_MESSAGE_QUEUE = message_queue
+        LOCAL_QUEUE_KEY = queue_key
+        DEBUG = False
+
+    app = create_app(WorkerConfig)
+    websockets.init_websockets(app, async_mode='threading')
+
+    # subscribe to the queue now instead of with the first connection
+    server = websockets.socketio.server
+    server.manager_initialized = True
+    server.manager.initialize()
+    server.manager.subscribed.wait(10)
+    subscribed.set()
+
+    websockets.socketio.run(app, host='127.0.0.1', port=port, use_reloader=False, log_output=False,
+                            allow_unsafe_werkzeug=True)
+
+
 class BaseTestCase(TestCase):
     """Base test case class for all integration tests"""
     
@@ -42,6 +73,24 @@ class BaseTestCase(TestCase):
         with self.app.app_context():
             db.session.remove()
             db.drop_all()
+            version_metadata.drop_all(bind=db.engine)
+        active_item_cache.invalidate()
+        group_directory.invalidate()
+        profile_cards.invalidate()
+
+    @contextmanager
+    def count_queries(self):
+        """Helper to count the SQL statements executed inside the block"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
 
     def print_routes(self):
         """Helper method to print available routes for debugging"""
@@ -180,6 +229,27 @@ class TestApiEndpoints(BaseTestCase):
             return data['user_id']
         return None
     
+    def connect_socket(self, login_data, **query):
+        """Helper to open a Socket.IO test client (one device) for a logged in user"""
+        from urllib.parse import urlencode
+        from app.websocket import websockets
+
+        if self.app.extensions.get('socketio') is None:
+            websockets.init_websockets(self.app, async_mode='threading')
+            self.addCleanup(self.reset_socketio)
+        query_string = urlencode({'token': login_data['access_token'], **query})
+        return websockets.socketio.test_client(self.app, query_string=query_string)
+
+    def reset_socketio(self):
+        from app.websocket import websockets
+
+        websockets.socketio.server = None
+        websockets.socketio.server_options.pop('client_manager', None)
+        websockets.socketio.server_options.pop('message_queue', None)
+        websockets.registry.clear()
+        websockets.local_connections.clear()
+        websockets.outbound.clear()
+
     def get_member_ids(self, count=1):
         """Helper to get multiple valid member user IDs"""
         member_ids = []
@@ -338,6 +408,97 @@ class TestApiEndpoints(BaseTestCase):
             else:
                 self.fail("Response doesn't contain 'contacts' or 'chats' key")
     
+    def test_get_chats_matches_legacy_response(self):
+        """getChats must stay byte-compatible with the per-row implementation"""
+        from app.services.contact_service import ContactService
+        from app.services.group_service import GroupService
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        contact_id = self.add_contact(headers)
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'hi'}, headers=headers)
+        group = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))
+        group_id = group['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'hello group'}, headers=headers)
+
+        response = self.client.get('/getChats', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        with self.app.test_request_context():
+            legacy = ContactService().get_user_contacts_by_user_id(user_id) + \
+                GroupService().get_groups_by_user_id(user_id)
+            for chat in legacy:
+                chat["last_message_timestamp"] = MessageService().get_last_message_date_for_contact(
+                    user_id, chat["contact_id"])
+            expected = self.app.json.response({"chats": legacy}).get_data()
+
+        self.assertEqual(response.data, expected)
+
+    def test_get_chats_query_count_is_constant(self):
+        """getChats must not issue queries per contact or per group"""
+        headers, _ = self.setup_users_and_login()
+        self.add_contact(headers)
+        self.client.post('/createGroup', json={}, headers=headers)
+        self.client.get('/getChats', headers=headers)
+
+        with self.count_queries() as small:
+            self.client.get('/getChats', headers=headers)
+
+        for i in range(5):
+            self.register_test_user(f"extra_contact_{i}", "password")
+            self.client.post(f'/addContact?contact_name=extra_contact_{i}', headers=headers)
+            self.client.post('/createGroup', json={}, headers=headers)
+        self.client.get('/getChats', headers=headers)
+
+        with self.count_queries() as large:
+            response = self.client.get('/getChats', headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))['chats']), 12)
+        self.assertEqual(len(small), len(large))
+
+    def test_conversation_read_model_matches_rebuild(self):
+        """Conversation rows maintained on writes must equal a full rebuild from the message tables"""
+        from app.models.conversation import Conversation
+        from app.services.conversation_service import ConversationService
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        contact_id = self.add_contact(headers)
+        group = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))
+        group_id = group['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+
+        headers2, _ = self.login_user(self.test_user2, self.test_password2)
+        first = json.loads(self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'one'},
+                                            headers=headers2).data.decode('utf-8'))
+        self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'two'}, headers=headers2)
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'three'}, headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'four'}, headers=headers2)
+        MessageService().mark_as_read(first['message_id'], user_id)
+
+        def snapshot():
+            return sorted(
+                (c.user_id, c.chat_id, c.is_group, c.last_message_id, c.last_message_at, c.last_sender_id,
+                 c.unread_count)
+                for c in Conversation.query.all()
+            )
+
+        maintained = snapshot()
+        self.assertIn((user_id, contact_id, False), [row[:3] for row in maintained])
+        own_direct = next(row for row in maintained if row[:2] == (user_id, contact_id))
+        self.assertEqual(own_direct[6], 1)
+
+        self.assertIn('success', ConversationService().rebuild())
+        db.session.expire_all()
+        self.assertEqual(snapshot(), maintained)
+
+        result = self.app.test_cli_runner().invoke(args=["rebuild-conversations"])
+        self.assertIn("Rebuilt 4 conversation rows", result.output)
+
     def test_endpoint_get_all_users(self):
         """Test the getAllUsers endpoint"""
         # Set up users and login
@@ -555,6 +716,1018 @@ class TestApiEndpoints(BaseTestCase):
         
         print("=== Completed test_endpoint_get_chat_messages ===")
 
+    def test_get_chat_messages_cursor_pagination(self):
+        """Cursor pages walk the whole history, legacy pages keep working, unpaginated loads are capped"""
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        contact_id = self.add_contact(headers)
+        service = MessageService()
+        sent = [service.save_message(login_data['user_id'], contact_id, f"msg {i}")['message_id'] for i in range(25)]
+
+        def get(query):
+            response = self.client.get(f'/getChatMessages?chat_id={contact_id}&{query}', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.data.decode('utf-8'))
+
+        legacy = get('page=2')
+        self.assertEqual([m['message_id'] for m in legacy['messages']], sent[20:])
+        self.assertNotIn('cursors', legacy)
+
+        newest = get('limit=10')
+        self.assertEqual([m['message_id'] for m in newest['messages']], sent[15:])
+        self.assertTrue(newest['has_more'])
+
+        collected = [m['message_id'] for m in newest['messages']]
+        cursor = newest['cursors']['before']
+        while True:
+            older = get(f'limit=10&before={cursor}')
+            collected = [m['message_id'] for m in older['messages']] + collected
+            cursor = older['cursors']['before']
+            if not older['has_more']:
+                break
+        self.assertEqual(collected, sent)
+
+        first_page = get('page=1')
+        self.assertEqual(len(first_page['messages']), 20)
+        newer = get(f"limit=3&after={get('limit=25')['cursors']['before']}")
+        self.assertEqual([m['message_id'] for m in newer['messages']], sent[1:4])
+
+        self.app.config['MESSAGE_PAGE_MAX'] = 5
+        capped = get('limit=1000')
+        self.assertEqual([m['message_id'] for m in capped['messages']], sent[20:])
+        self.assertEqual(len(get('')['messages']), 5)
+
+        response = self.client.get(f'/getChatMessages?chat_id={contact_id}&before=garbage', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_message_page_query_count_is_constant(self):
+        """Message pages are loaded with joined queries, not with lookups per message"""
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        contact_id = self.add_contact(headers)
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        service = MessageService()
+        for i in range(60):
+            service.save_message(user_id, contact_id, f"direct {i}")
+            service.save_message(user_id, group_id, f"group {i}", is_group=True)
+
+        for chat_id in (contact_id, group_id):
+            self.client.get(f'/getChatMessages?chat_id={chat_id}&limit=1', headers=headers)  # group directory loaded
+            with self.count_queries() as small:
+                response = self.client.get(f'/getChatMessages?chat_id={chat_id}&limit=5', headers=headers)
+            self.assertEqual(len(json.loads(response.data.decode('utf-8'))['messages']), 5)
+
+            with self.count_queries() as large:
+                response = self.client.get(f'/getChatMessages?chat_id={chat_id}&limit=50', headers=headers)
+            messages = json.loads(response.data.decode('utf-8'))['messages']
+            self.assertEqual(len(messages), 50)
+            self.assertEqual({m['sender_username'] for m in messages}, {self.test_username})
+            self.assertEqual(len(small), len(large))
+
+        for is_group, chat_id in ((False, contact_id), (True, group_id)):
+            with self.count_queries() as small:
+                service.get_chat_messages(user_id, chat_id, is_group=is_group, page_size=5)
+            with self.count_queries() as large:
+                result = service.get_chat_messages(user_id, chat_id, is_group=is_group, page_size=50)
+            self.assertEqual(len(result['messages']), 50)
+            self.assertEqual(result['total_messages'], 60)
+            self.assertTrue(all(m['recipient_name'] != "Unknown Group" for m in result['messages']))
+            self.assertEqual(len(small), len(large))
+
+    def test_mark_chat_read_moves_watermark(self):
+        """markChatRead moves a per-chat watermark, unread counts are range counts after it"""
+        from app.models.message import MessageRead
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        contact_id = self.add_contact(headers)
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        service = MessageService()
+        received = [service.save_message(contact_id, user_id, f"msg {i}")['message_id'] for i in range(5)]
+        for i in range(3):
+            service.save_message(contact_id, group_id, f"group {i}", is_group=True)
+        self.assertEqual(service.get_unread_count(user_id, contact_id), 5)
+
+        response = self.client.post('/markChatRead', json={'chat_id': contact_id, 'message_id': received[2]},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['unread_count'], 2)
+        self.assertFalse(service.unread_count_query(user_id, contact_id).statement.compile().string.count('message_read'))
+
+        # an older message never moves the watermark back
+        result = service.mark_as_read(received[0], user_id)
+        self.assertEqual(result, {"success": True})
+        self.assertEqual(service.get_unread_count(user_id, contact_id), 2)
+        self.assertEqual(MessageRead.query.count(), 0)
+
+        messages = json.loads(self.client.get(f'/getChatMessages?chat_id={contact_id}',
+                                              headers=headers).data.decode('utf-8'))['messages']
+        self.assertEqual([m['message_id'] for m in messages], received)
+        read = service.get_chat_messages(user_id, contact_id)['messages']
+        self.assertEqual([m['read'] for m in read], [False, False, True, True, True])
+        self.assertTrue(service.is_message_read(received[2], user_id))
+        self.assertFalse(service.is_message_read(received[3], user_id))
+
+        result = json.loads(self.client.post(f'/markChatRead?chat_id={group_id}',
+                                             headers=headers).data.decode('utf-8'))
+        self.assertEqual(result['unread_count'], 0)
+        self.assertEqual(MessageRead.query.filter_by(reader_id=user_id).count(), 3)
+        self.assertEqual(service.conversation_service.get_conversation(user_id, group_id).unread_count, 0)
+
+        response = self.client.post(f'/markChatRead?chat_id={contact_id}&message_id=missing', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_chat_streams_ndjson(self):
+        """exportChat streams the whole history as NDJSON in batches, optionally gzipped"""
+        import gzip
+        from app.services.message_service import MessageService
+
+        headers, login_data = self.setup_users_and_login()
+        contact_id = self.add_contact(headers)
+        service = MessageService()
+        sent = [service.save_message(login_data['user_id'], contact_id, f"msg {i}")['message_id'] for i in range(30)]
+        self.app.config['EXPORT_BATCH_SIZE'] = 7
+
+        response = self.client.get(f'/exportChat?chat_id={contact_id}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        lines = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual([line['message_id'] for line in lines], sent)
+        self.assertEqual(lines[0]['sender_username'], self.test_username)
+
+        response = self.client.get(f'/exportChat?chat_id={contact_id}&gzip=true', headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['message_id'] for line in lines], sent)
+
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        headers2, _ = self.login_user(self.test_user2, self.test_password2)
+        response = self.client.get(f'/exportChat?chat_id={group_id}', headers=headers2)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(f'/exportChat?chat_id={group_id}', headers=headers)
+        self.assertEqual(response.data, b"")
+
+    def test_send_pipeline_single_commit_and_bounded_queries(self):
+        """saveMessage writes in one transaction with a bounded, size independent query count"""
+        from app.metrics import count_queries, metrics
+        from app.models.user import UserContact, ContactStatusEnum
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        stranger_id = self.get_user_id_by_username("stranger")
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        for member_id in self.get_member_ids(5):
+            self.client.post(f'/addMember?group_id={group_id}&new_member_id={member_id}', headers=headers)
+        metrics.reset()
+
+        # first message to a stranger creates both contact rows in the same transaction
+        with count_queries() as first:
+            response = self.client.post('/saveMessage', json={'recipient_id': stranger_id, 'content': 'hi'}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(first.commits, 1)
+        self.assertEqual(UserContact.query.filter(UserContact.contact_id.in_([user_id, stranger_id])).count(), 2)
+
+        for recipient_id in (stranger_id, group_id):
+            counts = []
+            for _ in range(4):
+                with count_queries() as counter:
+                    response = self.client.post('/saveMessage', json={'recipient_id': recipient_id, 'content': 'again'},
+                                                headers=headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(counter.commits, 1)
+                counts.append(counter.count)
+            self.assertEqual(len(set(counts[1:])), 1)  # the first one may still move streak/conversation state
+
+        self.app.config['METRICS_TOKEN'] = 'metrics-secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={'X-Metrics-Token': 'wrong'}).status_code, 401)
+        response = self.client.get('/metrics', headers={'X-Metrics-Token': 'metrics-secret'})
+        summary = json.loads(response.data.decode('utf-8'))['summaries']['send.queries']
+        self.assertEqual(summary['count'], 9)
+        self.assertLessEqual(summary['max'], 12)
+
+        # last words: the message is stored and the sender is blocked for good
+        stranger_row = UserContact.query.filter_by(user_id=user_id, contact_id=stranger_id).first()
+        stranger_row.status = ContactStatusEnum.LASTWORDS
+        db.session.commit()
+        response = self.client.post('/saveMessage', json={'recipient_id': stranger_id, 'content': 'bye'}, headers=headers)
+        self.assertIn("now blocked", json.loads(response.data.decode('utf-8'))['success'])
+        response = self.client.post('/saveMessage', json={'recipient_id': stranger_id, 'content': 'bye'}, headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+    def test_streak_engine_replays_message_histories(self):
+        """The incremental streak engine gives the streak and points of the old streak code on message histories"""
+        import random
+        from datetime import datetime, timedelta
+        from app.models import Message, User
+        from app.models.user import UserContact, ContactStatusEnum
+        from app.services.streak_service import StreakService
+
+        def baseline(history, once_per_day_fix):
+            """
+            ContactService.check_streak_validity + update_streak as they were before the engine,
+            replayed with the send time as utcnow(). once_per_day_fix is the only allowed change:
+            "established today" looks at the day the streak was counted instead of
+            last_streak_update, which check_streak_validity had just set (so it never got past 1).
+            """
+            rows = [{"streak": 0, "last_streak_update": None, "counted_on": None} for _ in range(2)]
+            last_sent, points, streaks = {}, 0, []
+            for sender, at in history:
+                last_sent[sender] = at
+                today, twenty_four_hours_ago = at.date(), at - timedelta(hours=24)
+                both_recent_messages = all(x in last_sent and last_sent[x] >= twenty_four_hours_ago for x in "ab")
+
+                # check_streak_validity
+                if not any(c["last_streak_update"] == today for c in rows):
+                    for c in rows:
+                        if not both_recent_messages and c["streak"] > 0:
+                            c["streak"] = 0
+                        c["last_streak_update"] = today
+
+                # update_streak
+                marker = "counted_on" if once_per_day_fix else "last_streak_update"
+                streak_established_today = any(c[marker] == today and c["streak"] > 0 for c in rows)
+                if streak_established_today and both_recent_messages:
+                    pass
+                elif both_recent_messages:
+                    for c in rows:
+                        c["streak"] += 1
+                        c["last_streak_update"] = c["counted_on"] = today
+                    points += 1
+                elif all(c["last_streak_update"] != today for c in rows):
+                    for c in rows:
+                        c["streak"] = 0
+                        c["last_streak_update"] = today
+                streaks.append(rows[0]["streak"])
+            return streaks, points
+
+        start = datetime(2025, 3, 1, 9)
+        day = lambda d, h, sender: (sender, start + timedelta(days=d, hours=h))
+        rng = random.Random(21)
+        histories = [
+            [day(d, h, s) for d in range(5) for h, s in ((0, "a"), (2, "b"), (3, "a"))],      # daily exchange
+            [day(0, 0, "a"), day(0, 1, "b"), day(1, 0, "a"), day(2, 5, "a"), day(2, 6, "b")],  # gap: reset
+            [day(0, -8, "a"), day(0, -7.5, "b"), day(0, 15.5, "a"), day(0, 38, "a"), day(0, 38.5, "b")],  # reset, same day again
+            [day(d, 0, "a") for d in range(4)],                                               # one-sided
+            [day(0, 14.8, "a"), day(0, 14.9, "b"), day(0, 15.1, "a"), day(1, 0, "b")],       # around midnight
+            [day(0, 0, "a"), day(0, 1, "b"), day(1, 0.5, "a"), day(1, 2, "a"), day(2, 0, "a")],  # checked today: kept
+            *(sorted([(rng.choice("ab"), start + timedelta(minutes=rng.randrange(8 * 24 * 60))) for _ in range(60)],
+                     key=lambda m: m[1]) for _ in range(4)),
+        ]
+
+        # the documented difference: without the fix a daily exchange never gets past 1
+        self.assertEqual(max(baseline(histories[0], once_per_day_fix=False)[0]), 1)
+        self.assertEqual(max(baseline(histories[0], once_per_day_fix=True)[0]), 5)
+        self.assertEqual(baseline(histories[5], once_per_day_fix=True)[0], [0, 1, 2, 2, 0])
+
+        streaks = StreakService()
+        for i, history in enumerate(histories):
+            ids = {"a": f"a{i}", "b": f"b{i}"}
+            db.session.add_all([User(user_id=user_id, username=user_id, password="x", salt="x", points=0)
+                                for user_id in ids.values()])
+            db.session.add_all([UserContact(user_id=ids[x], contact_id=ids[y], status=ContactStatusEnum.FRIEND, streak=0)
+                                for x, y in (("a", "b"), ("b", "a"))])
+            db.session.commit()
+
+            replayed = []
+            for n, (sender, at) in enumerate(history):
+                recipient = "b" if sender == "a" else "a"
+                db.session.add(Message(message_id=f"{i}-{n}", sender_user_id=ids[sender],
+                                       recipient_user_id=ids[recipient], encrypted_content="x", send_at=at))
+                replayed.append(streaks.record_message(ids[sender], ids[recipient], at)[0])
+                db.session.commit()
+
+            expected_streaks, expected_points = baseline(history, once_per_day_fix=True)
+            self.assertEqual(replayed, expected_streaks, f"history {i}")
+            self.assertEqual([db.session.get(User, user_id).points for user_id in ids.values()], [expected_points] * 2)
+            self.assertEqual({c.streak for c in UserContact.query.filter(UserContact.user_id.in_(ids.values()))},
+                             {expected_streaks[-1]})
+
+        # migration 4 fills last_sent_at of existing rows from the message table
+        from app.migrations.versions import incremental_streak_columns
+        recorded = {(c.user_id, c.contact_id): c.last_sent_at for c in UserContact.query.all()}
+        UserContact.query.update({UserContact.last_sent_at: None})
+        db.session.commit()
+        with db.engine.begin() as conn:
+            incremental_streak_columns(conn)
+        db.session.expire_all()
+        self.assertEqual({(c.user_id, c.contact_id): c.last_sent_at for c in UserContact.query.all()}, recorded)
+
+        # a message is one UPDATE of the pair, plus one of the points when the streak counts
+        with self.count_queries() as statements:
+            streaks.record_message("a0", "b0", start + timedelta(days=5, hours=1))
+            streaks.record_message("b0", "a0", start + timedelta(days=5, hours=2))
+        db.session.commit()
+        self.assertEqual([statement.split()[0] for statement in statements], ["UPDATE", "UPDATE", "UPDATE"])
+
+        # over the API: the first exchange of a new pair counts
+        headers, login_data = self.setup_users_and_login()
+        stranger_id = self.get_user_id_by_username("stranger")
+        self.client.post('/saveMessage', json={'recipient_id': stranger_id, 'content': 'hi'}, headers=headers)
+        stranger_headers, _ = self.login_user("stranger", "password_for_stranger")
+        self.client.post('/saveMessage', json={'recipient_id': login_data['user_id'], 'content': 'hi'},
+                         headers=stranger_headers)
+        db.session.expire_all()
+        self.assertEqual([c.streak for c in UserContact.query.filter_by(contact_id=stranger_id)], [1])
+        self.assertEqual(db.session.get(User, stranger_id).points, 1)
+
+    def test_streak_expiry_job_resets_broken_pairs_and_reads_do_not_write(self):
+        """Broken streaks are reset by the batch job; getChats only reads"""
+        from datetime import datetime, timedelta
+        from app.metrics import metrics
+        from app.models.user import UserContact, ContactStatusEnum
+        from app.services.streak_service import StreakService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        friend_id = self.login_user(self.test_user2, self.test_password2)[1]['user_id']
+        quiet_id = self.login_user(self.test_user3, self.test_password3)[1]['user_id']
+        now = datetime.utcnow()
+        for contact_id, contact_sent in ((friend_id, now - timedelta(hours=2)), (quiet_id, now - timedelta(hours=30))):
+            db.session.add_all([
+                UserContact(user_id=user_id, contact_id=contact_id, status=ContactStatusEnum.FRIEND, streak=3,
+                            last_sent_at=now - timedelta(hours=1)),
+                UserContact(user_id=contact_id, contact_id=user_id, status=ContactStatusEnum.FRIEND, streak=3,
+                            last_sent_at=contact_sent),
+            ])
+        db.session.commit()
+
+        with self.count_queries() as statements:
+            response = self.client.get('/getChats', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s for s in statements if not s.lstrip().upper().startswith("SELECT")], [])
+
+        # a message that arrives after the batch was selected wins over the stale batch
+        streaks = StreakService()
+        stale_batch = {(user_id, quiet_id), (quiet_id, user_id)}
+        streaks.record_message(quiet_id, user_id, now)
+        self.assertEqual(db.session.execute(streaks.expiry_update(stale_batch, now)).rowcount, 0)
+        db.session.rollback()
+
+        metrics.reset()
+        result = streaks.expire_streaks(now=now, batch_size=1)
+        self.assertEqual(result["expired"], 2)
+        db.session.expire_all()
+        self.assertEqual({(c.user_id, c.contact_id): c.streak for c in UserContact.query.all()}, {
+            (user_id, friend_id): 3, (friend_id, user_id): 3, (user_id, quiet_id): 0, (quiet_id, user_id): 0
+        })
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["streak_expiry.batches"], result["checked"])
+        self.assertEqual(snapshot["gauges"]["streak_expiry.progress"], result["checked"])
+
+        result = self.app.test_cli_runner().invoke(args=["expire-streaks"])
+        self.assertIn("Checked 2 streak(s), 0 expired.", result.output)
+
+    def test_write_behind_batches_whole_sends(self):
+        """With MESSAGE_WRITE_BEHIND sends are committed in batches, each with its streak and contact rows"""
+        from datetime import datetime
+        from app.metrics import metrics
+        from app.models import Message, User
+        from app.models.user import UserContact
+        from app.services.conversation_service import ConversationService
+        from app.services.send_service import SendService
+        from app.services.write_behind import get_write_behind
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        stranger_id = self.get_user_id_by_username("stranger")
+        self.app.config.update(MESSAGE_WRITE_BEHIND=True, WRITE_BEHIND_FLUSH_MS=20)
+        service = SendService()
+        write_behind = get_write_behind(self.app)
+        metrics.reset()
+        try:
+            pending = [service.send(user_id, stranger_id, f"msg {i}", wait=False) for i in range(40)]
+            self.assertTrue(all(status == 200 and result['pending'] for result, status in pending))
+            self.assertEqual(pending[0][0]['new_contacts'], [(user_id, stranger_id), (stranger_id, user_id)])
+
+            # /saveMessage waits for the commit by default (WRITE_BEHIND_WAIT)
+            stranger_headers, _ = self.login_user("stranger", "password_for_stranger")
+            response = self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'reply'},
+                                        headers=stranger_headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNotNone(db.session.get(Message, json.loads(response.data.decode('utf-8'))['message_id']))
+
+            # a bad send fails alone, the rest of its batch is still written
+            def duplicate():
+                db.session.add(Message(message_id=pending[0][0]['message_id'], sender_user_id=user_id,
+                                       recipient_user_id=stranger_id, encrypted_content="again",
+                                       send_at=datetime.utcnow(), is_group=False))
+                db.session.flush()
+            failing = write_behind.submit(duplicate)
+            after, _ = service.send(user_id, stranger_id, "after", wait=False)
+
+            write_behind.flush(timeout=5)
+            self.assertIsNotNone(failing.exception(timeout=5))
+            db.session.expire_all()
+            self.assertIsNotNone(db.session.get(Message, after['message_id']))
+            self.assertEqual(Message.query.count(), 42)
+            self.assertEqual(ConversationService().get_conversation(stranger_id, user_id).unread_count, 41)
+            # the contact rows were created once, the exchange counted the streak
+            self.assertEqual({(c.user_id, c.contact_id, c.streak) for c in UserContact.query.filter(
+                UserContact.user_id.in_([user_id, stranger_id]), UserContact.contact_id.in_([user_id, stranger_id]))},
+                {(user_id, stranger_id, 1), (stranger_id, user_id, 1)})
+            self.assertEqual(db.session.get(User, stranger_id).points, 1)
+            self.assertLess(metrics.snapshot()['summaries']['write_behind.batch_size']['count'], 42)
+            self.assertEqual(metrics.snapshot()['counters']['write_behind.failed'], 1)
+        finally:
+            write_behind.stop()
+
+        # stopping flushes what is still queued and rejects new writes
+        self.assertRaises(RuntimeError, write_behind.submit, lambda: None)
+
+    def test_websocket_rooms_reach_every_device(self):
+        """Fan-outs are room emits: every device gets them, group rooms follow the membership"""
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        user_id, contact_id = login_data['user_id'], login_data2['user_id']
+        phone, laptop = self.connect_socket(login_data), self.connect_socket(login_data)
+        contact_device = self.connect_socket(login_data2)
+        self.assertTrue(phone.is_connected() and laptop.is_connected())
+        self.assertEqual(len(websockets.registry.sids(user_id)), 2)
+
+        def events(client, name):
+            return [event['args'][0] for event in client.get_received() if event['name'] == name]
+
+        self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'hi'}, headers=headers2)
+        self.assertEqual(len(events(phone, 'new_message')), 1)
+        self.assertEqual(len(events(laptop, 'new_message')), 1)
+
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        contact_device.get_received()
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        self.assertEqual([e['action'] for e in events(contact_device, 'chat_change')], ['add_member'])
+        for client in (phone, laptop):
+            client.get_received()
+
+        sender = db.session.get(websockets.User, contact_id)
+        with self.count_queries() as statements:
+            websockets.send_message(sender, group_id, 'hello', is_group=True)
+        self.assertEqual(statements, [])
+        self.assertEqual(len(events(phone, 'new_message')), 1)
+        self.assertEqual(len(events(laptop, 'new_message')), 1)
+        self.assertEqual(events(contact_device, 'new_message'), [])  # the sender's own devices are skipped
+
+        self.client.post(f'/removeMember?group_id={group_id}&member_id={contact_id}', headers=headers)
+        self.assertEqual([e['action'] for e in events(contact_device, 'chat_change')], ['remove_member'])
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'members only'}, headers=headers)
+        self.assertEqual(events(contact_device, 'new_message'), [])
+
+        phone.disconnect()
+        self.assertEqual(len(websockets.registry.sids(user_id)), 1)
+        laptop.disconnect()
+        self.assertFalse(websockets.registry.is_online(user_id))
+
+        from app.websocket.registry import ConnectionRegistry
+        with self.assertRaises(TypeError):
+            ConnectionRegistry()  # abstract, every registry implements the whole interface
+
+    def test_typing_is_coalesced_without_queries(self):
+        """send_char needs no database access and sends at most one receive_char per interval"""
+        from app.metrics import metrics
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        _, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        contact_id = login_data2['user_id']
+        phone, contact_device = self.connect_socket(login_data), self.connect_socket(login_data2)
+
+        now = [1000.0]
+        throttle = websockets.typing_throttle
+        self.addCleanup(setattr, throttle, 'clock', throttle.clock)
+        throttle.clock = lambda: now[0]
+        metrics.reset()
+
+        def typing_events():
+            return [event['args'][0] for event in contact_device.get_received() if event['name'] == 'receive_char']
+
+        with self.count_queries() as statements:
+            for char in 'hello':
+                phone.emit('send_char', {'recipient_id': contact_id, 'char': char})
+        self.assertEqual(statements, [])
+        first, = typing_events()
+        self.assertEqual((first['char'], first['chars'], first['is_group']), ('h', ['h'], False))
+        self.assertEqual(first['sender_username'], self.test_username)
+
+        now[0] += throttle.interval
+        throttle.flush()
+        second, = typing_events()
+        self.assertEqual((second['char'], second['chars']), ('o', ['e', 'l', 'l', 'o']))
+
+        # coalesced events that are not sent in time are dropped
+        phone.emit('send_char', {'recipient_id': contact_id, 'char': 'x'})
+        now[0] += throttle.stale_after + 1
+        throttle.flush()
+        self.assertEqual(typing_events(), [])
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['typing.received'], 6)
+        self.assertEqual(counters['typing.forwarded'], 2)
+        self.assertEqual(counters['typing.dropped'], 1)
+
+        # group members get the typing events of the group, the sender's devices don't
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        contact_device.get_received()
+        phone.get_received()
+        phone.emit('send_char', {'recipient_id': group_id, 'char': 'g'})
+        group_event, = typing_events()
+        self.assertTrue(group_event['is_group'])
+        self.assertEqual([e for e in phone.get_received() if e['name'] == 'receive_char'], [])
+
+    def test_timeout_is_served_from_the_active_item_cache(self):
+        """Timeouts are checked in memory, set by useItem, evicted at active_until and dropped on invalidation"""
+        from datetime import timedelta
+        from app.models.items import Item, Inventory
+        from app.services.active_item_cache import active_item_cache
+        from app.services.invalidation import invalidation_bus
+        from app.services.item_service import ItemService
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        user_id = login_data['user_id']
+        item_service = ItemService()
+        item_service.reset_items()
+        timeout = Item.query.filter_by(name='timeout').first()
+        db.session.add(Inventory(item_id=timeout.id, user_id=login_data2['user_id'], quantity=1))
+        db.session.commit()
+
+        self.assertIsNone(item_service.is_timed_out(user_id))
+        response = self.client.post(f'/useItem?item_name=timeout&to_user_id={user_id}', headers=headers2)
+        self.assertEqual(response.status_code, 200)
+
+        with self.count_queries() as statements:
+            until = item_service.is_timed_out(user_id)
+        self.assertEqual(statements, [])
+        self.assertIsNotNone(until)
+        response = self.client.post('/saveMessage', json={'recipient_id': login_data2['user_id'], 'content': 'hi'}, headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+        # another worker used an item: the entry is dropped and read again from the database
+        invalidation_bus.dispatch('active_items', user_id)
+        with self.count_queries() as statements:
+            self.assertEqual(item_service.is_timed_out(user_id), until)
+        self.assertEqual(len(statements), 1)
+
+        # evicted exactly at active_until, without asking the database
+        def no_load():
+            self.fail("the cache asked the database")
+        self.assertEqual(active_item_cache.get(user_id, until - timedelta(seconds=1), no_load), {'timeout': until})
+        self.assertEqual(active_item_cache.get(user_id, until, no_load), {})
+
+        # a load that raced with use_item's invalidation is not stored
+        def racing_load():
+            invalidation_bus.dispatch('active_items', 'racing')
+            return []
+        self.assertEqual(active_item_cache.get('racing', until, racing_load), {})
+        self.assertEqual(active_item_cache.get('racing', until, lambda: [('timeout', until + timedelta(minutes=1))]),
+                         {'timeout': until + timedelta(minutes=1)})
+
+    def test_presence_goes_to_contacts_and_group_members_in_frames(self):
+        """Presence transitions are sent as presence_diff frames to contacts and group members only"""
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        _, login_data3 = self.login_user(self.test_user3, self.test_password3)
+        self.register_test_user('stranger', 'password_stranger')
+        _, stranger_data = self.login_user('stranger', 'password_stranger')
+        user_id, contact_id, member_id = login_data['user_id'], login_data2['user_id'], login_data3['user_id']
+
+        self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'hi'}, headers=headers2)
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={member_id}', headers=headers)
+
+        self.app.config['PRESENCE_INTERVAL_MS'] = 3600 * 1000  # frames are flushed by the test
+        contact_device = self.connect_socket(login_data2)
+        member_device = self.connect_socket(login_data3)
+        stranger_device = self.connect_socket(stranger_data)
+        websockets.presence.flush()
+        for client in (contact_device, member_device, stranger_device):
+            client.get_received()
+
+        def frames(client):
+            return [event['args'][0]['changes'] for event in client.get_received() if event['name'] == 'presence_diff']
+
+        # a reconnect within the interval collapses into the last state
+        phone = self.connect_socket(login_data)
+        phone.disconnect()
+        phone = self.connect_socket(login_data)
+        laptop = self.connect_socket(login_data)
+        websockets.presence.flush()
+
+        expected = [[{'user_id': user_id, 'username': self.test_username, 'status': 'online'}]]
+        self.assertEqual(frames(contact_device), expected)
+        self.assertEqual(frames(member_device), expected)
+        self.assertEqual(frames(stranger_device), [])
+
+        phone.disconnect()
+        websockets.presence.flush()
+        self.assertEqual(frames(contact_device), [])  # still online on the laptop
+        laptop.disconnect()
+        self.assertEqual(websockets.presence.flush(), 2)
+        self.assertEqual(frames(contact_device)[0][0]['status'], 'offline')
+        self.assertEqual(frames(stranger_device), [])
+
+    def test_presence_store_replaces_is_online_writes(self):
+        """Online state comes from the presence store, connecting writes nothing and entries expire"""
+        from app.models import User
+        from app.services.user_service import UserService
+        from app.services.presence_store import get_presence_store
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        user_id, contact_id = login_data['user_id'], login_data2['user_id']
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'hi'}, headers=headers)
+
+        def contact_online():
+            chats = json.loads(self.client.get('/getChats', headers=headers).data.decode('utf-8'))['chats']
+            return next(chat['is_online'] for chat in chats if chat['contact_id'] == contact_id)
+
+        self.assertFalse(contact_online())
+        with self.count_queries() as statements:
+            device = self.connect_socket(login_data2)
+        self.assertFalse([statement for statement in statements if not statement.lstrip().upper().startswith('SELECT')])
+        websockets.flush_arrivals()  # done by the presence flusher
+        self.assertTrue(contact_online())
+        users = json.loads(self.client.get(f'/getAllUsers?searchBy={self.test_user2}', headers=headers).data.decode('utf-8'))['users']
+        self.assertTrue(users[0]['is_online'])
+        self.assertTrue(UserService().user_dicts([db.session.get(User, contact_id)])[0]['is_online'])
+        self.assertNotIn('is_online', User.__table__.columns)  # dropped by migration 5
+
+        device.disconnect()
+        self.assertFalse(contact_online())
+
+        # without heartbeats (e.g. the worker crashed) the entry expires after the TTL
+        store = get_presence_store()
+        now = [1000.0]
+        self.addCleanup(setattr, store, 'clock', store.clock)
+        store.clock = lambda: now[0]
+        store.set_online([contact_id])
+        self.assertTrue(contact_online())
+        now[0] += store.ttl
+        self.assertFalse(contact_online())
+
+    def test_connect_admission_caches_identity_and_limits_the_rate(self):
+        """Reconnects decode no token and read no user row, connects over the rate are refused"""
+        from app.metrics import metrics
+        from app.services.presence_store import get_presence_store
+        from app.websocket import websockets
+        from app.websocket.admission import TokenBucket
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+
+        def user_reads(statements):
+            return [statement for statement in statements if 'FROM user ' in statement or 'FROM user\n' in statement]
+
+        metrics.reset()
+        with self.count_queries() as statements:
+            device = self.connect_socket(login_data)
+        self.assertTrue(user_reads(statements))
+        self.assertFalse(get_presence_store().is_online(user_id))  # written with the next presence flush
+        websockets.flush_arrivals()
+        self.assertTrue(get_presence_store().is_online(user_id))
+        device.disconnect()
+
+        with self.count_queries() as statements:
+            device = self.connect_socket(login_data)
+        self.assertTrue(device.is_connected())
+        self.assertFalse(user_reads(statements))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual((counters['connect.identity_hits'], counters['connect.user_hits'], counters['connect.admitted']), (1, 1, 2))
+
+        # a new username reaches the cache through the invalidation bus
+        self.client.post('/changeProfile', json={'action': 'name', 'new_value': 'renamed'}, headers=headers)
+        self.connect_socket(login_data)
+        self.assertEqual(metrics.snapshot()['counters']['connect.user_misses'], 2)
+        self.assertIn('renamed', [c['username'] for c in websockets.local_connections.values()])
+
+        self.addCleanup(setattr, websockets, 'connect_bucket', websockets.connect_bucket)
+        websockets.connect_bucket = TokenBucket(rate=0, burst=1)
+        self.assertTrue(self.connect_socket(login_data).is_connected())
+        self.assertFalse(self.connect_socket(login_data).is_connected())
+        self.assertEqual(metrics.snapshot()['counters']['connect.rejected'], 1)
+
+    def test_send_message_over_socket_is_acknowledged(self):
+        """send_message over the socket stores the message and acks the real message_id, which the recipients get too"""
+        from app.models import Message
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        user_id, contact_id = login_data['user_id'], login_data2['user_id']
+        phone, contact_device = self.connect_socket(login_data), self.connect_socket(login_data2)
+        contact_device.get_received()
+
+        ack = phone.emit('send_message', {'recipient_id': contact_id, 'content': 'over the socket', 'client_id': 'c1'}, callback=True)
+        self.assertTrue(ack['success'])
+        self.assertEqual(ack['client_id'], 'c1')
+        stored = db.session.get(Message, ack['message_id'])
+        self.assertEqual((stored.sender_user_id, stored.recipient_user_id), (user_id, contact_id))
+        self.assertEqual(ack['timestamp'], stored.send_at.isoformat())
+
+        pushed = [e['args'][0] for e in contact_device.get_received() if e['name'] == 'new_message']
+        self.assertEqual([(m['message_id'], m['content'], m['timestamp']) for m in pushed],
+                         [(ack['message_id'], 'over the socket', ack['timestamp'])])
+
+        # same validation as /saveMessage
+        ack = phone.emit('send_message', {'recipient_id': contact_id}, callback=True)
+        self.assertEqual((ack['error'], ack['status']), ("'content' is required", 400))
+
+        # the HTTP path pushes the stored id as well
+        response = self.client.post('/saveMessage', json={'recipient_id': user_id, 'content': 'via http'}, headers=headers2)
+        message_id = json.loads(response.data.decode('utf-8'))['message_id']
+        pushed = [e['args'][0] for e in phone.get_received() if e['name'] == 'new_message']
+        self.assertEqual([m['message_id'] for m in pushed], [message_id])
+
+    def test_reconnect_replays_missed_events(self):
+        """A reconnecting client gets the events after its last seq, or resync_required"""
+        self.maxDiff = None
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        contact_id = login_data2['user_id']
+
+        def received(client):
+            return [(event['name'], event['args'][0]) for event in client.get_received()]
+
+        device = self.connect_socket(login_data2)
+        (name, sync), = received(device)
+        self.assertEqual(name, 'sync')
+        self.assertFalse(sync['resync_required'])
+        device.disconnect()
+
+        # missed while offline: a direct message, being added to a group and a message in it
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'before you joined'}, headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'direct'}, headers=headers)
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'welcome'}, headers=headers)
+
+        device = self.connect_socket(login_data2, last_seq=sync['seq'], epoch=sync['epoch'])
+        events = received(device)
+        self.assertEqual([name for name, _ in events], ['new_message', 'chat_change', 'chat_change', 'new_message', 'sync'])
+        self.assertEqual([data['content'] for name, data in events if name == 'new_message'], ['direct', 'welcome'])
+        self.assertEqual(events[1][1]['user_id'], login_data['user_id'])  # new contact
+        self.assertEqual(events[2][1]['action'], 'add_member')
+        seqs = [data['seq'] for _, data in events[:4]]
+        self.assertEqual(seqs, sorted(seqs))
+        sync = events[-1][1]
+        self.assertEqual((sync['replayed'], sync['resync_required'], sync['seq']), (4, False, seqs[-1]))
+
+        # live events carry their seq as well
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'live'}, headers=headers)
+        (name, live), = received(device)
+        self.assertGreater(live['seq'], sync['seq'])
+        device.disconnect()
+
+        # more missed events than the log keeps, or a log from another epoch: resync
+        self.addCleanup(setattr, websockets.event_log, 'retention', websockets.event_log.retention)
+        websockets.event_log.retention = 1
+        for content in ('one', 'two'):
+            self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': content}, headers=headers)
+        device = self.connect_socket(login_data2, last_seq=live['seq'], epoch=sync['epoch'])
+        self.assertEqual(received(device), [('sync', {**sync, 'seq': live['seq'] + 2, 'replayed': 0, 'resync_required': True})])
+        other_epoch = self.connect_socket(login_data2, last_seq=live['seq'], epoch='old')
+        self.assertTrue(received(other_epoch)[-1][1]['resync_required'])
+
+        # a room that was evicted and recreated does not hide the evicted events
+        from app.websocket.event_log import LocalEventLog
+        log = LocalEventLog(retention=10, max_rooms=1)
+        seen = log.append(['user:a'], 'new_message', {})
+        log.append(['user:a'], 'new_message', {})
+        log.append(['user:b'], 'new_message', {})  # evicts user:a
+        log.append(['user:a'], 'new_message', {})
+        self.assertEqual(log.since({'user:a': seen}, 'a'), ([], True))
+
+    def test_outbound_queue_drops_low_priority_first_and_disconnects_slow_clients(self):
+        """Emits beyond a connection's burst are queued, typing is dropped before messages"""
+        from app.metrics import metrics
+        from app.websocket import websockets
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        contact_id = login_data2['user_id']
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'hello'}, headers=headers)
+        self.app.config['OUTBOUND_INTERVAL_MS'] = 3600 * 1000  # the test flushes itself
+        device = self.connect_socket(login_data2)
+        device.get_received()
+        sid, = websockets.registry.sids(contact_id)
+
+        outbound = websockets.outbound
+        for name in ('size', 'burst', 'clock'):
+            self.addCleanup(setattr, outbound, name, getattr(outbound, name))
+        outbound.size = 3
+        outbound.burst = 0  # the connection used up its budget
+        now = [0.0]
+        outbound.clock = lambda: now[0]
+        outbound.clear()
+        metrics.reset()
+
+        def typing():
+            websockets._send_typing({'sender_id': login_data['user_id'], 'sender_username': self.test_username,
+                                     'char': 'H', 'chars': ['H'], 'is_group': False, 'recipient_id': contact_id})
+
+        for content in ('one', 'two'):
+            self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': content}, headers=headers)
+            typing()
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'three'}, headers=headers)
+        self.assertEqual(device.get_received(), [])
+        self.assertEqual(outbound.depth(sid), 3)
+        self.assertEqual(metrics.snapshot()['counters']['outbound.dropped'], 2)
+        outbound.flush()
+        self.assertEqual(metrics.snapshot()['gauges']['outbound.depth_top'], [{'user_id': contact_id, 'depth': 3}])
+
+        # the next intervals send the backlog: the messages arrive in order, the typing events were dropped
+        outbound.burst = 2
+        outbound.flush()
+        outbound.flush()
+        received = [(event['name'], event['args'][0].get('content')) for event in device.get_received()]
+        self.assertEqual(received, [('new_message', 'one'), ('new_message', 'two'), ('new_message', 'three')])
+        self.assertEqual(metrics.snapshot()['gauges']['outbound.backlogged'], 0)
+        self.assertEqual(metrics.snapshot()['gauges']['outbound.depth'], 0)
+        self.assertEqual(metrics.snapshot()['gauges']['outbound.depth_top'], [])
+
+        # a connection that stays backlogged for OUTBOUND_SLOW_S is disconnected
+        outbound.flush()
+        outbound.burst, outbound.size = 1, 10
+        for content in ('four', 'five', 'six'):
+            for _ in range(3):  # more than the connection is sent per interval
+                self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': content}, headers=headers)
+            outbound.flush()
+            now[0] += outbound.slow_after / 2 + 1
+        self.assertEqual(metrics.snapshot()['counters']['outbound.disconnected'], 1)
+        self.assertFalse(device.is_connected())
+
+        # a full queue of messages only: the client is disconnected and replays from the event log
+        outbound.burst, outbound.size = 0, 3
+        device = self.connect_socket(login_data2)
+        for content in ('seven', 'eight', 'nine', 'ten'):
+            self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': content}, headers=headers)
+        self.assertEqual(metrics.snapshot()['counters']['outbound.disconnected'], 2)
+        self.assertFalse(device.is_connected())
+
+        # a replay that does not fit into burst + queue is a resync instead of a disconnect loop
+        outbound.burst = 1
+        outbound.flush()
+        device = self.connect_socket(login_data2)
+        sync = device.get_received()[-1]['args'][0]
+        device.disconnect()
+        for content in ('eleven', 'twelve', 'thirteen', 'fourteen'):
+            self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': content}, headers=headers)
+        outbound.flush()
+        device = self.connect_socket(login_data2, last_seq=sync['seq'], epoch=sync['epoch'])
+        outbound.flush()
+        received = device.get_received()
+        self.assertEqual([event['name'] for event in received], ['sync'])
+        self.assertTrue(received[0]['args'][0]['resync_required'])
+        self.assertEqual(metrics.snapshot()['counters']['outbound.disconnected'], 2)
+
+    def test_offloaded_database_calls_run_in_the_thread_pool(self):
+        """serve.py runs the DB-API calls in a thread pool, the app works the same"""
+        import threading
+        from app.serving import OffloadedDBAPI, offload_database
+
+        offload_database(self.app, 'eventlet', 2)
+        headers, login_data = self.setup_users_and_login()
+        response = self.client.get('/getChats', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        connection = db.session.connection().connection.dbapi_connection
+        self.assertIsInstance(connection, OffloadedDBAPI)
+        threads = []
+        connection.create_function('thread_ident', 0, lambda: threads.append(threading.get_ident()) or 1)
+        cursor = connection.cursor()
+        cursor.execute('select thread_ident()')
+        self.assertEqual(cursor.fetchall(), [(1,)])
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_emits_reach_sockets_on_another_worker(self):
+        """With a message queue, HTTP requests on one worker reach the sockets held by another worker process"""
+        import multiprocessing
+        import socket
+        import time
+        import socketio
+        from app.websocket import websockets
+        from app.websocket.local_queue import run_broker
+
+        headers, login_data = self.setup_users_and_login()
+        headers2, login_data2 = self.login_user(self.test_user2, self.test_password2)
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={login_data2["user_id"]}', headers=headers)
+
+        def free_port():
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                return s.getsockname()[1]
+
+        queue_port, worker_port = free_port(), free_port()
+        message_queue = f"local://127.0.0.1:{queue_port}"
+        queue_key = 'test-queue-key'
+        context = multiprocessing.get_context('spawn')
+
+        broker_ready = context.Event()
+        broker = context.Process(target=run_broker, args=(queue_port, queue_key, broker_ready), daemon=True)
+        broker.start()
+        self.addCleanup(broker.terminate)
+        self.assertTrue(broker_ready.wait(10))
+
+        # worker A holds the first user's socket
+        subscribed = context.Event()
+        worker = context.Process(target=socket_worker, args=(
+            db.engine.url.render_as_string(hide_password=False), message_queue, queue_key, worker_port, subscribed
+        ), daemon=True)
+        worker.start()
+        self.addCleanup(worker.terminate)
+        self.assertTrue(subscribed.wait(20))
+
+        received = []
+        device = socketio.Client()
+        device.on('new_message', received.append)
+        deadline = time.monotonic() + 20
+        while not device.connected:
+            try:
+                device.connect(f"http://127.0.0.1:{worker_port}?token={login_data['access_token']}", transports=['polling'])
+            except socketio.exceptions.ConnectionError:
+                self.assertLess(time.monotonic(), deadline, "worker A did not start")
+                time.sleep(0.2)
+        self.addCleanup(device.disconnect)
+
+        # worker B: this process serves the HTTP requests of the contact
+        self.app.config['SOCKETIO_MESSAGE_QUEUE'] = message_queue
+        self.app.config['LOCAL_QUEUE_KEY'] = queue_key
+        websockets.init_websockets(self.app, async_mode='threading')
+        self.addCleanup(self.reset_socketio)
+
+        self.client.post('/saveMessage', json={'recipient_id': login_data['user_id'], 'content': 'direct'}, headers=headers2)
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'group'}, headers=headers2)
+
+        deadline = time.monotonic() + 10
+        while len(received) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual([(m['content'], m['is_group']) for m in received], [('direct', False), ('group', True)])
+        self.assertEqual(received[1]['recipient_id'], group_id)
+
+    def test_local_queue_needs_the_key(self):
+        """The local broker listens on localhost only and serves only connections that know the key"""
+        import threading
+        from app.websocket.local_queue import LocalBroker, connect, parse_url, recv_frame, send_frame
+
+        broker = LocalBroker(0, 'right-key')
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+        self.assertEqual(broker.address[0], '127.0.0.1')
+        with self.assertRaises(ValueError):
+            parse_url('local://10.0.0.1:6499')
+
+        with self.assertRaises(ConnectionError):
+            connect(broker.address, 'wrong-key', 'subscribe', 'test')
+
+        subscriber = connect(broker.address, 'right-key', 'subscribe', 'test')
+        publisher = connect(broker.address, 'right-key', 'publish', 'test')
+        send_frame(publisher, {'method': 'emit', 'data': [1, 'two']})
+        self.assertEqual(recv_frame(subscriber), {'method': 'emit', 'data': [1, 'two']})
+        subscriber.close()
+        publisher.close()
+
+    def test_invalidations_reach_other_workers_over_the_local_queue(self):
+        """With local://, invalidations go through the local broker; a queue without a bus is refused"""
+        import threading
+        import time
+        from app.config import Config
+        from app.services.invalidation import InvalidationBus
+        from app.websocket.local_queue import LocalBroker
+
+        broker = LocalBroker(0, 'bus-key')
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+        url = f'local://127.0.0.1:{broker.address[1]}'
+        worker_a, worker_b = InvalidationBus(), InvalidationBus()
+        dropped = []
+        worker_b.subscribe('groups', dropped.append)
+        worker_a.connect(url, key='bus-key')
+        worker_b.connect(url, key='bus-key')
+
+        worker_a.publish('groups', 7)
+        worker_a.publish('groups')
+        deadline = time.monotonic() + 5
+        while len(dropped) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(dropped, [7, None])
+
+        class KafkaConfig(Config):
+            SOCKETIO_MESSAGE_QUEUE = 'kafka://localhost:9092'
+
+        with self.assertRaises(RuntimeError):
+            create_app(KafkaConfig)
+
     def test_endpoint_get_groups(self):
         """Test the getGroups endpoint"""
         print("\n=== Starting test_endpoint_get_groups ===")
@@ -842,6 +2015,36 @@ class TestApiEndpoints(BaseTestCase):
         self.assertEqual(data['username'], self.test_username)
         self.assertIn('profile_picture', data)
 
+    def test_user_lookups_are_remembered_for_the_request(self):
+        """A request loads a user once however often the routes and services look it up"""
+        from app.metrics import metrics
+        from app.models.user import User
+        from app.services.user_service import UserService
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        metrics.reset()
+
+        def user_queries(statements):
+            return [s for s in statements if 'FROM user' in s and 'user.user_id = ?' in s]
+
+        with self.count_queries() as statements:
+            response = self.client.get('/getOwnProfile', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(user_queries(statements)), 1)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["user_lookup.misses.api.get_own_profile"], 1)
+        self.assertEqual(counters["user_lookup.hits.api.get_own_profile"], 2)
+
+        # the memo ends with the request: a user that did not exist is found by the next one
+        with self.app.test_request_context():
+            self.assertFalse(UserService().does_user_exist("later"))
+            db.session.add(User(user_id="later", username="later", password="x", salt="x"))
+            db.session.commit()
+            self.assertFalse(UserService().does_user_exist("later"))
+        with self.app.test_request_context():
+            self.assertTrue(UserService().does_user_exist("later"))
+
     def test_send_message(self):
         """Test the sendMessage endpoint"""
         # Set up users and login
@@ -900,5 +2103,212 @@ class TestApiEndpoints(BaseTestCase):
         data = json.loads(response.data.decode('utf-8'))
         self.assertIn('success', data)
 
+    def test_group_checks_are_served_from_the_group_directory(self):
+        """Group existence, membership and role checks hit the database once, mutators invalidate"""
+        from app.models import GroupRoleEnum
+        from app.services.group_directory import group_directory
+        from app.services.group_service import GroupService, GROUPS_CHANNEL
+        from app.services.invalidation import invalidation_bus
+
+        headers, login_data = self.setup_users_and_login()
+        user_id = login_data['user_id']
+        contact_id = self.add_contact(headers)
+        member_id = self.get_member_ids(1)[0]
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'hi'}, headers=headers)
+        self.client.get(f'/getChatMessages?chat_id={contact_id}', headers=headers)
+
+        def group_queries(statements):
+            return [s for s in statements if 'group_member' in s or 'FROM "group"' in s]
+
+        with self.count_queries() as statements:
+            self.client.get(f'/getChatMessages?chat_id={group_id}', headers=headers)
+            self.client.get(f'/getChatMessages?chat_id={contact_id}', headers=headers)  # cached as no group
+            self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'again'}, headers=headers)
+            self.client.post('/markChatRead', json={'chat_id': group_id}, headers=headers)
+        self.assertEqual(group_queries(statements), [])
+
+        service = GroupService()
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={member_id}', headers=headers)
+        self.assertTrue(service.is_user_member(member_id, group_id))
+        self.client.post('/changeGroup', json={'action': 'admin', 'group_id': group_id, 'new_value': member_id},
+                         headers=headers)
+        self.assertTrue(service.is_user_admin(member_id, group_id))
+        self.client.post(f'/removeMember?group_id={group_id}&member_id={member_id}', headers=headers)
+        self.assertFalse(service.is_user_member(member_id, group_id))
+        self.client.post(f'/deleteGroup?group_id={group_id}', headers=headers)
+        self.assertFalse(service.does_group_exist(group_id))
+
+        # a load that raced with an invalidation is not stored
+        def racing_loader(group_id):
+            group_directory.invalidate(group_id)
+            return {user_id: GroupRoleEnum.ADMIN}
+        self.assertEqual(group_directory.members("racing", racing_loader), {user_id: GroupRoleEnum.ADMIN})
+        self.assertIsNone(group_directory.members("racing", lambda group_id: None))
+
+        # other workers drop their entry through the invalidation bus
+        self.assertIsNone(group_directory.members("racing", lambda group_id: {}))
+        invalidation_bus.dispatch(GROUPS_CHANNEL, "racing")
+        self.assertEqual(group_directory.members("racing", lambda group_id: {}), {})
+
+        # "no such group" is only believed for missing_ttl seconds
+        self.addCleanup(setattr, group_directory, 'clock', group_directory.clock)
+        now = [0.0]
+        group_directory.clock = lambda: now[0]
+        self.assertIsNone(group_directory.members("later", lambda group_id: None))
+        self.assertIsNone(group_directory.members("later", lambda group_id: {user_id: GroupRoleEnum.ADMIN}))
+        now[0] += group_directory.missing_ttl + 1
+        self.assertEqual(group_directory.members("later", lambda group_id: {user_id: GroupRoleEnum.ADMIN}),
+                         {user_id: GroupRoleEnum.ADMIN})
+
+    def test_profile_cards_replace_user_rows_and_follow_changes(self):
+        """Names and pictures come from the profile card cache, profile changes invalidate it"""
+        from app.metrics import metrics
+        from app.models.user import User
+        from app.services.invalidation import invalidation_bus
+        from app.services.profile_cards import ProfileCard
+        from app.services.user_service import UserService, USERS_CHANNEL
+
+        headers, login_data = self.setup_users_and_login()
+        contact_id = self.add_contact(headers)
+        group_id = json.loads(self.client.post('/createGroup', json={}, headers=headers).data.decode('utf-8'))['group']['contact_id']
+        self.client.post(f'/addMember?group_id={group_id}&new_member_id={contact_id}', headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': contact_id, 'content': 'hi'}, headers=headers)
+        self.client.post('/saveMessage', json={'recipient_id': group_id, 'content': 'hi all'}, headers=headers)
+        profile_cards.invalidate()
+
+        def card_loads(statements):
+            return [s for s in statements if 'user.username' in s and 'user.password' not in s]
+
+        def names():
+            chats = json.loads(self.client.get('/getChats', headers=headers).data.decode('utf-8'))['chats']
+            contact = next(chat for chat in chats if chat['contact_id'] == contact_id)
+            group = next(chat for chat in chats if chat['contact_id'] == group_id)
+            member = next(m for m in group['members'] if m['contact_id'] == contact_id)
+            return contact['name'], contact['picture_url'], member['name'], member['picture_url']
+
+        # one column-only query for every contact and member, then none
+        with self.count_queries() as cold:
+            self.assertEqual(names()[0], self.test_user2)
+        self.assertEqual(len(card_loads(cold)), 1)
+        metrics.reset()
+        with self.count_queries() as warm:
+            names()
+            messages = json.loads(self.client.get(f'/getChatMessages?chat_id={contact_id}', headers=headers)
+                                  .data.decode('utf-8'))['messages']
+            self.client.get(f'/getChatMessages?chat_id={group_id}', headers=headers)
+        self.assertEqual(card_loads(warm), [])
+        self.assertEqual({m['sender_username'] for m in messages}, {self.test_username})
+        counters = metrics.snapshot()["counters"]
+        self.assertGreater(counters["profile_cards.hits"], 0)
+        self.assertNotIn("profile_cards.misses", counters)
+
+        # profile changes drop the card
+        service = UserService()
+        service.change_username(contact_id, "renamed")
+        service.change_profile_picture(contact_id, "new.png")
+        self.assertEqual(names(), ("renamed", "new.png", "renamed", "new.png"))
+
+        # a change on another worker arrives through the invalidation bus
+        User.query.filter_by(user_id=contact_id).update({"username": "elsewhere"})
+        db.session.commit()
+        self.assertEqual(names()[0], "renamed")
+        invalidation_bus.dispatch(USERS_CHANNEL, contact_id)
+        self.assertEqual(names()[0], "elsewhere")
+
+        # a load that raced with an invalidation is not stored
+        def racing_loader(user_ids):
+            profile_cards.invalidate("racing")
+            return [ProfileCard("racing", "old", None)]
+        self.assertEqual(profile_cards.cards(["racing"], racing_loader)["racing"].username, "old")
+        self.assertEqual(profile_cards.cards(["racing"], lambda user_ids: []), {})
+
+class TestSchemaMigrations(BaseTestCase):
+    """Tests for the versioned migrations and the query plan check"""
+
+    def test_hot_queries_do_not_scan(self):
+        """Every hot service query must be an index seek on a freshly created schema"""
+        from app.migrations.query_plans import check_query_plans
+
+        result = check_query_plans()
+        self.assertEqual(result["failures"], [])
+
+    def test_upgrade_adds_indexes_to_existing_database(self):
+        """A database created before the indexes existed gets them through upgrade()"""
+        from app.migrations import upgrade, current_version, head_version
+        from app.migrations.query_plans import check_query_plans
+
+        with db.engine.begin() as conn:
+            for name in ('ix_message_sender_recipient_send_at', 'ix_message_recipient_group_send_at',
+                         'ix_message_read_reader_id', 'ix_group_member_user_id',
+                         'ix_active_items_user_active_until', 'ix_user_contact_contact_id'):
+                conn.exec_driver_sql(f'DROP INDEX {name}')
+
+        failing = [name for name, _ in check_query_plans()["failures"]]
+        self.assertIn("group page", failing)
+        self.assertIn("active items", failing)
+        self.assertEqual(current_version(), 0)
+
+        applied = upgrade()
+        self.assertEqual([version for version, _ in applied], list(range(1, head_version() + 1)))
+        self.assertEqual(current_version(), head_version())
+        self.assertEqual(check_query_plans()["failures"], [])
+        self.assertEqual(upgrade(), [])
+
+        result = self.app.test_cli_runner().invoke(args=["check-query-plans"])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_replayed_migrations_give_the_model_schema(self):
+        """upgrade() on an empty database creates the tables, columns and indexes of the models"""
+        from sqlalchemy import inspect
+        from app.migrations import upgrade
+
+        def schema():
+            inspector = inspect(db.engine)
+            return {table: ({column['name'] for column in inspector.get_columns(table)},
+                            {index['name'] for index in inspector.get_indexes(table)})
+                    for table in db.metadata.tables}
+
+        expected = schema()
+        db.session.remove()
+        db.drop_all()
+        upgrade()
+        self.assertEqual(schema(), expected)
+
+    def test_upgrade_turns_receipts_into_watermarks(self):
+        """Migration 3 keeps the newest receipt per chat as watermark and drops direct receipts"""
+        from datetime import datetime, timedelta
+        from app.models.conversation import Conversation
+        from app.migrations import head_version, schema_version, stamp_head, upgrade
+        from app.models import Group, GroupMember, GroupRoleEnum, Message, ReadWatermark, User
+        from app.models.message import MessageRead
+
+        users = [User(user_id=f"u{i}", username=f"user{i}", password="x", salt="x") for i in range(2)]
+        group = Group(group_id="g1", group_name="group")
+        db.session.add_all(users + [group] + [GroupMember(group_id="g1", user_id=user.user_id, role=GroupRoleEnum.MEMBER)
+                                             for user in users])
+        start = datetime(2025, 1, 1)
+        messages = [Message(message_id=f"d{i}", sender_user_id="u1", recipient_user_id="u0", encrypted_content="x",
+                            send_at=start + timedelta(minutes=i)) for i in range(3)]
+        messages += [Message(message_id=f"g{i}", sender_user_id="u1", recipient_user_id="g1", encrypted_content="x",
+                             send_at=start + timedelta(minutes=i), is_group=True) for i in range(2)]
+        db.session.add_all(messages)
+        db.session.add_all([MessageRead(message_id=message_id, reader_id="u0", read_at=start)
+                            for message_id in ("d0", "d1", "g0")])
+        db.session.commit()
+        stamp_head()
+        with db.engine.begin() as conn:
+            ReadWatermark.__table__.drop(conn)
+            conn.execute(schema_version.delete().where(schema_version.c.version >= 3))
+
+        self.assertEqual([version for version, _ in upgrade()], list(range(3, head_version() + 1)))
+        db.session.expire_all()
+        watermarks = {(w.user_id, w.chat_id): w.read_up_to_message_id for w in ReadWatermark.query.all()}
+        self.assertEqual(watermarks, {("u0", "u1"): "d1", ("u0", "g1"): "g0"})
+        self.assertEqual([r.message_id for r in MessageRead.query.all()], ["g0"])
+        # unread counters follow the watermarks without a manual rebuild
+        unread = {(c.user_id, c.chat_id): c.unread_count for c in Conversation.query.all()}
+        self.assertEqual(unread, {("u0", "u1"): 1, ("u1", "u0"): 0, ("u0", "g1"): 1, ("u1", "g1"): 0})
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()